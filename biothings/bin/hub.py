@@ -16,15 +16,50 @@ logging.getLogger("requests").setLevel(logging.ERROR)
 logging.info("Hub DB backend: %s" % biothings.config.HUB_DB_BACKEND)
 logging.info("Hub database: %s" % biothings.config.DATA_HUB_DB_DATABASE)
 
-from biothings.utils.manager import JobManager
+from biothings.utils.manager import JobManager, RecyclingProcessPoolExecutor
 loop = asyncio.get_event_loop()
-process_queue = concurrent.futures.ProcessPoolExecutor(max_workers=config.HUB_MAX_WORKERS)
+max_tasks_per_worker = getattr(config,"HUB_MAX_TASKS_PER_WORKER",None)
+max_worker_memory = getattr(config,"HUB_MAX_WORKER_MEMORY",None)
+if max_tasks_per_worker or max_worker_memory:
+    # worker processes are recycled one by one, after a number of jobs
+    # or when using too much memory
+    process_queue = RecyclingProcessPoolExecutor(max_workers=config.HUB_MAX_WORKERS,
+            max_tasks_per_worker=max_tasks_per_worker,
+            max_worker_memory=max_worker_memory)
+else:
+    process_queue = concurrent.futures.ProcessPoolExecutor(max_workers=config.HUB_MAX_WORKERS)
 thread_queue = concurrent.futures.ThreadPoolExecutor()
 loop.set_default_executor(process_queue)
+remote_queue = None
+if getattr(config,"HUB_REMOTE_WORKERS_PORT",None):
+    # workers connect with: python -m biothings.utils.parallel --host <hub> --port <port>
+    # and must share HUB_REMOTE_WORKERS_AUTHKEY (required). Listening on localhost
+    # unless HUB_REMOTE_WORKERS_HOST is set (eg. "0.0.0.0" for all interfaces)
+    from biothings.utils.parallel import RemoteWorkerExecutor
+    remote_queue = RemoteWorkerExecutor(host=getattr(config,"HUB_REMOTE_WORKERS_HOST","127.0.0.1"),
+                                        port=config.HUB_REMOTE_WORKERS_PORT,logger=config.logger,
+                                        authkey=getattr(config,"HUB_REMOTE_WORKERS_AUTHKEY",None))
+    remote_queue.start()
 jmanager = JobManager(loop,
                       process_queue, thread_queue,
                       max_memory_usage=None,
+                      remote_queue=remote_queue,
                       )
+# report callbacks blocking the event loop (lag above threshold, in seconds)
+from biothings.utils.loopmonitor import LoopMonitor
+loop_monitor = LoopMonitor(loop,threshold=getattr(config,"HUB_LOOP_LAG_THRESHOLD",0.5),
+                           logger=config.logger)
+loop_monitor.start()
+# docs/s, bytes/s per step and source, queues and workers usage
+from biothings.utils.metrics import MetricsCollector
+metrics_collector = MetricsCollector(loop,job_manager=jmanager)
+metrics_collector.register_gauges(loop_monitor.get_metrics)
+metrics_collector.start()
+if getattr(config,"HUB_METRICS_PORT",None):
+    # Prometheus text format, on http://host:port/metrics. Not authenticated, listening
+    # on localhost unless HUB_METRICS_HOST is set (eg. "0.0.0.0" for all interfaces)
+    loop.run_until_complete(metrics_collector.start_http_server(host=getattr(config,"HUB_METRICS_HOST","127.0.0.1"),
+                                                                port=config.HUB_METRICS_PORT))
 
 import biothings.hub.dataload.uploader as uploader
 import biothings.hub.dataload.dumper as dumper
@@ -43,6 +78,10 @@ index_manager = indexer.IndexerManager(pindexer=pindexer,job_manager=jmanager)
 index_manager.configure()
 
 dmanager = dumper.DumperManager(job_manager=jmanager)
+# downloads from all dumpers share bandwidth and connections
+from biothings.hub.dataload.scheduler import get_download_scheduler
+download_scheduler = get_download_scheduler()
+metrics_collector.register_gauges(download_scheduler.get_metrics)
 dmanager.schedule_all()
 # manually register biothings source dumper
 # this dumper will download whatever is necessary to update an ES index
@@ -83,6 +122,9 @@ COMMANDS = {
         "top" : partial(top,process_queue,thread_queue),
         "pending" : pending,
         "done" : done,
+        "lag" : loop_monitor.report,
+        "metrics" : metrics_collector.report,
+        "downloads" : download_scheduler.report,
         }
 
 passwords = hasattr(config,"HUB_ACCOUNTS") and config.HUB_ACCOUNTS or {
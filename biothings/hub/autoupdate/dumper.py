@@ -8,6 +8,7 @@ biothings.config_for_app(config)
 from config import DATA_ARCHIVE_ROOT
 from biothings.hub.dataload.dumper import HTTPDumper, DumperException
 from biothings.utils.common import gunzipall, md5sum
+from biothings.utils.diffplan import VersionPlanner, final_version
 
 HUB_ENV = hasattr(config,"HUB_ENV") and config.HUB_ENV or "" # default to prod (normal)
 LATEST = HUB_ENV and "%s-latest" % HUB_ENV or "latest"
@@ -46,11 +47,17 @@ class BiothingsDumper(HTTPDumper):
     # TODO: should we ensure ARCHIVE is always true ?
     # (ie we have to keep all versions to apply them in order)
 
+    # number of diff files downloaded at the same time
+    MAX_PARALLEL_DUMP = 4
+    # number of concurrent requests used to fetch versions metadata
+    PLANNER_WORKERS = 8
 
     def __init__(self, *args, **kwargs):
         super(BiothingsDumper,self).__init__(*args,**kwargs)
         # list of build_version to download/apply, in order
         self._target_backend = None
+        # local diff file => md5sum from release metadata
+        self.expected_md5 = {}
 
     @property
     def target_backend(self):
@@ -63,11 +70,17 @@ class BiothingsDumper(HTTPDumper):
 
     def download(self,remoteurl,localfile,headers={}):
         res = super(BiothingsDumper,self).download(remoteurl,localfile,headers=headers)
+        # check diff files as soon as they're downloaded (md5 computed while downloading)
+        expected = self.expected_md5.get(localfile)
+        if expected and res.get("md5") != expected:
+            raise DumperException("Bad md5sum for file '%s' (expected %s, got %s)" % \
+                    (localfile,expected,res.get("md5")))
         # use S3 metadata to set local mtime
         # we add 1 second to make sure we wouldn't download remoteurl again
         # because remote is older by just a few milliseconds
         lastmodified = int(res.headers["x-amz-meta-lastmodified"]) + 1
         os.utime(localfile, (lastmodified, lastmodified))
+        return res
 
     def load_remote_json(self,url):
         res = self.client.get(url)
@@ -145,6 +158,44 @@ class BiothingsDumper(HTTPDumper):
         # - when incremental, it's always old_version.new_version
         return max(versions)
 
+    def plan_update(self, build_meta):
+        """
+        Return cheapest list of releases (chained incrementals and/or full)
+        to go from backend's current version to the one from "build_meta"
+        """
+        versions_url = self.__class__.SRC_URL % (self.__class__.BIOTHINGS_APP,VERSIONS)
+        avail_versions = self.load_remote_json(versions_url)
+        if not avail_versions:
+            self.logger.error("Can't find versions information from URL %s, will try '%s'" % \
+                    (versions_url,build_meta["require_version"]))
+            avail_versions = [build_meta["require_version"],build_meta["build_version"]]
+        planner = VersionPlanner(lambda v: self.__class__.SRC_URL % (self.__class__.BIOTHINGS_APP,v),
+                                 max_workers=self.__class__.PLANNER_WORKERS,logger=self.logger)
+        return planner.get_plan(avail_versions,self.target_backend.version,
+                                final_version(build_meta["build_version"]))
+
+    def add_diff_file(self, furl, localfile, md5):
+        """Add diff file to download list, unless it's already been downloaded"""
+        self.expected_md5[localfile] = md5
+        prev = self.remote_files.get(furl) or {}
+        if md5 and prev.get("md5") == md5 and os.path.exists(localfile):
+            self.logger.debug("Diff file '%s' already downloaded" % localfile)
+            return
+        self.to_dump.append({"remote":furl, "local":localfile})
+
+    def prefetch(self, steps):
+        """
+        Add diff files from next incremental releases to download list (in their
+        own data folder), so they're ready when these releases are dumped
+        """
+        for step in steps:
+            if step["type"] != "incremental":
+                continue
+            folder = os.path.join(self.src_root_folder,step["version"])
+            for finfo in step["files"]:
+                self.add_diff_file(finfo["url"],os.path.join(folder,os.path.basename(finfo["name"])),
+                                   finfo["md5sum"])
+
     def create_todump_list(self, force=False, version=LATEST):
         assert self.__class__.BIOTHINGS_APP, "BIOTHINGS_APP class attribute is not set"
         self.logger.info("Dumping version '%s'" % version)
@@ -192,31 +243,18 @@ class BiothingsDumper(HTTPDumper):
                 else:
                     self.logger.info("Diff update requires version '%s' but target_backend is '%s'" % \
                             (build_meta["require_version"],self.target_backend.version))
-                    # TODO: we could keep track of what's needed to update, recursively. But
-                    # note sure if it's a good idea because we'd need to mix dumper and
-                    # uploader processes together, orchestrate them which can be tricky.
-                    # If we just let dumper and uploader works on their own, and
-                    # kind of force dumper to check more regularly when we know we have more than
-                    # one update to go through, we would respect dumper/uploade decoupling and things
-                    # we would keep things simple (it'd be a little bit longer though)
-                    # keep track on this version, we'll need to apply it later
-                    self.logger.info("Now looking for a compatible version")
-                    # by default we'll check directly the required version
-                    required_version = build_meta["require_version"]
-                    versions_url = self.__class__.SRC_URL % (self.__class__.BIOTHINGS_APP,VERSIONS)
-                    avail_versions = self.load_remote_json(versions_url)
-                    if not avail_versions:
-                        self.logger.error("Can't find versions information from URL %s, will try '%s'" % \
-                                (versions_url,required_version))
-                    else:
-                        # if any of available versions end with "require_version", then it means it's compatible
-                        compatibles = [v for v in avail_versions if v.endswith(build_meta["require_version"])]
-                        self.logger.info("Compatible versions from which we can apply this update: %s" % compatibles)
-                        best_version = self.choose_best_version(compatibles)
-                        self.logger.info("Best version found: '%s'" % best_version)
-                        required_version = best_version
-                    # let's get what we need
-                    return self.create_todump_list(force=force,version=required_version)
+                    # releases are still applied one at a time (dumper and uploader stay decoupled)
+                    # but we look for the cheapest way to reach that version (chained incrementals
+                    # or full release), dump the first release and prefetch next releases' diff files
+                    plan = self.plan_update(build_meta)
+                    if not plan:
+                        raise DumperException("Can't find any way to update from version '%s' to '%s'" % \
+                                (self.target_backend.version,build_meta["build_version"]))
+                    self.logger.info("Update plan: %s (%s bytes)" % ([s["version"] for s in plan],
+                        sum([s["size"] or 0 for s in plan])))
+                    self.create_todump_list(force=force,version=plan[0]["version"])
+                    self.prefetch(plan[1:])
+                    return self.release
                 self.release = build_meta["build_version"]
                 # ok, now we can use download()
                 # we will download it again during the normal process so we can then compare
@@ -239,7 +277,7 @@ class BiothingsDumper(HTTPDumper):
                         # this is a true URL
                         furl = fname
                     new_localfile = os.path.join(self.new_data_folder,os.path.basename(fname))
-                    self.to_dump.append({"remote":furl, "local":new_localfile}) 
+                    self.add_diff_file(furl,new_localfile,md5_fname.get("md5sum"))
             else:
                 # it's a full snapshot release, it always can be applied
                 self.release = build_meta["build_version"]
@@ -262,7 +300,10 @@ class BiothingsDumper(HTTPDumper):
             for md5_fname in metadata["diff"]["files"]:
                 spec_md5 = md5_fname["md5sum"]
                 fname = md5_fname["name"]
-                compute_md5 = md5sum(os.path.join(self.new_data_folder,fname))
+                localfile = os.path.join(self.new_data_folder,fname)
+                # md5 was computed while downloading, no need to read the file again
+                downloaded = [f for f in self.remote_files.values() if f.get("local") == localfile]
+                compute_md5 = downloaded and downloaded[0].get("md5") or md5sum(localfile)
                 if compute_md5 != spec_md5:
                     self.logger.error("md5 check failed for file '%s', it may be corrupted" % fname)
                     e = DumperException("Bad md5sum for file '%s'" % fname)
@@ -21,6 +21,7 @@ from biothings.utils.loggers import get_logger, HipchatHandler
 from biothings.utils.manager import BaseManager, ManagerError
 from biothings.utils.dataload import update_dict_recur
 import biothings.utils.mongo as mongo
+from biothings.utils import metrics
 from biothings.utils.hub_db import get_source_fullname, get_src_build_config, \
                                    get_src_build, get_src_dump, get_src_master
 from biothings import config as btconfig
@@ -671,6 +672,7 @@ class DataBuilder(object):
                 cnt += len(doc_ids)
                 pinfo = self.get_pinfo()
                 pinfo["step"] = src_name
+                pinfo["__remote__"] = True # batches can run on remote workers, if any
                 pinfo["description"] = "#%d/%d (%.1f%%)" % (bnum,btotal,(cnt/total*100))
                 self.logger.info("Creating merger job #%d/%d, to process '%s' %d/%d (%.1f%%)" % \
                         (bnum,btotal,src_name,cnt,total,(cnt/total*100.)))
@@ -728,6 +730,7 @@ def merger_worker(col_name,dest_name,ids,mapper,upsert,batch_num):
         mapper.load()
         docs = mapper.process(cur)
         cnt = dest.update(docs, upsert=upsert)
+        metrics.record("merge",col_name,docs=cnt)
         return cnt
     except Exception as e:
         logger_name = "build_%s_%s_batch_%s" % (dest_name,col_name,batch_num)
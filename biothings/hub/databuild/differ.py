@@ -21,6 +21,7 @@ from biothings.utils.backend import DocMongoBackend
 import biothings.utils.aws as aws
 from biothings.utils.jsondiff import make as jsondiff
 from biothings.utils.hub import publish_data_version
+from biothings.utils import metrics
 
 logging = btconfig.logger
 
@@ -410,8 +411,11 @@ def diff_worker_new_vs_old(id_list_new, old_db_col_names, new_db_col_names,
         md5 = md5sum(file_name)
         summary["diff_file"] = {
                 "name" : os.path.basename(file_name),
-                "md5sum" : md5
+                "md5sum" : md5,
+                "size" : os.path.getsize(file_name)
                 }
+    metrics.record("diff",new.target_name,docs=len(id_list_new),
+                   size=summary.get("diff_file") and os.path.getsize(file_name) or 0)
 
     return summary
 
@@ -433,8 +437,11 @@ def diff_worker_old_vs_new(id_list_old, new_db_col_names, batch_num, diff_folder
         md5 = md5sum(file_name)
         summary["diff_file"] = {
                 "name" : os.path.basename(file_name),
-                "md5sum" : md5
+                "md5sum" : md5,
+                "size" : os.path.getsize(file_name)
                 }
+    metrics.record("diff",new.target_name,docs=len(id_list_old),
+                   size=summary.get("diff_file") and os.path.getsize(file_name) or 0)
 
     return summary
 
@@ -22,6 +22,7 @@ from ..dataload.storage import UpsertStorage
 from biothings.utils.es import ESIndexer
 import biothings.utils.jsonpatch as jsonpatch
 from biothings.utils.diff import generate_diff_folder
+from biothings.utils import metrics
 
 logging = btconfig.logger
 
@@ -282,6 +283,8 @@ def sync_mongo_jsondiff_worker(diff_file, old_db_col_names, new_db_col_names, ba
     logging.info("Done applying diff from file '%s': %s" % (diff_file,res))
     diff.setdefault("synced",{}).setdefault("mongo",True)
     dump(diff,diff_file)
+    metrics.record("sync",diff["source"],docs=res["added"] + res["updated"] + res["deleted"],
+                   size=os.path.getsize(diff_file))
     return res
 
 
@@ -358,6 +361,8 @@ def sync_es_jsondiff_worker(diff_file, es_config, new_db_col_names, batch_size,
     logging.info("Done applying diff from file '%s': %s" % (diff_file,res))
     diff.setdefault("synced",{}).setdefault("es",True)
     dump(diff,diff_file)
+    metrics.record("sync",diff["source"],docs=res["added"] + res["updated"] + res["deleted"],
+                   size=os.path.getsize(diff_file))
     return res
 
 
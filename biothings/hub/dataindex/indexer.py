@@ -19,6 +19,7 @@ from biothings import config as btconfig
 from biothings.utils.mongo import doc_feeder, id_feeder
 from config import LOG_FOLDER, logger as logging
 from biothings.utils.hub import publish_data_version
+from biothings.utils import metrics
 
 
 class IndexerException(Exception):
@@ -293,6 +294,7 @@ class Indexer(object):
                 cnt += len(ids)
                 pinfo = self.get_pinfo()
                 pinfo["step"] = self.target_name
+                pinfo["__remote__"] = True # batches can run on remote workers, if any
                 pinfo["description"] = "#%d/%d (%.1f%%)" % (bnum,btotal,(cnt/total*100))
                 self.logger.info("Creating indexer job #%d/%d, to index '%s' %d/%d (%.1f%%)" % \
                         (bnum,btotal,target_name,cnt,total,(cnt/total*100.)))
@@ -458,6 +460,7 @@ def do_index_worker(col_name,ids,pindexer,batch_num):
         idxer = pindexer()
         cur = doc_feeder(col, step=len(ids), inbatch=False, query={'_id': {'$in': ids}})
         cnt = idxer.index_bulk(cur)
+        metrics.record("index",col_name,docs=cnt[0])
         return cnt
 
 def indexer_worker(col_name,ids,pindexer,batch_num,mode="index"):
@@ -1,7 +1,8 @@
-import time
-import os, pprint
+import time, threading
+import os, pprint, shutil
 from datetime import datetime
 import asyncio
+import concurrent.futures
 from functools import partial
 
 from biothings.utils.hub_db import get_src_dump
@@ -10,11 +11,73 @@ from biothings.utils.loggers import HipchatHandler
 from config import logger as logging, HIPCHAT_CONFIG, LOG_FOLDER
 
 from biothings.utils.manager import BaseSourceManager
+from biothings.utils import metrics, transfer
+from biothings.utils.contentstore import ContentStore, detach
+from biothings.hub.dataload.scheduler import get_download_scheduler
+from biothings import config as btconfig
+from urllib import parse as urlparse
+
+# idle clients kept in worker processes, per dumper and host, as
+# (client,idle_since,timeout) tuples (see BaseDumper.pooled_download)
+_client_pool = {}
+_client_pool_lock = threading.Lock()
+# pid of the process where the thread closing idle clients runs
+_client_pool_reaper = None
+# dump status is saved from that thread, in order, so the event loop isn't
+# blocked by database access
+_status_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
 
 class DumperException(Exception):
     pass
 
+
+def close_client(client):
+    try:
+        getattr(client,"close",lambda: None)()
+    except Exception:
+        pass
+
+
+def close_idle_clients(now=None):
+    """Close pooled clients idle for longer than their timeout, return how many were closed"""
+    now = now or time.time()
+    expired = []
+    with _client_pool_lock:
+        for key,idle in list(_client_pool.items()):
+            expired.extend([c for c,since,timeout in idle if now - since >= timeout])
+            idle[:] = [e for e in idle if now - e[1] < e[2]]
+            if not idle:
+                _client_pool.pop(key)
+    for client in expired:
+        close_client(client)
+    return len(expired)
+
+
+def start_pool_reaper(interval=5):
+    """Start thread closing idle pooled clients, if not already running in this process"""
+    global _client_pool_reaper
+    with _client_pool_lock:
+        if _client_pool_reaper == os.getpid():
+            return
+        _client_pool_reaper = os.getpid()
+    def reap():
+        while True:
+            time.sleep(interval)
+            close_idle_clients()
+    threading.Thread(target=reap,name="dumper-pool-reaper",daemon=True).start()
+
+class DownloadResult(dict):
+    """
+    Information about a downloaded file (remote, local, validators, checksum...),
+    stored in src_dump (download.remote_files) to detect changes on next dump.
+    Response's headers and status code are available as attributes.
+    """
+    def __init__(self, *args, headers=None, status_code=None, **kwargs):
+        super(DownloadResult,self).__init__(*args,**kwargs)
+        self.headers = headers or {}
+        self.status_code = status_code
+
 class BaseDumper(object):
     # override in subclass accordingly
     SRC_NAME = None
@@ -31,6 +94,39 @@ class BaseDumper(object):
 
     SCHEDULE = None # crontab format schedule, if None, won't be scheduled
 
+    # max number of files downloaded at the same time by this dumper
+    # (default: config.MAX_PARALLEL_DUMP, or process pool's size if not set)
+    MAX_PARALLEL_DUMP = None
+    # max number of connections to the same host, across all dumpers running
+    # in the hub (default: config.MAX_CONNECTIONS_PER_HOST, or no limit).
+    # First dumper connecting to a host sets its limit.
+    MAX_CONNECTIONS_PER_HOST = None
+    # downloads from dumpers with higher priority are started first, and get
+    # a bigger share of the hub's bandwidth (see scheduler.DownloadScheduler)
+    DOWNLOAD_PRIORITY = 0
+    # connections are kept in worker processes after a download to be reused
+    # for next files, and closed once idle for that long (seconds, None to not
+    # keep them). Idle ones per host and process are limited to MAX_CONNECTIONS_PER_HOST
+    POOL_IDLE_TIMEOUT = 30
+
+    # checksums computed while downloading (any hashlib algorithm), stored in src_dump
+    CHECKSUMS = ["md5"]
+    # decompress .gz/.bz2 files while downloading, next to compressed ones
+    # (same name without extension, as gunzipall() does)
+    DECOMPRESS = False
+    # stop (no post-dump, no upload) when downloaded files are the same as previous
+    # dump's (previous release is kept). Set to True in dumpers where it's safe to
+    # skip post_dump (eg. releases based on dates, which change even if content doesn't)
+    STOP_IF_UNCHANGED = False
+    # keep dumped files in a content-addressed store (config.DATA_STORE_ROOT, default
+    # DATA_ARCHIVE_ROOT/.store), hardlinked to release folders, so files identical
+    # between releases are stored once (default: config.DUMPER_USE_STORE, or False)
+    USE_STORE = None
+
+    # max time (seconds) create_todump_list() can take before dump is cancelled
+    # (default: config.DUMPER_CHECK_TIMEOUT, or no limit)
+    CHECK_TIMEOUT = None
+
     def __init__(self, src_name=None, src_root_folder=None, log_folder=None, no_confirm=True, archive=None):
         # unpickable attrs, grouped
         self.init_state()
@@ -47,6 +143,15 @@ class BaseDumper(object):
         self.timestamp = time.strftime('%Y%m%d')
         self.prepared = False
         self.steps=["dump","post"]
+        self.progress = None
+        # remote file => DownloadResult from previous/current dump
+        self.remote_files = {}
+        self.unchanged = False
+        self.cancelled = False
+        # remote file => local file, for files not downloaded as up-to-date
+        self.up_to_date = {}
+        # bandwidth allocation for current download (set in worker process)
+        self.throttle_file = None
 
     def init_state(self):
         self._state = {
@@ -63,6 +168,9 @@ class BaseDumper(object):
     @property
     def client(self):
         if not self._state["client"]:
+            if self.cancelled:
+                # don't let a cancelled create_todump_list() reconnect
+                raise DumperException("Dump was cancelled")
             self.prepare_client()
         return self._state["client"]
     @property
@@ -127,6 +235,70 @@ class BaseDumper(object):
         """
         raise NotImplementedError("Define in subclass")
 
+    def get_content_tap(self, localfile):
+        """Return a ContentTap computing checksums (and decompressing) while downloading"""
+        algos = list(self.__class__.CHECKSUMS)
+        store = self.get_store()
+        if store and not store.algo in algos:
+            algos.append(store.algo)
+        consumers = [transfer.Checksums(algos)]
+        if self.__class__.DECOMPRESS and transfer.Decompressor.supports(localfile):
+            consumers.append(transfer.Decompressor(localfile))
+        throttle = self.throttle_file and transfer.Throttle(path=self.throttle_file) or None
+        return transfer.ContentTap(consumers,throttle=throttle)
+
+    def make_download_result(self, remotefile, localfile, tap, **kwargs):
+        """
+        Build a DownloadResult with tap's results (checksums, ...). It's
+        flagged "unchanged" if checksums are the same as previous dump's.
+        """
+        result = DownloadResult(remote=remotefile,local=localfile,**kwargs)
+        result.update(tap.finish(localfile))
+        prev = self.remote_files.get(remotefile) or {}
+        common = [algo for algo in self.__class__.CHECKSUMS if prev.get(algo)]
+        result["unchanged"] = bool(common) and all([prev[algo] == result[algo] for algo in common])
+        return result
+
+    def get_store(self):
+        """Return ContentStore if dumped files are stored there, None otherwise"""
+        use_store = self.__class__.USE_STORE
+        if use_store is None:
+            use_store = getattr(btconfig,"DUMPER_USE_STORE",False)
+        if not use_store:
+            return None
+        root = getattr(btconfig,"DATA_STORE_ROOT",None) or os.path.join(btconfig.DATA_ARCHIVE_ROOT,".store")
+        return ContentStore(root,logger=self.logger)
+
+    def store_file(self, remotefile, localfile, result):
+        """
+        Add downloaded file to the store (if used), so it's hardlinked to the already
+        stored copy if any. File's digest is added to download result.
+        """
+        store = self.get_store()
+        if not store or not os.path.isfile(localfile):
+            return result
+        if not isinstance(result,DownloadResult):
+            result = DownloadResult(remote=remotefile,local=localfile)
+        result[store.algo] = store.add(localfile,result.get(store.algo))
+        return result
+
+    def link_up_to_date(self):
+        """
+        Files which didn't need to be downloaded (see remote_is_better()) are
+        hardlinked from the store to their local path in the new release folder
+        """
+        store = self.get_store()
+        for remotefile,localfile in self.up_to_date.items():
+            prev = self.remote_files.get(remotefile)
+            if not prev or os.path.exists(localfile):
+                continue
+            if store and store.link(prev.get(store.algo),localfile):
+                self.logger.debug("'%s' linked from store (up-to-date)" % localfile)
+                self.remote_files[remotefile] = DownloadResult(prev,local=localfile)
+            else:
+                # removed from store meanwhile, new release would be incomplete
+                raise DumperException("Up-to-date file '%s' couldn't be linked to '%s'" % (remotefile,localfile))
+
     def post_download(self, remotefile, localfile):
         """Placeholder to add a custom process once a file is downloaded.
         This is a good place to check file's integrity. Optional"""
@@ -214,12 +386,54 @@ class BaseDumper(object):
             self.src_doc["download"]["pid"] = os.getpid()
         else:
             self.src_doc["download"]["time"] = timesofar(self.t0)
+        if self.progress:
+            self.src_doc["download"]["progress"] = self.progress
+        if self.remote_files:
+            self.src_doc["download"]["remote_files"] = list(self.remote_files.values())
         if "download" in extra:
             self.src_doc["download"].update(extra["download"])
         else:
             self.src_doc.update(extra)
         self.src_dump.save(self.src_doc)
 
+    @asyncio.coroutine
+    def save_status(self,status,transient=False,**extra):
+        """Call register_status() from a thread so event loop isn't blocked by database access"""
+        yield from asyncio.get_event_loop().run_in_executor(_status_executor,
+                partial(self.register_status,status,transient=transient,**extra))
+
+    @asyncio.coroutine
+    def check(self,job_manager,force=False,**kwargs):
+        """
+        Run create_todump_list() in a thread, so listing remote files doesn't block
+        the event loop. If it takes more than CHECK_TIMEOUT seconds (or if dump is
+        cancelled), client is released so pending network calls are interrupted.
+        """
+        pinfo = self.get_pinfo()
+        pinfo["step"] = "check"
+        timeout = self.__class__.CHECK_TIMEOUT or getattr(btconfig,"DUMPER_CHECK_TIMEOUT",None)
+        job = yield from job_manager.defer_to_thread(pinfo,partial(self.create_todump_list,force=force,**kwargs))
+        try:
+            # shield: thread can't be stopped, its job will end on its own
+            yield from asyncio.wait_for(asyncio.shield(job),timeout)
+        except asyncio.TimeoutError:
+            # thread's result (probably an error now) is of no use
+            job.add_done_callback(lambda f: f.exception())
+            self.cancel_check()
+            raise DumperException("Checking remote files took more than %ss, cancelled" % timeout)
+        except asyncio.CancelledError:
+            self.cancel_check()
+            raise
+
+    def cancel_check(self):
+        self.cancelled = True
+        self.to_dump = []
+        if self._state["client"]:
+            try:
+                self.release_client()
+            except Exception as e:
+                self.logger.debug("Error while releasing client: %s" % e)
+
     @asyncio.coroutine
     def dump(self, steps=None, force=False, job_manager=None, check_only=False, **kwargs):
         '''
@@ -235,10 +449,14 @@ class BaseDumper(object):
         if type(self.steps) == str:
             self.steps = [self.steps]
         strargs = "[steps=%s]" % ",".join(self.steps)
+        self.cancelled = False
         try:
+            # get src_dump info and setup logs off the event loop
+            yield from asyncio.get_event_loop().run_in_executor(_status_executor,self.prepare)
             if "dump" in self.steps:
-                pinfo = self.get_pinfo()
-                pinfo["step"] = "check"
+                self.progress = None
+                # previous dump's release, kept if new one is the same
+                prev_doc = dict(self.src_doc or {})
                 # if last download failed (or was interrupted), we want to force the dump again
                 try:
                     if self.src_doc["download"]["status"] in ["failed","downloading"]:
@@ -247,20 +465,36 @@ class BaseDumper(object):
                 except (AttributeError,KeyError) as e:
                     # no src_doc or no download info
                     pass
-                # TODO: blocking call for now, FTP client can't be properly set in thread after
-                self.create_todump_list(force=force, **kwargs)
+                # what we know about remote files from previous dump (to detect changes)
+                self.remote_files = {f["remote"] : DownloadResult(f) for f in \
+                        self.src_doc.get("download",{}).get("remote_files",[])}
+                self.up_to_date = {}
+                yield from self.check(job_manager,force=force,**kwargs)
                 if self.to_dump:
                     if check_only:
                         self.logger.info("New release available, '%s', %s file(s) to download" % \
                             (self.release,len(self.to_dump)),extra={"notify":True})
                         return self.release
                     # mark the download starts
-                    self.register_status("downloading",transient=True)
+                    yield from self.save_status("downloading",transient=True)
                     # unsync to make it pickable
                     state = self.unprepare()
                     yield from self.do_dump(job_manager=job_manager)
                     # then restore state
                     self.prepare(state)
+                    self.link_up_to_date()
+                    if self.unchanged and self.__class__.STOP_IF_UNCHANGED and not force:
+                        # same content as before, no need to go further: previous (post-processed)
+                        # release stays the current one, new release folder isn't needed
+                        prev_folder = prev_doc.get("data_folder")
+                        if prev_folder and os.path.realpath(prev_folder) != os.path.realpath(self.new_data_folder):
+                            self.logger.info("Removing '%s', same content as '%s'" % (self.new_data_folder,prev_folder))
+                            shutil.rmtree(self.new_data_folder,ignore_errors=True)
+                        yield from self.save_status("success",data_folder=prev_folder or self.new_data_folder,
+                                                    release=prev_doc.get("release",self.release))
+                        self.logger.info("Downloaded data is the same as previous dump, nothing to update",
+                                extra={"notify":True})
+                        return "Nothing to dump"
                 else:
                     # if nothing to dump, don't do post process
                     self.logger.debug("Nothing to dump",extra={"notify":True})
@@ -281,17 +515,17 @@ class BaseDumper(object):
                 if got_error:
                     raise got_error
                 # set it to success at the very end
-                self.register_status("success",pending_to_upload=self.__class__.AUTO_UPLOAD)
+                yield from self.save_status("success",pending_to_upload=self.__class__.AUTO_UPLOAD)
                 self.logger.info("success %s" % strargs,extra={"notify":True})
-        except (KeyboardInterrupt,Exception) as e:
-            self.logger.error("Error while dumping source: %s" % e)
+        except (KeyboardInterrupt,asyncio.CancelledError,Exception) as e:
+            self.logger.error("Error while dumping source: %s" % repr(e))
             import traceback
             self.logger.error(traceback.format_exc())
-            self.register_status("failed",download={"err" : str(e)})
-            self.logger.exception("failed %s: %s" % (strargs,e),extra={"notify":True})
+            yield from self.save_status("failed",download={"err" : repr(e)})
+            self.logger.exception("failed %s: %s" % (strargs,repr(e)),extra={"notify":True})
             raise
         finally:
-            if self.client:
+            if self._state["client"]:
                 self.release_client()
 
     def get_pinfo(self):
@@ -338,26 +572,161 @@ class BaseDumper(object):
     def current_release(self):
         return self.src_doc.get("release")
 
+    def get_host(self, remotefile):
+        """Return host "remotefile" is downloaded from (used to limit connections per host)"""
+        return urlparse.urlparse(remotefile).netloc or self.src_name
+
+    def pooled_download(self, remotefile, localfile, throttle_file=None):
+        """
+        Call download() from a worker process, using an idle client from that
+        process' pool if any, so connections are reused between files.
+        Client is put back in the pool once downloaded (see POOL_IDLE_TIMEOUT).
+        Download rate follows scheduler's allocation in "throttle_file", if any.
+        """
+        self.throttle_file = throttle_file
+        # may be linked to other releases' copies, don't overwrite them
+        detach(localfile)
+        key = (self.__class__.__name__,self.src_name,self.get_host(remotefile))
+        reused = False
+        while not reused:
+            with _client_pool_lock:
+                idle = _client_pool.get(key)
+                if not idle:
+                    break
+                self.client = idle.pop()[0]
+            reused = not self.need_prepare()
+            if not reused:
+                self.discard_client()
+        if not reused:
+            self.client = None
+        try:
+            res = self.download(remotefile,localfile)
+        except (EOFError, OSError) as e:
+            if not reused:
+                raise
+            # pooled connection may have been closed by server, try with a new one
+            self.logger.debug("Pooled client failed (%s), retrying with a new one" % e)
+            self.discard_client()
+            res = self.download(remotefile,localfile)
+        except Exception:
+            self.discard_client()
+            raise
+        self.release_to_pool(key)
+        return self.store_file(remotefile,localfile,res)
+
+    def release_to_pool(self, key):
+        """Put current client in the pool for "key" (see pooled_download()), or close it"""
+        client = self._state["client"]
+        self.client = None
+        timeout = self.__class__.POOL_IDLE_TIMEOUT
+        max_idle = self.__class__.MAX_CONNECTIONS_PER_HOST or \
+                getattr(btconfig,"MAX_CONNECTIONS_PER_HOST",None) or 1
+        with _client_pool_lock:
+            # idle ones to the same host, from any dumper
+            num_idle = sum([len(idle) for k,idle in _client_pool.items() if k[2] == key[2]])
+            pooled = bool(timeout) and num_idle < max_idle
+            if pooled:
+                _client_pool.setdefault(key,[]).append((client,time.time(),timeout))
+        if pooled:
+            start_pool_reaper(interval=min(timeout,5))
+        else:
+            close_client(client)
+
+    def discard_client(self):
+        if self._state["client"]:
+            try:
+                self.release_client()
+            except Exception:
+                pass
+        self.client = None
+
+    def update_progress(self, files, force=False):
+        """Compute download progress from "files" (list of file's status) and store it in src_dump"""
+        now = time.time()
+        if not force and now - self.progress.get("updated",0) < 2:
+            return
+        done = [f for f in files if f["status"] == "done"]
+        size = sum([f["size"] for f in done])
+        self.progress.update({
+            "total" : len(files),
+            "done" : len(done),
+            "failed" : len([f for f in files if f["status"] == "failed"]),
+            "downloading" : len([f for f in files if f["status"] == "downloading"]),
+            "size" : size,
+            "throughput" : size / max(now - self.progress["started"],0.001),
+            "allocated" : get_download_scheduler().get_stats(self.src_name)["allocated"],
+            "files" : files,
+            "updated" : now})
+        # files' status is only saved with dump's status (see register_status())
+        upd = dict([("download.progress.%s" % k,v) for k,v in self.progress.items() if k != "files"])
+        def save():
+            # not using self.src_dump, dumper's state has been unprepared
+            get_src_dump().update_one({"_id" : self.src_name},{"$set" : upd})
+        # same thread as save_status(), so updates are saved in order
+        f = _status_executor.submit(save)
+        f.add_done_callback(lambda f: f.exception() and \
+                logging.warning("Can't save download progress for '%s': %s" % (self.src_name,f.exception())))
+
     @asyncio.coroutine
     def do_dump(self,job_manager=None):
         self.logger.info("%d file(s) to download" % len(self.to_dump))
         jobs = []
         state = self.unprepare()
-        for todo in self.to_dump:
+        # downloads are started when hub-wide scheduler allows it
+        scheduler = get_download_scheduler()
+        max_parallel = self.__class__.MAX_PARALLEL_DUMP or getattr(btconfig,"MAX_PARALLEL_DUMP",None)
+        host_limit = self.__class__.MAX_CONNECTIONS_PER_HOST or getattr(btconfig,"MAX_CONNECTIONS_PER_HOST",None)
+        files = [{"remote" : todo["remote"], "local" : todo["local"], "status" : "pending"} for todo in self.to_dump]
+        self.progress = {"started" : time.time()}
+        self.update_progress(files,force=True)
+        for todo,finfo in zip(self.to_dump,files):
             remote = todo["remote"]
             local = todo["local"]
-            def done(job):
-                self.post_download(remote,local)
+            ticket = yield from scheduler.acquire(self.src_name,self.get_host(remote),
+                    priority=self.__class__.DOWNLOAD_PRIORITY,max_parallel=max_parallel,host_limit=host_limit)
+            def done(job,remote=remote,local=local,finfo=finfo,ticket=ticket):
+                if job.cancelled() or job.exception():
+                    finfo["status"] = "failed"
+                    scheduler.release(ticket)
+                else:
+                    finfo["status"] = "done"
+                    if isinstance(job.result(),DownloadResult):
+                        self.remote_files[remote] = job.result()
+                    finfo["size"] = os.path.exists(local) and os.path.getsize(local) or 0
+                    finfo["time"] = round(time.time() - finfo["started"],2)
+                    scheduler.release(ticket,size=finfo["size"])
+                    self.post_download(remote,local)
+                self.update_progress(files)
             pinfo = self.get_pinfo()
             pinfo["step"] = "dump"
             pinfo["description"] = remote
-            job = yield from job_manager.defer_to_process(pinfo, partial(self.download,remote,local))
+            finfo["status"] = "downloading"
+            finfo["started"] = time.time()
+            try:
+                job = yield from job_manager.defer_to_process(pinfo,
+                        partial(self.pooled_download,remote,local,ticket.alloc_file))
+            except Exception:
+                scheduler.release(ticket)
+                raise
             job.add_done_callback(done)
+            job.add_done_callback(partial(self.record_download,local))
             jobs.append(job)
-        yield from asyncio.gather(*jobs)
+            self.update_progress(files)
+        try:
+            results = yield from asyncio.gather(*jobs)
+        finally:
+            self.update_progress(files,force=True)
+        # unchanged only if all downloads could tell they were
+        self.unchanged = bool(results) and \
+                all([isinstance(r,DownloadResult) and r.get("unchanged") for r in results])
         self.logger.info("%s successfully downloaded" % self.SRC_NAME)
         self.to_dump = []
 
+    def record_download(self,localfile,job):
+        # account downloaded bytes in hub metrics
+        if not job.cancelled() and not job.exception() and os.path.exists(localfile):
+            metrics.record("dump",self.src_name,size=os.path.getsize(localfile))
+
     def prepare_local_folders(self,localfile):
         localdir = os.path.dirname(localfile)
         if not os.path.exists(localdir):
@@ -368,63 +737,72 @@ class BaseDumper(object):
                 pass
 
 
-from ftplib import FTP
+from biothings.utils.ftp import FTPSession
 
 class FTPDumper(BaseDumper):
     FTP_HOST = ''
     CWD_DIR = ''
     FTP_USER = ''
     FTP_PASSWD = ''
+    FTP_TIMEOUT = 60
+    # send NOOP when connection is idle for that long (seconds)
+    FTP_KEEPALIVE = 60
+    # directory listings used to check remote files are kept that long (seconds)
+    FTP_LISTING_TTL = 300
 
     def prepare_client(self):
-        # FTP side
-        self.client = FTP(self.FTP_HOST)
-        self.client.login(self.FTP_USER,self.FTP_PASSWD)
-        if self.CWD_DIR:
-            self.client.cwd(self.CWD_DIR)
+        # FTP side, a session reconnecting when connection is lost
+        self.client = FTPSession(self.FTP_HOST,self.FTP_USER,self.FTP_PASSWD,cwd=self.CWD_DIR,
+                                 timeout=self.FTP_TIMEOUT,keepalive=self.FTP_KEEPALIVE,
+                                 listing_ttl=self.FTP_LISTING_TTL,logger=self.logger)
+        self.client.connect()
 
     def need_prepare(self):
-        return not self.client or (self.client and not self.client.file)
+        return not self.client or self.client.closed
 
     def release_client(self):
         assert self.client
         self.client.close()
         self.client = None
 
+    def get_host(self, remotefile):
+        return self.FTP_HOST
+
     def download(self,remotefile,localfile):
         self.prepare_local_folders(localfile)
         self.logger.debug("Downloading '%s'" % remotefile)
+        tap = self.get_content_tap(localfile)
         with open(localfile,"wb") as out_f:
-            self.client.retrbinary('RETR %s' % remotefile, out_f.write)
+            def write(data):
+                tap.feed(out_f.tell(),data)
+                out_f.write(data)
+            try:
+                self.client.retrbinary('RETR %s' % remotefile, write)
+            except Exception:
+                tap.abort()
+                raise
         # set the mtime to match remote ftp server
-        response = self.client.sendcmd('MDTM ' + remotefile)
-        code, lastmodified = response.split()
-        # an example: 'last-modified': '20121128150000'
-        lastmodified = time.mktime(datetime.strptime(lastmodified, '%Y%m%d%H%M%S').timetuple())
+        lastmodified = self.client.get_mtime(remotefile)
         os.utime(localfile, (lastmodified, lastmodified))
-        return code
+        return self.make_download_result(remotefile,localfile,tap,mtime=lastmodified)
 
     def remote_is_better(self,remotefile,localfile):
         """'remotefile' is relative path from current working dir (CWD_DIR), 
-        'localfile' is absolute path"""
+        'localfile' is absolute path. Remote modification time and size
+        come from (cached) directory listings"""
         res = os.stat(localfile)
         local_lastmodified = int(res.st_mtime)
-        response = self.client.sendcmd('MDTM ' + remotefile)
-        code, remote_lastmodified = response.split()
-        remote_lastmodified = int(time.mktime(datetime.strptime(remote_lastmodified, '%Y%m%d%H%M%S').timetuple()))
-
-        if remote_lastmodified > local_lastmodified:
-            self.logger.debug("Remote file '%s' is newer (remote: %s, local: %s)" %
-                    (remotefile,remote_lastmodified,local_lastmodified))
+        if self.client.is_newer(remotefile,local_lastmodified):
+            self.logger.debug("Remote file '%s' is newer (local: %s)" %
+                    (remotefile,local_lastmodified))
             return True
         local_size = res.st_size
-        self.client.sendcmd("TYPE I")
-        response = self.client.sendcmd('SIZE ' + remotefile)
-        code, remote_size= map(int,response.split())
+        remote_size = self.client.get_size(remotefile)
         if remote_size > local_size:
             self.logger.debug("Remote file '%s' is bigger (remote: %s, local: %s)" % (remotefile,remote_size,local_size))
             return True
         self.logger.debug("'%s' is up-to-date, no need to download" % remotefile)
+        self.up_to_date[remotefile] = localfile
         return False
 
 
@@ -432,6 +810,12 @@ import requests
 
 class HTTPDumper(BaseDumper):
     """Dumper using HTTP protocol and "requests" library"""
+    # max number of concurrent range requests per file
+    DOWNLOAD_SEGMENTS = 4
+    # files are split only if segments are at least that big (bytes)
+    MIN_SEGMENT_SIZE = transfer.MIN_SEGMENT_SIZE
+    # retries per segment when connection is dropped
+    DOWNLOAD_RETRIES = 5
 
     def prepare_client(self):
         self.client = requests.Session()
@@ -444,22 +828,72 @@ class HTTPDumper(BaseDumper):
         self.client = None
 
     def remote_is_better(self,remotefile,localfile):
+        """
+        Compare remote file with the one from previous dump using a conditional
+        request (If-None-Match/If-Modified-Since). If previous dump didn't get
+        any validators, the file is downloaded and content checksums are compared.
+        """
+        prev = self.remote_files.get(remotefile)
+        if not prev:
+            return True
+        if not os.path.exists(localfile):
+            # only in previous release, it can only be reused if it's in the store
+            # (see link_up_to_date()), otherwise new release would miss it
+            store = self.get_store()
+            if not store or not store.has(prev.get(store.algo)):
+                return True
+        headers = {}
+        if prev.get("etag"):
+            headers["If-None-Match"] = prev["etag"]
+        if prev.get("last_modified"):
+            headers["If-Modified-Since"] = prev["last_modified"]
+        if not headers:
+            return True
+        res = self.client.head(remotefile,headers=headers,allow_redirects=True)
+        if res.status_code == 304:
+            self.logger.debug("'%s' not modified, no need to download" % remotefile)
+            self.up_to_date[remotefile] = localfile
+            return False
+        # server may ignore conditional headers, compare validators ourselves
+        info = self.get_validators(res)
+        if info["etag"] and info["etag"] == prev.get("etag") or \
+                not info["etag"] and info["last_modified"] and info["last_modified"] == prev.get("last_modified") \
+                and info["content_length"] == prev.get("content_length"):
+            self.logger.debug("'%s' is up-to-date, no need to download" % remotefile)
+            self.up_to_date[remotefile] = localfile
+            return False
         return True
 
+    def get_validators(self,res):
+        length = res.headers.get("Content-Length")
+        return {"etag" : res.headers.get("ETag"),
+                "last_modified" : res.headers.get("Last-Modified"),
+                "content_length" : length and int(length) or None}
+
     def download(self,remoteurl,localfile,headers={}):
-        """kwargs will be passed to requests.Session.get()"""
+        """
+        Download remoteurl to localfile, with concurrent range requests when the
+        server supports them (see biothings.utils.transfer). An interrupted
+        download is resumed on next call. "headers" are sent with each request.
+        Return a DownloadResult, with checksums computed while downloading, and
+        "unchanged" set to True if content is the same as previous dump's.
+        """
         self.prepare_local_folders(localfile)
         self.logger.debug("Downloading '%s'" % remoteurl)
-        res = self.client.get(remoteurl,stream=True,headers=headers)
-        if not res.status_code == 200:
-            raise DumperException("Error while downloading '%s' (status: %s, reason: %s)" % \
-                    (remoteurl,res.status_code,res.reason))
-        fout = open(localfile, 'wb')
-        for chunk in res.iter_content(chunk_size=512 * 1024):
-            if chunk:
-                fout.write(chunk)
-        fout.close()
-        return res
+        tap = self.get_content_tap(localfile)
+        try:
+            res = transfer.download(self.client,remoteurl,localfile,headers=headers,
+                                     segments=self.__class__.DOWNLOAD_SEGMENTS,
+                                     min_segment_size=self.__class__.MIN_SEGMENT_SIZE,
+                                     max_retries=self.__class__.DOWNLOAD_RETRIES,
+                                     tap=tap,logger=self.logger)
+        except Exception as e:
+            tap.abort()
+            if isinstance(e,transfer.TransferError):
+                raise DumperException(str(e))
+            raise
+        return self.make_download_result(remoteurl,localfile,tap,headers=res.headers,
+                                         status_code=res.status_code,**self.get_validators(res))
 
 class LastModifiedHTTPDumper(HTTPDumper):
     """Given a list of URLs, check Last-Modified header to see 
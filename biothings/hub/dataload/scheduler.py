@@ -0,0 +1,228 @@
+"""
+Hub-wide download scheduler.
+
+All dumpers ask the scheduler before downloading a file, so concurrent dumps
+(dump_all(), scheduled dumps, ...) share the hub's connections and bandwidth
+instead of competing for them:
+- number of downloads running at the same time can be limited hub-wide
+  (config.MAX_DOWNLOADS), per host and per dumper,
+- queued downloads are started by priority, then from the dumper with the
+  fewest running downloads, then from the one which least recently started
+  a download (so dumpers get their turn), then in order,
+- bandwidth budget (config.DOWNLOAD_BANDWIDTH, bytes/s) is split between
+  dumpers currently downloading, weighted by their priority, and equally between
+  a dumper's downloads. Downloads run in worker processes, allocated rates are
+  written to RUN_DIR/bandwidth and read by transfer.Throttle.
+Achieved throughput per dumper is reported by report().
+"""
+import os, time, json, glob
+import logging
+import asyncio
+from collections import OrderedDict
+
+from biothings.utils.common import sizeof_fmt
+
+_scheduler = None
+
+
+def get_download_scheduler():
+    """Return hub's scheduler, created from config on first call"""
+    global _scheduler
+    if _scheduler is None:
+        from biothings import config
+        _scheduler = DownloadScheduler(bandwidth=getattr(config,"DOWNLOAD_BANDWIDTH",None),
+                                       max_downloads=getattr(config,"MAX_DOWNLOADS",None),
+                                       alloc_dir=os.path.join(config.RUN_DIR,"bandwidth"),
+                                       logger=config.logger)
+    return _scheduler
+
+
+class Ticket(object):
+    """A download, queued or running"""
+
+    def __init__(self, tid, dumper, host, priority=0, max_parallel=None):
+        self.id = tid
+        self.dumper = dumper
+        self.host = host
+        self.priority = priority
+        self.max_parallel = max_parallel
+        self.future = asyncio.Future()
+        self.alloc_file = None
+        self.rate = None
+        self.started = None
+
+    def __repr__(self):
+        return "<Ticket #%s %s@%s priority=%s>" % (self.id,self.dumper,self.host,self.priority)
+
+
+class DownloadScheduler(object):
+    """
+    "bandwidth" is the hub's download budget in bytes/s and "max_downloads" the
+    max number of downloads at the same time (None: no limit). Allocated rates
+    are written in "alloc_dir".
+    """
+
+    def __init__(self, bandwidth=None, max_downloads=None, alloc_dir=None, logger=logging):
+        self.bandwidth = bandwidth
+        self.max_downloads = max_downloads
+        self.alloc_dir = alloc_dir
+        self.logger = logger
+        self.host_limits = {}
+        self.waiting = []
+        self.active = OrderedDict()
+        self.stats = {}
+        self.counter = 0
+        self.starts = 0
+        if self.alloc_dir:
+            os.makedirs(self.alloc_dir,exist_ok=True)
+            # left by a previous hub instance
+            for fn in glob.glob(os.path.join(self.alloc_dir,"*.json")):
+                os.unlink(fn)
+
+    def get_stats(self, dumper):
+        return self.stats.setdefault(dumper,{"priority" : 0, "active" : 0, "queued" : 0, "files" : 0,
+                                             "bytes" : 0, "active_time" : 0.0, "since" : None,
+                                             "allocated" : None, "last_start" : 0})
+
+    def set_host_limit(self, host, limit):
+        # first dumper connecting to a host sets its limit
+        if not host in self.host_limits:
+            self.host_limits[host] = limit
+
+    @asyncio.coroutine
+    def acquire(self, dumper, host, priority=0, max_parallel=None, host_limit=None):
+        """
+        Wait until "dumper" can download a file from "host", return a Ticket
+        to be released once downloaded. At most "max_parallel" downloads
+        run for this dumper, and "host_limit" for this host.
+        """
+        self.set_host_limit(host,host_limit)
+        self.counter += 1
+        ticket = Ticket(self.counter,dumper,host,priority,max_parallel)
+        stats = self.get_stats(dumper)
+        stats["priority"] = priority
+        stats["queued"] += 1
+        self.waiting.append(ticket)
+        self.dispatch()
+        try:
+            yield from ticket.future
+        except asyncio.CancelledError:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                stats["queued"] -= 1
+                self.dispatch()
+            else:
+                self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket, size=0):
+        """Download is over, "size" bytes were downloaded"""
+        if self.active.pop(ticket.id,None) is None:
+            return
+        stats = self.get_stats(ticket.dumper)
+        stats["active"] -= 1
+        stats["files"] += 1
+        stats["bytes"] += size
+        if not stats["active"]:
+            stats["active_time"] += time.time() - stats["since"]
+            stats["since"] = None
+        if ticket.alloc_file:
+            try:
+                os.unlink(ticket.alloc_file)
+            except FileNotFoundError:
+                pass
+        self.dispatch()
+
+    def running(self, dumper=None, host=None):
+        return len([t for t in self.active.values() if (dumper is None or t.dumper == dumper) \
+                and (host is None or t.host == host)])
+
+    def can_start(self, ticket):
+        if self.max_downloads and len(self.active) >= self.max_downloads:
+            return False
+        limit = self.host_limits.get(ticket.host)
+        if limit and self.running(host=ticket.host) >= limit:
+            return False
+        if ticket.max_parallel and self.running(dumper=ticket.dumper) >= ticket.max_parallel:
+            return False
+        return True
+
+    def dispatch(self):
+        """Start queued downloads, as long as limits allow it"""
+        while True:
+            candidates = [t for t in self.waiting if self.can_start(t)]
+            if not candidates:
+                break
+            # higher priority first, then fair share between dumpers, then FIFO
+            ticket = min(candidates,key=lambda t: (-t.priority,self.running(dumper=t.dumper),
+                                                   self.get_stats(t.dumper)["last_start"],t.id))
+            self.waiting.remove(ticket)
+            stats = self.get_stats(ticket.dumper)
+            self.starts += 1
+            stats["last_start"] = self.starts
+            stats["queued"] -= 1
+            stats["active"] += 1
+            if stats["since"] is None:
+                stats["since"] = time.time()
+            ticket.started = time.time()
+            if self.bandwidth and self.alloc_dir:
+                ticket.alloc_file = os.path.join(self.alloc_dir,"%s.json" % ticket.id)
+            self.active[ticket.id] = ticket
+            ticket.future.set_result(ticket)
+        self.allocate()
+
+    def allocate(self):
+        """Split bandwidth between dumpers' running downloads, write rates for downloading processes"""
+        by_dumper = OrderedDict()
+        for ticket in self.active.values():
+            by_dumper.setdefault(ticket.dumper,[]).append(ticket)
+        weights = dict([(d,max(max([t.priority for t in tickets]),0) + 1) for d,tickets in by_dumper.items()])
+        total = sum(weights.values())
+        for dumper,stats in self.stats.items():
+            stats["allocated"] = None
+        for dumper,tickets in by_dumper.items():
+            share = self.bandwidth and self.bandwidth * weights[dumper] / total or None
+            self.get_stats(dumper)["allocated"] = share
+            for ticket in tickets:
+                rate = share and int(share / len(tickets)) or None
+                if ticket.alloc_file and rate != ticket.rate:
+                    self.write_allocation(ticket,rate)
+                ticket.rate = rate
+
+    def write_allocation(self, ticket, rate):
+        tmpfn = ticket.alloc_file + ".tmp"
+        try:
+            json.dump({"rate" : rate, "dumper" : ticket.dumper},open(tmpfn,"w"))
+            # atomic, never read partially written
+            os.rename(tmpfn,ticket.alloc_file)
+        except Exception as e:
+            self.logger.warning("Can't write bandwidth allocation '%s': %s" % (ticket.alloc_file,e))
+
+    def get_throughputs(self):
+        """Return, per dumper, downloads and achieved throughput (bytes/s while downloading)"""
+        now = time.time()
+        res = OrderedDict()
+        for dumper,stats in sorted(self.stats.items()):
+            active_time = stats["active_time"] + (stats["since"] and now - stats["since"] or 0)
+            res[dumper] = {"priority" : stats["priority"], "active" : stats["active"],
+                           "queued" : stats["queued"], "files" : stats["files"], "bytes" : stats["bytes"],
+                           "allocated" : stats["allocated"],
+                           "throughput" : active_time and stats["bytes"] / active_time or 0.0}
+        return res
+
+    def get_metrics(self):
+        """Gauges, see MetricsCollector.register_gauges()"""
+        return {"downloads_active" : len(self.active), "downloads_queued" : len(self.waiting)}
+
+    def report(self):
+        line = "{:<25}|{:>8}|{:>7}|{:>7}|{:>7}|{:>12}|{:>12}|{:>12}"
+        print("Bandwidth: %s, downloads: %d running, %d queued" % \
+                (self.bandwidth and "%s/s" % sizeof_fmt(self.bandwidth) or "no limit",
+                 len(self.active),len(self.waiting)))
+        print(line.format("DUMPER","PRIORITY","ACTIVE","QUEUED","FILES","BYTES","ALLOCATED","BYTES/S"))
+        for dumper,vals in self.get_throughputs().items():
+            print(line.format(str(dumper)[:25],vals["priority"],vals["active"],vals["queued"],vals["files"],
+                              sizeof_fmt(vals["bytes"]),
+                              vals["allocated"] and "%s/s" % sizeof_fmt(vals["allocated"]) or "-",
+                              "%s/s" % sizeof_fmt(vals["throughput"])))
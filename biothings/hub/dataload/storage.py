@@ -1,22 +1,61 @@
-import types, copy, datetime, time
-import logging
+import types, copy, datetime, time, os, shutil, tempfile, pickle, heapq
+import logging, queue, threading
+from collections import OrderedDict
 
 import asyncio
-from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo.errors import DuplicateKeyError, BulkWriteError, AutoReconnect
+from pymongo import ReplaceOne
 
 from biothings.utils.common import timesofar, iter_n
 from biothings.utils.mongo import get_src_db
+from biothings.utils.dataload import merge_struct
+from biothings.utils.inspect import inspect, merge_inspect
+from biothings.utils import metrics
 
 
 class StorageException(Exception):
     pass
 
+
+def sort_key(_id):
+    # _ids of different types can't be compared
+    return (type(_id).__name__,_id)
+
 class BaseStorage(object):
 
+    # number of threads storing batches while next ones are parsed. If 0,
+    # batches are parsed then stored one after the other, from caller's thread.
+    # With one writer, batches are stored in order
+    writers = 1
+    # max number of parsed batches waiting to be stored, parsing
+    # blocks when reached
+    max_pending_batches = 2
+    # batches failing with these (transient) errors are stored again, up to
+    # max_retries times, waiting retry_delay seconds (doubled each time)
+    transient_errors = (AutoReconnect,)
+    max_retries = 3
+    retry_delay = 1.0
+    # True if on_stored is called as documents are stored (see store_batches())
+    supports_checkpoints = False
+    # if "type" or "mapping", stored batches are inspected (see
+    # biothings.utils.inspect), results being accumulated in "inspected"
+    inspect_mode = None
+
     def __init__(self,db,dest_col_name,logger=logging):
         db = db or get_src_db()
         self.temp_collection = db[dest_col_name]
         self.logger = logger
+        # source name, when set, stored documents are accounted in hub metrics
+        self.source = None
+        # when set, called with the number of documents, from the start, all stored
+        self.on_stored = None
+        # True when storing into a collection partially filled by a previous,
+        # failed attempt: already stored documents must be expected
+        self.resumed = False
+        # inspect results (see inspect_mode), None if inspection failed
+        self.inspected = {}
+        # stored documents, batches, retries and time spent (see store_batches())
+        self.stats = {}
 
     def process(self,iterable,*args,**kwargs):
         """
@@ -25,8 +64,161 @@ class BaseStorage(object):
         """
         raise NotImplementedError("implement-me in subclass")
 
+    def record_metrics(self, docs=0, timings=None):
+        if self.source:
+            metrics.record("upload",self.source,docs=docs,timings=timings)
+
+    def inspect_batch(self, doc_li):
+        """
+        Return inspect results for documents "doc_li", None if not inspected.
+        Can run concurrently, results are then merged with merge_inspected()
+        """
+        if not self.inspect_mode or self.inspected is None:
+            return None
+        mapt = {}
+        try:
+            for doc in doc_li:
+                inspect(doc,mapt=mapt,mode=self.inspect_mode)
+        except TypeError as e:
+            self.logger.warning("Can't inspect documents, inspection disabled: %s" % e)
+            self.inspected = None
+            return None
+        return mapt
+
+    def merge_inspected(self, mapt):
+        # inspection can be disabled concurrently
+        inspected = self.inspected
+        if mapt and inspected is not None:
+            merge_inspect(inspected,mapt)
+
+    def store_batches(self, batches, store_func):
+        """
+        Call store_func(batch,retry) for each batch from "batches" iterator and
+        return the sum of returned values (number of stored documents). If a
+        batch fails with a transient error, it's stored again with retry=True
+        (some of its documents may have been stored by the failed attempt).
+        Batches are stored by writer threads while next ones are parsed (see
+        "writers" and "max_pending_batches"). Storing errors stop parsing and
+        are raised, parsing errors are raised once already parsed batches are
+        stored. Time spent parsing, storing and waiting for writers (parsing
+        is faster than storing) is logged and recorded in hub metrics.
+        If set, on_stored() is called each time the number of stored
+        documents, from the first one with no gap, grows. Stored batches are
+        inspected before, if inspect_mode is set (each writer inspects its
+        batch, results are merged into "inspected").
+        """
+        t0 = time.time()
+        timings = {"parse" : 0.0, "write" : 0.0, "wait" : 0.0}
+        retries = [0]
+        results = []
+        errors = []
+        lock = threading.Lock()
+        batches = enumerate(batches)
+        # batch number => size, for batches stored after one still being stored
+        done = {}
+        progress = {"next" : 0, "stored" : 0}
+
+        def next_batch():
+            t0 = time.time()
+            try:
+                return next(batches)
+            except StopIteration:
+                return None
+            finally:
+                timings["parse"] += time.time() - t0
+
+        def store(batch):
+            t0 = time.time()
+            num, doc_li = batch
+            delay = self.retry_delay
+            for attempt in range(self.max_retries + 1):
+                try:
+                    res = store_func(doc_li,retry=attempt > 0)
+                    break
+                except self.transient_errors as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.logger.warning("Error while storing batch #%d, retrying in %.1fs: %s" % (num,delay,e))
+                    with lock:
+                        retries[0] += 1
+                    time.sleep(delay)
+                    delay *= 2
+            elapsed = time.time() - t0
+            mapt = self.inspect_batch(doc_li)
+            with lock:
+                timings["write"] += elapsed
+                self.merge_inspected(mapt)
+                results.append(res)
+                done[num] = len(doc_li)
+                stored = progress["stored"]
+                while progress["next"] in done:
+                    progress["stored"] += done.pop(progress["next"])
+                    progress["next"] += 1
+                if self.on_stored and progress["stored"] > stored:
+                    self.on_stored(progress["stored"])
+
+        if not self.writers:
+            while True:
+                batch = next_batch()
+                if batch is None:
+                    break
+                store(batch)
+        else:
+            pending = queue.Queue(maxsize=self.max_pending_batches)
+
+            def writer():
+                while True:
+                    batch = pending.get()
+                    if batch is None:
+                        break
+                    if errors:
+                        # keep consuming so parsing never blocks
+                        continue
+                    try:
+                        store(batch)
+                    except Exception as e:
+                        self.logger.exception("Error while storing batch: %s" % e)
+                        errors.append(e)
+
+            threads = [threading.Thread(target=writer,name="storage_writer_%d" % i,daemon=True) \
+                       for i in range(self.writers)]
+            for thread in threads:
+                thread.start()
+            try:
+                while not errors:
+                    batch = next_batch()
+                    if batch is None:
+                        break
+                    tw = time.time()
+                    pending.put(batch)
+                    timings["wait"] += time.time() - tw
+            finally:
+                # on parsing error, already parsed batches are still stored
+                for _ in threads:
+                    pending.put(None)
+                for thread in threads:
+                    thread.join()
+            if errors:
+                raise errors[0]
+        total = sum(results)
+        elapsed = time.time() - t0
+        self.stats = {"docs" : total, "batches" : len(results), "retries" : retries[0],
+                      "elapsed_s" : elapsed, "docs_per_s" : total / max(elapsed,0.001),
+                      "parse_s" : timings["parse"], "write_s" : timings["write"], "wait_s" : timings["wait"]}
+        self.logger.info("Stored %d documents in %d batches (%d retries, %d writers, %.0f docs/s). " % \
+                (total,len(results),retries[0],self.writers,self.stats["docs_per_s"]) + \
+                "Parse: %.1fs, write: %.1fs, waiting for writers: %.1fs" % \
+                (timings["parse"],timings["write"],timings["wait"]))
+        self.record_metrics(timings=timings)
+        return total
+
 class BasicStorage(BaseStorage):
 
+    supports_checkpoints = True
+    # batches are inserted unordered, _ids being unique they can be
+    # stored concurrently (each writer using its own connection from the pool)
+    writers = 4
+
     def doc_iterator(self, doc_d, batch=True, batch_size=10000):
         if isinstance(doc_d, types.GeneratorType) and batch:
             for doc_li in iter_n(doc_d, n=batch_size):
@@ -57,99 +249,178 @@ class BasicStorage(BaseStorage):
     def process(self, doc_d, batch_size):
         self.logger.info("Uploading to the DB...")
         t0 = time.time()
-        total = 0
-        for doc_li in self.doc_iterator(doc_d, batch=True, batch_size=batch_size):
-            self.temp_collection.insert(doc_li, manipulate=False, check_keys=False)
-            total += len(doc_li)
+
+        def store(doc_li, retry=False):
+            try:
+                self.temp_collection.insert_many(doc_li, ordered=False)
+            except BulkWriteError as e:
+                # when resuming or retrying, some may have been stored before
+                if not (self.resumed or retry) or \
+                        [err for err in e.details["writeErrors"] if err["code"] != 11000]:
+                    raise
+            self.record_metrics(len(doc_li))
+            return len(doc_li)
+
+        total = self.store_batches(self.doc_iterator(doc_d, batch=True, batch_size=batch_size),store)
         self.logger.info('Done[%s]' % timesofar(t0))
 
         return total
 
 class MergerStorage(BasicStorage):
     """
-    This storage will try to merge documents when finding duplicated errors.
-    It's useful when data is parsed using iterator. A record can be stored in database,
-    then later, another record with the same ID is sent to the db, raising a duplicated error.
-    These two documents would have been merged before using a 'put all in memory' parser. 
-    Since data is here read line by line, the merge is done while storing
+    This storage will merge documents sharing the same _id.
+    It's useful when data is parsed using iterator. A record can be parsed
+    and later, another record with the same ID is parsed. These two documents
+    would have been merged before using a 'put all in memory' parser.
+    Documents are merged in memory (up to "max_docs_in_memory" distinct ones,
+    or "max_memory" bytes, estimated from the pickled size of a document per
+    batch) so each _id is written once. For bigger inputs, sorted runs are
+    written to disk (in "spill_dir", default to system's temp folder) and
+    merged once everything is parsed. Documents already in the collection
+    (eg. stored by another process) are merged with the new ones while storing.
+    These limits can be set per source with the uploader's storage_options.
     """
+    max_docs_in_memory = 200000
+    max_memory = 256 * 1024 * 1024
+    spill_dir = None
+    # documents are stored once all are parsed
+    supports_checkpoints = False
+
+    def __init__(self,*args,**kwargs):
+        super(MergerStorage,self).__init__(*args,**kwargs)
+        self.aslistofdict = None
+
+    def merge_doc(self, existing, doc):
+        """Merge "doc" into previously found "existing" doc with the same _id"""
+        return merge_struct(doc,existing,aslistofdict=self.aslistofdict)
+
+    def add_doc(self, docs, doc):
+        aslistofdict = doc.pop("__aslistofdict__",None)
+        if aslistofdict:
+            self.aslistofdict = aslistofdict
+        _id = doc["_id"]
+        if _id in docs:
+            docs[_id] = self.merge_doc(docs[_id],doc)
+        else:
+            docs[_id] = doc
+
+    def write_run(self, docs, spill_dir):
+        """Write "docs" (_id => doc), sorted by _id, to a new run file in "spill_dir", return its path"""
+        fd, path = tempfile.mkstemp(prefix="run_",suffix=".pickle",dir=spill_dir)
+        with os.fdopen(fd,"wb") as fout:
+            for key in sorted(docs,key=sort_key):
+                pickle.dump(docs[key],fout,protocol=pickle.HIGHEST_PROTOCOL)
+        self.logger.info("Wrote run of %d documents to '%s'" % (len(docs),path))
+        return path
+
+    def read_run(self, num, path):
+        with open(path,"rb") as fin:
+            while True:
+                try:
+                    doc = pickle.load(fin)
+                except EOFError:
+                    break
+                # run number keeps input order between runs for the same _id
+                yield (sort_key(doc["_id"]),num,doc)
+
+    def merge_runs(self, runs):
+        """Iterate over documents from sorted "runs", merging the ones with the same _id"""
+        current = None
+        for key,_,doc in heapq.merge(*[self.read_run(num,path) for num,path in enumerate(runs)]):
+            if current is not None and key == current_key:
+                current = self.merge_doc(current,doc)
+            else:
+                if current is not None:
+                    yield current
+                current, current_key = doc, key
+        if current is not None:
+            yield current
+
+    def store_merged(self, doc_li, retry=False):
+        tinner = time.time()
+        nbinsert = 0
+        try:
+            res = self.temp_collection.insert_many(doc_li,ordered=False)
+            nbinsert += len(res.inserted_ids)
+        except BulkWriteError as e:
+            nbinsert += e.details["nInserted"]
+            dups = [err["op"] for err in e.details["writeErrors"] if err["code"] == 11000]
+            if len(dups) != len(e.details["writeErrors"]):
+                raise
+            self.logger.info("Merging %d records with existing ones" % len(dups))
+            existing = dict([(d["_id"],d) for d in \
+                    self.temp_collection.find({"_id" : {"$in" : [d["_id"] for d in dups]}})])
+            self.temp_collection.bulk_write([ReplaceOne({"_id" : d["_id"]},self.merge_doc(existing[d["_id"]],d)) \
+                    for d in dups],ordered=False)
+            nbinsert += len(dups)
+        self.record_metrics(nbinsert)
+        self.logger.info("Inserted %s records [%s]" % (nbinsert,timesofar(tinner)))
+        return nbinsert
 
     def process(self, doc_d, batch_size):
         self.logger.info("Uploading to the DB...")
         t0 = time.time()
-        tinner = time.time()
-        aslistofdict = None
-        total = 0
-        for doc_li in self.doc_iterator(doc_d, batch=True, batch_size=batch_size):
-            toinsert = len(doc_li)
-            nbinsert = 0
-            self.logger.info("Inserting %s records ... " % toinsert)
-            try:
-                bob = self.temp_collection.initialize_unordered_bulk_op()
-                for d in doc_li:
-                    aslistofdict = d.pop("__aslistofdict__",None)
-                    bob.insert(d)
-                res = bob.execute()
-                nbinsert += res["nInserted"]
-                self.logger.info("OK [%s]" % timesofar(tinner))
-            except BulkWriteError as e:
-                inserted = e.details["nInserted"]
-                nbinsert += inserted
-                self.logger.info("Fixing %d records " % len(e.details["writeErrors"]))
-                ids = [d["op"]["_id"] for d in e.details["writeErrors"]]
-                # build hash of existing docs
-                docs = self.temp_collection.find({"_id" : {"$in" : ids}})
-                hdocs = {}
-                for doc in docs:
-                    hdocs[doc["_id"]] = doc
-                bob2 = self.temp_collection.initialize_unordered_bulk_op()
-                for err in e.details["writeErrors"]:
-                    errdoc = err["op"]
-                    existing = hdocs[errdoc["_id"]]
-                    assert "_id" in existing
-                    _id = errdoc.pop("_id")
-                    merged = merge_struct(errdoc, existing,aslistofdict=aslistofdict)
-                    bob2.find({"_id" : _id}).update_one({"$set" : merged})
-                    # update previously fetched doc. if several errors are about the same doc id,
-                    # we would't merged things properly without an updated document
-                    assert "_id" in merged
-                    hdocs[_id] = merged
-                    nbinsert += 1
-
-                res = bob2.execute()
-                self.logger.info("OK [%s]" % timesofar(tinner))
-            assert nbinsert == toinsert, "nb %s to %s" % (nbinsert,toinsert)
-            # end of loop so it counts the time spent in doc_iterator
-            tinner = time.time()
-            total += nbinsert
-
+        docs = OrderedDict()
+        runs = []
+        spill_dir = None
+        # sampled documents, total pickled size
+        sampled = [0,0]
+        try:
+            for doc_li in self.doc_iterator(doc_d, batch=True, batch_size=batch_size):
+                if doc_li:
+                    sampled[0] += 1
+                    sampled[1] += len(pickle.dumps(doc_li[0],protocol=pickle.HIGHEST_PROTOCOL))
+                for doc in doc_li:
+                    self.add_doc(docs,doc)
+                if len(docs) >= self.max_docs_in_memory or \
+                        sampled[0] and len(docs) * sampled[1] / sampled[0] >= self.max_memory:
+                    spill_dir = spill_dir or tempfile.mkdtemp(prefix="merger_",dir=self.spill_dir)
+                    runs.append(self.write_run(docs,spill_dir))
+                    docs = OrderedDict()
+            if runs:
+                if docs:
+                    runs.append(self.write_run(docs,spill_dir))
+                    docs = None
+                self.logger.info("Merging %d runs" % len(runs))
+                merged = self.merge_runs(runs)
+            else:
+                self.logger.info("Merged %d documents in memory" % len(docs))
+                merged = iter(docs.values())
+            total = self.store_batches(iter_n(merged,batch_size),self.store_merged)
+        finally:
+            if spill_dir:
+                shutil.rmtree(spill_dir,ignore_errors=True)
         self.logger.info('Done[%s]' % timesofar(t0))
-        self.switch_collection()
-        self.post_update_data()
 
         return total
 
 
 class IgnoreDuplicatedStorage(BasicStorage):
 
+    # first document found for an _id is kept: batches are stored one after
+    # the other so it doesn't depend on writers (can be changed if it doesn't matter)
+    writers = 1
+
     def process(self, iterable, batch_size):
         self.logger.info("Uploading to the DB...")
         t0 = time.time()
-        tinner = time.time()
-        total = 0
-        for doc_li in self.doc_iterator(iterable, batch=True, batch_size=batch_size):
+
+        def store(doc_li, retry=False):
+            tinner = time.time()
             try:
                 bob = self.temp_collection.initialize_unordered_bulk_op()
                 for d in doc_li:
                     bob.insert(d)
                 res = bob.execute()
-                total += res['nInserted']
+                self.record_metrics(res['nInserted'])
                 self.logger.info("Inserted %s records [%s]" % (res['nInserted'], timesofar(tinner)))
+                return res['nInserted']
             except BulkWriteError as e:
+                self.record_metrics(e.details['nInserted'])
                 self.logger.info("Inserted %s records, ignoring %d [%s]" % (e.details['nInserted'],len(e.details["writeErrors"]),timesofar(tinner)))
-            except Exception as e:
-                raise
-            tinner = time.time()
+                return e.details['nInserted']
+
+        total = self.store_batches(self.doc_iterator(iterable, batch=True, batch_size=batch_size),store)
         self.logger.info('Done[%s]' % timesofar(t0))
 
         return total 
@@ -159,6 +430,7 @@ class NoBatchIgnoreDuplicatedStorage(BasicStorage):
     You should use IgnoreDuplicatedStorag, which works using batch
     and is thus way faster...
     """
+    supports_checkpoints = False
 
     def process(self, doc_d, batch_size):
         self.logger.info("Uploading to the DB...")
@@ -175,6 +447,7 @@ class NoBatchIgnoreDuplicatedStorage(BasicStorage):
                 total += 1
                 if (cnt + dups) % batch_size == 0:
                     # we insert one by one but display progress on a "batch_size" base
+                    self.record_metrics(cnt)
                     self.logger.info("Inserted %s records, ignoring %s [%s]" % (cnt,dups,timesofar(tinner)))
                     cnt = 0
                     dups = 0
@@ -192,23 +465,25 @@ class NoBatchIgnoreDuplicatedStorage(BasicStorage):
 class UpsertStorage(BasicStorage):
     """Insert or update documents, based on _id"""
 
+    # last document found for an _id is kept (see IgnoreDuplicatedStorage)
+    writers = 1
+
     def process(self, iterable, batch_size):
         self.logger.info("Uploading to the DB...")
         t0 = time.time()
-        tinner = time.time()
-        total = 0
-        for doc_li in self.doc_iterator(iterable, batch=True, batch_size=batch_size):
-            try:
-                bob = self.temp_collection.initialize_unordered_bulk_op()
-                for d in doc_li:
-                    bob.find({"_id" : d["_id"]}).upsert().replace_one(d)
-                res = bob.execute()
-                nb = res["nUpserted"] + res["nModified"]
-                total += nb
-                self.logger.info("Upserted %s records [%s]" % (nb,timesofar(tinner)))
-            except Exception as e:
-                raise
+
+        def store(doc_li, retry=False):
             tinner = time.time()
+            bob = self.temp_collection.initialize_unordered_bulk_op()
+            for d in doc_li:
+                bob.find({"_id" : d["_id"]}).upsert().replace_one(d)
+            res = bob.execute()
+            nb = res["nUpserted"] + res["nModified"]
+            self.record_metrics(nb)
+            self.logger.info("Upserted %s records [%s]" % (nb,timesofar(tinner)))
+            return nb
+
+        total = self.store_batches(self.doc_iterator(iterable, batch=True, batch_size=batch_size),store)
         self.logger.info('Done[%s]' % timesofar(t0))
 
         return total
@@ -1,6 +1,7 @@
-import time, sys, os, copy
-import datetime, pprint
+import time, sys, os, copy, shutil, pickle, json, glob, fnmatch, types
+import datetime, pprint, inspect, hashlib
 import asyncio
+from collections import deque
 import logging as loggingmod
 from functools import wraps, partial
 
@@ -8,6 +9,10 @@ from biothings.utils.common import get_timestamp, get_random_string, timesofar,
 from biothings.utils.hub_db import get_src_dump, get_src_master
 from biothings.utils.mongo import get_src_conn
 from biothings.utils.dataload import merge_struct
+from biothings.utils.filerange import split_file, RANGE_SIZE
+from biothings.utils.doccache import write_through, read_docs
+from biothings.utils.contentstore import hash_file
+from biothings.utils.inspect import merge_inspect, merge_scalar_list, stringify_inspect_doc
 from biothings.utils.manager import BaseSourceManager, \
                                     ManagerError, ResourceNotFound
 from .storage import IgnoreDuplicatedStorage, MergerStorage, \
@@ -24,28 +29,252 @@ class ResourceError(Exception):
     pass
 
 
+class Checkpoint(object):
+    """
+    Can be yielded by load_data() generators, between documents. "state"
+    (json serializable, eg. an offset in the input file) is then passed back,
+    as load_data(..., checkpoint=state), when an upload is resumed: load_data()
+    must continue with documents found after that checkpoint. Without
+    checkpoints, already stored documents are parsed again, and skipped.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+
+def get_checkpoint_file(col_name, batch_num):
+    return os.path.join(config.RUN_DIR,"checkpoints","%s_%s.json" % (col_name,batch_num))
+
+
+def get_inspect_file(col_name, batch_num):
+    return os.path.join(config.RUN_DIR,"inspect","%s_%s.pickle" % (col_name,batch_num))
+
+
+def get_spill_dir(col_name):
+    return os.path.join(config.RUN_DIR,"ranges",col_name)
+
+
+def save_inspected(inspected, path):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp,"wb") as fout:
+        pickle.dump(inspected,fout,protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp,path)
+
+
+def strip_checkpoints(data):
+    if not isinstance(data,types.GeneratorType):
+        return data
+    return (doc for doc in data if not isinstance(doc,Checkpoint))
+
+
+def cached_load(loaddata_func, cache_file, *args, checkpoint=None):
+    """
+    Return documents from "cache_file" if it exists. Otherwise call
+    loaddata_func(*args) and write the cache while documents are consumed.
+    """
+    if os.path.exists(cache_file):
+        return read_docs(cache_file,marker_class=Checkpoint,from_marker=checkpoint)
+    if checkpoint is not None:
+        # partial content, not cached
+        return loaddata_func(*args,checkpoint=checkpoint)
+    data = loaddata_func(*args)
+    if not isinstance(data,types.GeneratorType):
+        return data
+    return write_through(data,cache_file)
+
+
+class CheckpointTracker(object):
+    """
+    Keep track, in file "path", of the number of documents (from the first
+    one) stored by an upload job, along with last Checkpoint state found
+    before them, so the job can be resumed
+    """
+
+    # progress is written at most every write_interval seconds (see flush())
+    write_interval = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.last_write = 0
+        self.records = None
+        self.last = {}
+        if os.path.exists(path):
+            with open(path) as fin:
+                self.last = json.load(fin)
+        self.start_records = self.last.get("records",0)
+        self.state = self.last.get("state")
+        self.state_records = self.last.get("state_records",0)
+        # (records,state) from checkpoints not stored yet
+        self.marks = deque()
+
+    @property
+    def resumed(self):
+        """True if the job already ran before"""
+        return bool(self.last)
+
+    def load(self, loaddata_func, *args):
+        """Call loaddata_func(*args) and return documents which aren't stored yet"""
+        if self.state is not None:
+            data = loaddata_func(*args,checkpoint=self.state)
+            parsed = self.state_records
+        else:
+            data = loaddata_func(*args)
+            parsed = 0
+        self.write(self.start_records)
+        if not isinstance(data,types.GeneratorType):
+            # can't skip anything
+            self.start_records = 0
+            return data
+        return self.iterate(data,parsed)
+
+    def iterate(self, data, parsed):
+        for doc in data:
+            if isinstance(doc,Checkpoint):
+                self.marks.append((parsed,doc.state))
+                continue
+            parsed += 1
+            if parsed <= self.start_records:
+                continue
+            yield doc
+
+    def stored(self, count, before_write=None):
+        """
+        Called by storage, "count" documents are stored since (re)start.
+        If progress is written, before_write() is called first.
+        """
+        self.records = self.start_records + count
+        while self.marks and self.marks[0][0] <= self.records:
+            self.state_records, self.state = self.marks.popleft()
+        if time.time() - self.last_write >= self.write_interval:
+            self.flush(before_write)
+
+    def flush(self, before_write=None):
+        """Write progress not written yet"""
+        if self.records is None:
+            return
+        if before_write:
+            before_write()
+        self.write(self.records)
+        self.records = None
+
+    def write(self, records):
+        os.makedirs(os.path.dirname(self.path),exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp,"w") as fout:
+            json.dump({"records" : records, "state" : self.state,
+                       "state_records" : self.state_records},fout)
+        os.rename(tmp,self.path)
+        self.last_write = time.time()
+
+
 def upload_worker(name, storage_class, loaddata_func, col_name,
-                  batch_size, batch_num, *args):
+                  batch_size, batch_num, *args, checkpoint_file=None, cache_file=None,
+                  inspect_mode=None, inspect_file=None, storage_options=None, stats_key=None):
     """
     Pickable job launcher, typically running from multiprocessing.
     storage_class will instanciate with col_name, the destination 
     collection name. loaddata_func is the parsing/loading function,
-    called with *args
+    called with *args. If checkpoint_file is set, progress is recorded
+    there and a job which already ran continues where it stopped.
+    If cache_file is set, parsed documents are read from/written to it.
+    If inspect_file is set, stored documents are inspected (inspect_mode)
+    and results are saved there (pickled).
+    storage_options (dict) overrides storage's attributes (eg. "writers",
+    see BaseStorage). If stats_key, a (src_dump _id, key) tuple, is set,
+    storage stats are added to this src_dump document.
     """
+    tracker = None
+    save_inspect = None
     try:
-        data = loaddata_func(*args)
+        if cache_file:
+            loaddata_func = partial(cached_load,loaddata_func,cache_file)
         storage = storage_class(None,col_name,loggingmod)
-        return storage.process(data,batch_size)
+        storage.source = name
+        for k,v in (storage_options or {}).items():
+            if not hasattr(storage,k):
+                raise AttributeError("Storage %s has no option '%s'" % (storage_class.__name__,k))
+            setattr(storage,k,v)
+        if inspect_file:
+            storage.inspect_mode = inspect_mode
+        if checkpoint_file:
+            tracker = CheckpointTracker(checkpoint_file)
+            storage.resumed = tracker.resumed
+            if inspect_file and tracker.resumed and os.path.exists(inspect_file):
+                # documents stored before resuming were inspected then
+                with open(inspect_file,"rb") as fin:
+                    storage.inspected = pickle.load(fin)
+            if storage.supports_checkpoints:
+                data = tracker.load(loaddata_func,*args)
+                if inspect_file:
+                    # saved with progress: inspected documents are a superset of stored ones
+                    save_inspect = lambda: save_inspected(storage.inspected,inspect_file)
+                storage.on_stored = partial(tracker.stored,before_write=save_inspect)
+            else:
+                tracker.write(0)
+                data = loaddata_func(*args)
+        else:
+            data = loaddata_func(*args)
+        try:
+            cnt = storage.process(strip_checkpoints(data),batch_size)
+        finally:
+            if tracker:
+                # stored documents are kept on failure
+                tracker.flush(save_inspect)
+        if inspect_file:
+            save_inspected(getattr(storage,"inspected",None),inspect_file)
+        stats = getattr(storage,"stats",None)
+        if stats_key and stats:
+            # $inc so jobs running in parallel add up
+            src_id, key = stats_key
+            get_src_dump().update_one({"_id" : src_id},
+                    {"$inc" : dict([("%s.%s" % (key,k),v) for k,v in stats.items()])})
+        return cnt
     except Exception as e:
         logger_name = "%s_batch_%s" % (name,batch_num)
         logger = get_logger(logger_name, config.LOG_FOLDER)
         logger.exception(e)
         logger.error("Parameters:\nname=%s\nstorage_class=%s\n" % (name,storage_class) + \
                 "loaddata_func=%s\ncol_name=%s\nbatch_size=%s\n" % (loaddata_func,col_name,batch_size,) + \
-                "args=%s" % args)
+                "args=%s" % (args,))
         raise
 
 
+def range_parse_worker(name, loaddata_func, spill_file, batch_size, batch_num, *args, cache_file=None):
+    """
+    Pickable job launcher parsing data (like upload_worker) but storing
+    documents, by batch, in "spill_file" instead of the database. Return the
+    number of parsed documents.
+    """
+    try:
+        if cache_file:
+            loaddata_func = partial(cached_load,loaddata_func,cache_file)
+        total = 0
+        with open(spill_file,"wb") as fout:
+            for doc_li in iter_n(strip_checkpoints(loaddata_func(*args)),batch_size):
+                pickle.dump(doc_li,fout,protocol=pickle.HIGHEST_PROTOCOL)
+                total += len(doc_li)
+        return total
+    except Exception as e:
+        logger = get_logger("%s_batch_%s" % (name,batch_num), config.LOG_FOLDER)
+        logger.exception(e)
+        logger.error("Parameters:\nname=%s\nloaddata_func=%s\nspill_file=%s\nargs=%s" % \
+                (name,loaddata_func,spill_file,args))
+        raise
+
+
+def load_spilled(spill_files):
+    """Iterate over documents stored by range_parse_worker(), in files' order"""
+    for spill_file in spill_files:
+        with open(spill_file,"rb") as fin:
+            while True:
+                try:
+                    doc_li = pickle.load(fin)
+                except EOFError:
+                    break
+                yield from doc_li
+
+
 class DocSourceMaster(dict):
     '''A class to manage various doc data sources.'''
     # TODO: fix this delayed import
@@ -87,6 +316,34 @@ class BaseSourceUploader(object):
 
     keep_archive = 10 # number of archived collection to keep. Oldest get dropped first.
 
+    # don't upload again if input files are the same as last successful upload's
+    # (according to their digest, see dumper's USE_STORE)
+    skip_unchanged = False
+
+    # if True, a failed upload is resumed (unless forced), continuing into the
+    # same temp collection: completed jobs (see ParallelizedSourceUploader) are
+    # skipped, and already stored documents aren't stored again (load_data()
+    # must yield the same documents in the same order, see Checkpoint)
+    resumable = False
+
+    # if True, parsed documents are cached (see biothings.utils.doccache) and
+    # uploading the same release again reads them from cache instead of parsing
+    # input files. Cache depends on parser_version, by default a digest of the
+    # source files in the uploader's package (plugin folder) and of the file
+    # defining load_data(): set it explicitly if the parser is elsewhere.
+    cache_parsed = False
+    parser_version = None
+
+    # if "type" or "mapping", documents are inspected while stored (see
+    # biothings.utils.inspect), instead of reading the collection again after
+    # upload. Results are registered in src_master and, in "mapping" mode,
+    # used to generate the ES mapping if get_mapping() doesn't return one
+    inspect_mode = None
+
+    # storage tuning for this source, eg. {"writers" : 8, "max_retries" : 5}
+    # (see biothings.hub.dataload.storage.BaseStorage)
+    storage_options = {}
+
     def __init__(self, db_conn_info, data_root, collection_name=None, log_folder=None, *args, **kwargs):
         """db_conn_info is a database connection info tuple (host,port) to fetch/store 
         information about the datasource's state data_root is the root folder containing
@@ -108,6 +365,18 @@ class BaseSourceUploader(object):
         self.collection_name = collection_name or self.name
         self.data_folder = None
         self.prepared = False
+        # input file (relative to data folder) => digest, and files with the
+        # same digest as last successful upload (usable from load_data())
+        self.file_hashes = {}
+        self.unchanged_files = []
+        # parser version naming cache files, computed once per upload (see
+        # get_cache_file())
+        self.cache_version = None
+        # temp collection and completed jobs, recorded while uploading
+        self.checkpoint = None
+        # merged inspect results from last upload (see inspect_mode), None
+        # if data wasn't uploaded
+        self.inspected = None
 
     @property
     def fullname(self):
@@ -201,6 +470,139 @@ class BaseSourceUploader(object):
         if not force and job:
             raise ResourceNotReady("Resource '%s' is already being uploaded (job: %s)" % (self.name,job))
 
+    def get_file_hashes(self):
+        """
+        Return digests of files in data folder, as computed by the dumper
+        (path relative to data folder => digest). Files without digest are ignored.
+        """
+        hashes = {}
+        for finfo in self.src_doc.get("download",{}).get("remote_files",[]):
+            local = finfo.get("local")
+            digest = finfo.get("sha256")
+            if not local or not digest or not self.data_folder:
+                continue
+            relpath = os.path.relpath(local,self.data_folder)
+            if not relpath.startswith(os.pardir):
+                hashes[relpath] = digest
+        return hashes
+
+    def get_uploaded_hashes(self):
+        """Return file digests recorded by last successful upload"""
+        job = self.src_doc.get("upload",{}).get("jobs",{}).get(self.name,{})
+        if job.get("status") != "success":
+            return {}
+        return dict([(f["path"],f["sha256"]) for f in job.get("files",[])])
+
+    def file_unchanged(self, path):
+        """Return True if "path" (absolute or relative to data folder) didn't change since last upload"""
+        if os.path.isabs(path):
+            path = os.path.relpath(path,self.data_folder)
+        return path in self.unchanged_files
+
+    def get_checkpoint(self):
+        """Return checkpoint recorded by previous upload if it can be resumed"""
+        job = self.src_doc.get("upload",{}).get("jobs",{}).get(self.name,{})
+        checkpoint = job.get("checkpoint")
+        if job.get("status") in ("uploading","failed") and checkpoint and \
+                checkpoint.get("temp_collection") in self.db.collection_names():
+            return checkpoint
+        return None
+
+    def clean_checkpoints(self):
+        for fn in glob.glob(get_checkpoint_file(self.temp_collection_name,"*")) + \
+                  glob.glob(get_inspect_file(self.temp_collection_name,"*")):
+            os.unlink(fn)
+
+    def get_inspect_file(self, job=1):
+        """Return file where job "job" saves inspect results, None if not inspected"""
+        mode = self.__class__.inspect_mode
+        if not mode:
+            return None
+        if not mode in ("type","mapping"):
+            raise ResourceError("inspect_mode must be 'type' or 'mapping', got %s" % repr(mode))
+        return get_inspect_file(self.temp_collection_name,job)
+
+    def collect_inspected(self):
+        """Merge inspect results saved by upload jobs, None if not available"""
+        if not self.__class__.inspect_mode:
+            return None
+        merged = {}
+        files = glob.glob(get_inspect_file(self.temp_collection_name,"*"))
+        for fn in files:
+            with open(fn,"rb") as fin:
+                inspected = pickle.load(fin)
+            if inspected is None:
+                self.logger.warning("Inspection failed in '%s', no inspect results" % fn)
+                return None
+            merge_inspect(merged,inspected)
+        if not files:
+            return None
+        if self.__class__.inspect_mode == "mapping":
+            merge_scalar_list(merged,"mapping")
+        return merged
+
+    def get_parser_version(self):
+        """
+        Return parser_version if set, otherwise a digest of the source files
+        which parsing likely depends on: all modules from the uploader's
+        package (parser is usually in a separate module, next to the uploader)
+        and the one defining load_data()
+        """
+        if self.__class__.parser_version is not None:
+            return str(self.__class__.parser_version)
+        srcfile = inspect.getsourcefile(self.__class__)
+        folder = os.path.dirname(srcfile)
+        files = set([srcfile])
+        if os.path.exists(os.path.join(folder,"__init__.py")):
+            files.update(glob.glob(os.path.join(folder,"*.py")))
+        try:
+            files.add(inspect.getsourcefile(inspect.unwrap(self.__class__.load_data)))
+        except TypeError:
+            pass # builtin or not defined in a source file
+        digest = hashlib.sha256()
+        for fn in sorted(files):
+            digest.update(("%s:%s\n" % (os.path.basename(fn),hash_file(fn))).encode())
+        return digest.hexdigest()[:8]
+
+    def get_cache_folder(self):
+        """Folder for this uploader's cached documents (one per uploader, see clean_cache())"""
+        return os.path.join(self.src_root_folder,".cache",self.name)
+
+    def get_cache_file(self, job=1):
+        """
+        Return cache file for job "job" (see cache_parsed), or None if
+        documents can't be cached (no release)
+        """
+        release = self.src_doc.get("release")
+        if not self.__class__.cache_parsed or not release:
+            return None
+        version = self.cache_version or self.get_parser_version()
+        return os.path.join(self.get_cache_folder(),"%s_%s_%s.bson.gz" % \
+                (str(release).replace(os.sep,"_"),version,job))
+
+    def cached_docs(self):
+        """
+        Iterate over cached documents for current release (eg. to inspect
+        them, see biothings.utils.inspect.inspect_docs())
+        """
+        pattern = self.get_cache_file("*")
+        if not pattern:
+            raise ResourceError("Parsed documents aren't cached for '%s'" % self.name)
+        files = glob.glob(pattern)
+        if not files:
+            raise ResourceError("No cached documents for '%s', upload it first" % self.name)
+        # in job order
+        for fn in sorted(files,key=lambda fn: int(os.path.basename(fn).split(".")[0].rsplit("_",1)[1])):
+            yield from read_docs(fn)
+
+    def clean_cache(self):
+        """Delete cached documents, except for current release and parser version"""
+        current = self.get_cache_file("*")
+        for fn in glob.glob(os.path.join(self.get_cache_folder(),"*.bson.gz")):
+            if not current or not fnmatch.fnmatch(fn,current):
+                self.logger.info("Deleting old cache file '%s'" % fn)
+                os.unlink(fn)
+
     def load_data(self,data_folder):
         """Parse data inside data_folder and return structure ready to be
         inserted in database"""
@@ -251,6 +653,10 @@ class BaseSourceUploader(object):
            data has been uploaded"""
         pass
 
+    def get_storage_stats_key(self):
+        """Where upload_worker() registers storage stats in src_dump"""
+        return (self.main_source,"upload.jobs.%s.stats" % self.name)
+
     @asyncio.coroutine
     def update_data(self, batch_size, job_manager):
         """
@@ -259,6 +665,9 @@ class BaseSourceUploader(object):
         pinfo = self.get_pinfo()
         pinfo["step"] = "update_data"
         got_error = False
+        cache_file = self.get_cache_file()
+        if cache_file and os.path.exists(cache_file):
+            self.logger.info("Reading parsed documents from cache '%s'" % cache_file)
         self.unprepare()
         job = yield from job_manager.defer_to_process(
                 pinfo,
@@ -270,7 +679,14 @@ class BaseSourceUploader(object):
                     self.temp_collection_name,
                     batch_size,
                     1, # no batch, just #1
-                    self.data_folder
+                    self.data_folder,
+                    checkpoint_file=self.__class__.resumable and \
+                            get_checkpoint_file(self.temp_collection_name,1) or None,
+                    cache_file=cache_file,
+                    inspect_mode=self.__class__.inspect_mode,
+                    inspect_file=self.get_inspect_file(),
+                    storage_options=self.__class__.storage_options,
+                    stats_key=self.get_storage_stats_key()
                     )
                 )
         def uploaded(f):
@@ -289,6 +705,23 @@ class BaseSourceUploader(object):
                 "timestamp": datetime.datetime.now()}
         # store mapping
         _doc['mapping'] = self.__class__.get_mapping()
+        inspected = self.inspected
+        if inspected is None and self.__class__.inspect_mode:
+            # data not uploaded this time, keep previous results
+            prev = self.src_master.find_one({"_id" : _doc["_id"]}) or {}
+            if "inspect" in prev:
+                _doc["inspect"] = prev["inspect"]
+                _doc["mapping"] = _doc["mapping"] or prev.get("mapping",{})
+        elif inspected:
+            _doc["inspect"] = {"mode" : self.__class__.inspect_mode,
+                               "results" : stringify_inspect_doc(inspected)}
+            if not _doc["mapping"] and self.__class__.inspect_mode == "mapping":
+                try:
+                    # elasticsearch dependency only needed here
+                    from biothings.utils.es import generate_es_mapping
+                    _doc["mapping"] = generate_es_mapping(copy.deepcopy(inspected))
+                except Exception as e:
+                    self.logger.warning("Can't generate mapping from inspect results: %s" % e)
         # type of id being stored in these docs
         if hasattr(self.__class__, '__metadata__'):
             _doc.update(self.__class__.__metadata__)
@@ -333,6 +766,12 @@ class BaseSourceUploader(object):
             upd["%s.time" % job_key] = timesofar(self.t0)
             upd["%s.time_in_s" % job_key] = t1
             upd["%s.step" % job_key] = self.name # collection name
+            if status == "success" and t1:
+                # storage stats, added by upload jobs
+                doc = self.src_dump.find_one({"_id" : self.main_source}) or {}
+                docs = doc.get("upload",{}).get("jobs",{}).get(self.name,{}).get("stats",{}).get("docs")
+                if docs:
+                    upd["%s.stats.docs_per_sec" % job_key] = round(docs / t1,1)
             self.src_dump.update_one({"_id" : self.main_source},{"$set" : upd})
 
     @asyncio.coroutine
@@ -356,16 +795,37 @@ class BaseSourceUploader(object):
         post_update_data = "post" in steps
         clean_archives = "clean" in steps
         strargs = "[steps=%s]" % ",".join(steps)
+        self.file_hashes = self.get_file_hashes()
+        self.cache_version = self.__class__.cache_parsed and self.get_parser_version() or None
+        uploaded = self.get_uploaded_hashes()
+        self.unchanged_files = sorted([f for f,h in self.file_hashes.items() if uploaded.get(f) == h])
+        files = [{"path" : f, "sha256" : h} for f,h in sorted(self.file_hashes.items())]
+        if self.__class__.skip_unchanged and not force and self.file_hashes and self.file_hashes == uploaded:
+            self.logger.info("Input files didn't change since last upload, nothing to upload",
+                    extra={"notify":True})
+            self.register_status("success",files=files)
+            return
         try:
-            if not self.temp_collection_name:
-                self.make_temp_collection()
-            self.db[self.temp_collection_name].drop()       # drop all existing records just in case.
-            self.register_status("uploading")
+            checkpoint = self.__class__.resumable and not force and self.get_checkpoint()
+            if checkpoint:
+                self.temp_collection_name = checkpoint["temp_collection"]
+                self.logger.info("Resuming upload into '%s' (%d completed jobs)" % \
+                        (self.temp_collection_name,len(checkpoint.get("done_jobs",[]))))
+            else:
+                if not self.temp_collection_name:
+                    self.make_temp_collection()
+                self.db[self.temp_collection_name].drop()       # drop all existing records just in case.
+                self.clean_checkpoints()
+                checkpoint = {"temp_collection" : self.temp_collection_name, "done_jobs" : []}
+            self.checkpoint = checkpoint
+            self.register_status("uploading",checkpoint=self.checkpoint)
             if update_data:
                 # unsync to make it pickable
                 state = self.unprepare()
                 yield from self.update_data(batch_size, job_manager, **kwargs)
                 self.prepare(state)
+                # {} if not available, so previous results aren't kept
+                self.inspected = self.collect_inspected() or {}
             if update_master:
                 self.update_master()
             if post_update_data:
@@ -385,7 +845,9 @@ class BaseSourceUploader(object):
             cnt = self.db[self.collection_name].count()
             if clean_archives:
                 self.clean_archived_collections()
-            self.register_status("success",count=cnt)
+            self.clean_checkpoints()
+            self.clean_cache()
+            self.register_status("success",count=cnt,files=files,checkpoint=None)
             self.logger.info("success %s" % strargs,extra={"notify":True})
         except Exception as e:
             self.register_status("failed",err=str(e))
@@ -497,6 +959,7 @@ class ParallelizedSourceUploader(BaseSourceUploader):
         """Return list of (*arguments) passed to self.load_data, in order. for
         each parallelized jobs. Ex: [(x,1),(y,2),(z,3)]
         If only one argument is required, it still must be passed as a 1-element tuple
+        When resumable, same jobs must be returned in the same order each time.
         """
         raise NotImplementedError("implement me in subclass")
 
@@ -508,9 +971,21 @@ class ParallelizedSourceUploader(BaseSourceUploader):
         # make sure we don't use any of self reference in the following loop
         fullname = copy.deepcopy(self.fullname)
         storage_class = copy.deepcopy(self.__class__.storage_class)
-        load_data = copy.deepcopy(self.load_data)
         temp_collection_name = copy.deepcopy(self.temp_collection_name)
+        resumable = self.__class__.resumable
+        checkpoint = copy.deepcopy(self.checkpoint or {"done_jobs" : []})
+        done_jobs = set(checkpoint["done_jobs"])
+        main_source = self.main_source
+        job_key = "upload.jobs.%s.checkpoint.done_jobs" % self.name
+        cache_files = [self.get_cache_file(bnum) for bnum in range(len(job_params))]
+        inspect_mode = self.__class__.inspect_mode
+        inspect_files = [self.get_inspect_file(bnum) for bnum in range(len(job_params))]
+        storage_options = copy.deepcopy(self.__class__.storage_options)
+        stats_key = self.get_storage_stats_key()
         state = self.unprepare()
+        # once unprepared (jobs() may have used the database or the logger)
+        load_data = copy.deepcopy(self.load_data)
+        src_dump = state["src_dump"] or get_src_dump()
         # important: within this loop, "self" should never be used to make sure we don't 
         # instantiate unpicklable attributes (via via autoset attributes, see prepare())
         # because there could a race condition where an error would cause self to log a statement
@@ -519,6 +994,8 @@ class ParallelizedSourceUploader(BaseSourceUploader):
         # in other words: once unprepared, self should never be changed until all 
         # jobs are submitted
         for bnum,args in enumerate(job_params):
+            if bnum in done_jobs:
+                continue
             pinfo = self.get_pinfo()
             pinfo["step"] = "update_data"
             pinfo["description"] = "%s" % str(args)
@@ -540,7 +1017,13 @@ class ParallelizedSourceUploader(BaseSourceUploader):
                         # batch num
                         bnum,
                         # and finally *args passed to loading func
-                        *args
+                        *args,
+                        checkpoint_file=resumable and get_checkpoint_file(temp_collection_name,bnum) or None,
+                        cache_file=cache_files[bnum],
+                        inspect_mode=inspect_mode,
+                        inspect_file=inspect_files[bnum],
+                        storage_options=storage_options,
+                        stats_key=stats_key
                         )
                     )
             jobs.append(job)
@@ -556,11 +1039,14 @@ class ParallelizedSourceUploader(BaseSourceUploader):
                 try:
                     if type(f.result()) != int:
                         got_error = Exception("Batch #%s failed while uploading source '%s' [%s]" % (batch_num, name, f.result()))
+                    elif resumable:
+                        checkpoint["done_jobs"] = sorted(set(checkpoint["done_jobs"] + [batch_num]))
+                        src_dump.update_one({"_id" : main_source},{"$set" : {job_key : checkpoint["done_jobs"]}})
                 except Exception as e:
                     got_error = e
 
             job.add_done_callback(partial(batch_uploaded,name=fullname,batch_num=bnum))
-        if jobs:
+        if jobs or done_jobs:
             yield from asyncio.gather(*jobs)
             if got_error:
                 raise got_error
@@ -568,6 +1054,95 @@ class ParallelizedSourceUploader(BaseSourceUploader):
             self.clean_archived_collections()
 
 
+class RangeParallelSourceUploader(ParallelizedSourceUploader):
+    """
+    Parse one big file with several processes: file is split into line-aligned
+    ranges (see biothings.utils.filerange), and load_data() is called for each
+    range, in parallel, with a FileRange object instead of the data folder.
+    anyfile()/open_anyfile() (so tabfile_feeder() and alike) accept it like a
+    regular file path. File must be uncompressed or block-compressed (BGZF).
+    """
+    # number of ranges, if None, file is split in ranges of about range_size bytes
+    range_parts = None
+    range_size = RANGE_SIZE
+    # number of header lines. If propagate_header is True, each range starts
+    # with them (as if it was the whole file), otherwise only the first one does
+    range_header = 0
+    propagate_header = False
+    # by default ranges are stored as soon as parsed, concurrently. If True,
+    # ranges are parsed in parallel but stored one after the other, in file order
+    # (eg. so IgnoreDuplicatedStorage keeps the first document found in file)
+    ordered = False
+
+    def get_range_file(self):
+        """Return the file to split, default to the only file in data folder"""
+        files = [f for f in os.listdir(self.data_folder) if not f.startswith(".") \
+                and os.path.isfile(os.path.join(self.data_folder,f))]
+        if len(files) != 1:
+            raise ResourceError("Expecting one file to split in '%s', found: %s" % (self.data_folder,files))
+        return os.path.join(self.data_folder,files[0])
+
+    def jobs(self):
+        ranges = split_file(self.get_range_file(),parts=self.range_parts,range_size=self.range_size,
+                header=self.range_header,propagate_header=self.propagate_header)
+        self.logger.info("Split '%s' in %d ranges" % (ranges[0].filename,len(ranges)))
+        return [(r,) for r in ranges]
+
+    @asyncio.coroutine
+    def update_data(self, batch_size, job_manager=None):
+        if not self.ordered:
+            yield from super(RangeParallelSourceUploader,self).update_data(batch_size,job_manager)
+            return
+        job_params = self.jobs()
+        cache_files = [self.get_cache_file(bnum) for bnum in range(len(job_params))]
+        spill_dir = get_spill_dir(self.temp_collection_name)
+        os.makedirs(spill_dir,exist_ok=True)
+        fullname = copy.deepcopy(self.fullname)
+        storage_class = copy.deepcopy(self.__class__.storage_class)
+        temp_collection_name = copy.deepcopy(self.temp_collection_name)
+        inspect_file = self.get_inspect_file("ordered")
+        stats_key = self.get_storage_stats_key()
+        state = self.unprepare()
+        load_data = copy.deepcopy(self.load_data)
+        # see ParallelizedSourceUploader.update_data() about not using "self" here
+        jobs = []
+        spill_files = []
+        try:
+            for bnum,args in enumerate(job_params):
+                pinfo = self.get_pinfo()
+                pinfo["step"] = "update_data"
+                pinfo["description"] = "parse %s" % str(args)
+                spill_file = os.path.join(spill_dir,"range_%d.pickle" % bnum)
+                job = yield from job_manager.defer_to_process(
+                        pinfo,
+                        partial(range_parse_worker,fullname,load_data,spill_file,batch_size,bnum,*args,
+                                cache_file=cache_files[bnum]))
+                jobs.append(job)
+                spill_files.append(spill_file)
+            yield from asyncio.gather(*jobs)
+            pinfo = self.get_pinfo()
+            pinfo["step"] = "update_data"
+            pinfo["description"] = "store %d ranges" % len(spill_files)
+            job = yield from job_manager.defer_to_process(
+                    pinfo,
+                    partial(upload_worker,fullname,storage_class,load_spilled,
+                            temp_collection_name,batch_size,len(spill_files),spill_files,
+                            checkpoint_file=self.__class__.resumable and \
+                                    get_checkpoint_file(temp_collection_name,"ordered") or None,
+                            inspect_mode=self.__class__.inspect_mode,inspect_file=inspect_file,
+                            storage_options=self.__class__.storage_options,stats_key=stats_key))
+            res = yield from job
+            if type(res) != int:
+                raise ResourceError("Storing ranges failed while uploading source '%s' [%s]" % (fullname,res))
+        finally:
+            # make sure no parsing process still writes there
+            if jobs:
+                yield from asyncio.wait(jobs)
+            shutil.rmtree(spill_dir,ignore_errors=True)
+        self.switch_collection()
+        self.clean_archived_collections()
+
+
 class NoDataSourceUploader(BaseSourceUploader):
     """
     This uploader won't upload any data and won't even assume
@@ -625,7 +1200,10 @@ class UploaderManager(BaseSourceManager):
         upload_info = {'status': status}
         upload_info.update(extra)
         if status == "uploading":
-            upload_info["jobs"] = {}
+            # jobs' information from previous upload is kept: uploaders use it
+            # to resume (checkpoint) or skip unchanged files (files)
+            doc = src_dump.find_one({"_id" : src_name}) or {}
+            upload_info["jobs"] = (doc.get("upload") or {}).get("jobs") or {}
             # unflag "need upload"
             src_dump.update_one({"_id" : src_name},{"$unset" : {"pending_to_upload":None}})
             src_dump.update_one({"_id" : src_name},{"$set" : {"upload" : upload_info}})
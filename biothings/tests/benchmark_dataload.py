@@ -0,0 +1,70 @@
+"""
+Benchmark dataload's tabfile_feeder()/tab2dict() against csv module based
+implementation (as used before). Generates a TSV file of given size (in MB),
+eg. for a multi-GB file:
+
+    python -m biothings.tests.benchmark_dataload --size 4000 --folder /data/tmp
+"""
+import os, csv, time, argparse, tempfile
+
+from biothings.utils.common import anyfile, sizeof_fmt
+from biothings.utils.dataload import tabfile_feeder, tab2dict, list2dict, listitems
+
+
+def csv_feeder(datafile, header=1, sep='\t'):
+    # previous implementation
+    in_f = anyfile(datafile)
+    reader = csv.reader(in_f, delimiter=sep)
+    for i in range(header):
+        next(reader)
+    for ld in reader:
+        yield [str(x) for x in ld]
+
+
+def csv_tab2dict(datafile, cols, key):
+    return list2dict([listitems(ld, *cols) for ld in csv_feeder(datafile)], key)
+
+
+def generate(path, size_mb, columns=12):
+    line_tpl = "\t".join(["rs%d"] + ["value_%%d_%d" % i for i in range(columns - 2)] + ["%d"]) + "\n"
+    with open(path,"w") as fout:
+        fout.write("\t".join(["col%d" % i for i in range(columns)]) + "\n")
+        i = 0
+        while fout.tell() < size_mb * 1024 * 1024:
+            fout.write("".join([line_tpl % ((i + j,) + (i + j,) * (columns - 2) + (j,)) for j in range(1000)]))
+            i += 1000
+
+
+def run(name, func):
+    t0 = time.time()
+    res = func()
+    return name, time.time() - t0, res
+
+
+def benchmark(path):
+    size = os.path.getsize(path)
+    results = [
+        run("csv_feeder (all columns)",lambda: sum(1 for _ in csv_feeder(path))),
+        run("tabfile_feeder (all columns)",lambda: sum(1 for _ in tabfile_feeder(path))),
+        run("csv_feeder + projection",lambda: sum(1 for ld in csv_feeder(path) if listitems(ld,0,11))),
+        run("tabfile_feeder(cols=[0,1])",lambda: sum(1 for _ in tabfile_feeder(path,cols=[0,1]))),
+        run("tabfile_feeder(cols,converters)",lambda: sum(ld[1] for ld in tabfile_feeder(path,cols=[0,11],converters={11 : int}))),
+        run("csv tab2dict",lambda: len(csv_tab2dict(path,(0,1),0))),
+        run("tab2dict",lambda: len(tab2dict(path,(0,1),0))),
+    ]
+    line = "{:<35}|{:>10}|{:>12}|{:>12}"
+    print(line.format("IMPLEMENTATION","TIME (s)","MB/s","RESULT"))
+    for name,secs,res in results:
+        print(line.format(name,"%.2f" % secs,"%.1f" % (size / 1024 / 1024 / secs),res))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size",type=int,default=500,help="size of generated file, in MB")
+    parser.add_argument("--folder",default=None,help="where to generate file (default: temp folder)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.folder) as tmpdir:
+        path = os.path.join(tmpdir,"benchmark.tsv")
+        generate(path,args.size)
+        print("File: %s (%s)" % (path,sizeof_fmt(os.path.getsize(path))))
+        benchmark(path)
@@ -0,0 +1,58 @@
+"""
+Benchmark compile_pipeline() against chained dict_sweep/unlist/value_convert_to_number
+calls, on generated nested variant documents:
+
+    python -m biothings.tests.benchmark_pipeline --docs 200000
+"""
+import time, copy, random, argparse
+
+from biothings.utils.dataload import compile_pipeline, dict_sweep, unlist, \
+        value_convert_to_number, list_split
+
+SWEPT = [".", "-", "", "NA", None]
+
+
+def variant(i):
+    return {
+        "_id" : "chr1:g.%dA>G" % i,
+        "chrom" : "1",
+        "vcf" : {"position" : str(i), "ref" : "A", "alt" : ["G"], "qual" : random.choice([".","50.5"])},
+        "rsid" : ["rs%d" % i],
+        "gene" : [{"symbol" : "GENE%d" % (i % 100), "id" : str(i % 100), "strand" : random.choice(["+","-"]),
+                   "transcripts" : [{"id" : "NM_%d" % j, "exon" : str(j), "cdna" : {"start" : str(j * 10), "end" : "."}}
+                                    for j in range(random.randint(1,3))]}],
+        "freq" : {"af" : str(random.random()), "ac" : str(random.randint(0,100)), "an" : "NA",
+                  "populations" : {"afr" : str(random.random()), "eur" : ".", "eas" : [str(random.random())]}},
+        "clinical" : {"sig" : "pathogenic;likely_pathogenic", "review" : "", "conditions" : [{"name" : "x", "id" : "-"}]},
+    }
+
+
+def chained(doc):
+    return dict_sweep(unlist(list_split(value_convert_to_number(doc, skipped_keys=["chrom","_id"]), ";")), vals=SWEPT)
+
+
+compiled = compile_pipeline(
+    (value_convert_to_number, {"skipped_keys" : ["chrom","_id"]}),
+    (list_split, {"sep" : ";"}),
+    unlist,
+    (dict_sweep, {"vals" : SWEPT}))
+
+
+def run(name, func, docs):
+    docs = copy.deepcopy(docs)
+    t0 = time.time()
+    res = [func(doc) for doc in docs]
+    secs = time.time() - t0
+    print("{:<20}|{:>10.2f}|{:>12.0f}".format(name,secs,len(docs) / secs))
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs",type=int,default=100000,help="number of documents")
+    args = parser.parse_args()
+    random.seed(42)
+    docs = [variant(i) for i in range(args.docs)]
+    print("{:<20}|{:>10}|{:>12}".format("IMPLEMENTATION","TIME (s)","DOCS/s"))
+    expected = run("chained helpers",chained,docs)
+    assert run("compile_pipeline",compiled,docs) == expected
@@ -0,0 +1,32 @@
+"""
+Minimal hub application (config module, sqlite hub db in a temp folder)
+for tests needing "biothings.config"
+"""
+import os, sys, tempfile, importlib
+
+import biothings
+
+APP_CONFIG = """
+import logging
+logger = logging.getLogger("tests")
+LOG_FOLDER = RUN_DIR = DATA_ARCHIVE_ROOT = {root!r}
+HIPCHAT_CONFIG = {{}}
+HUB_DB_BACKEND = {{"module" : "biothings.utils.sqlite3", "sqlite_db_folder" : {root!r}}}
+DATA_HUB_DB_DATABASE = "hubdb"
+DATA_SRC_DUMP_COLLECTION = "src_dump"
+DATA_SRC_MASTER_COLLECTION = "src_master"
+DATA_SRC_BUILD_COLLECTION = "src_build"
+DATA_SRC_BUILD_CONFIG_COLLECTION = "src_build_config"
+DATA_SRC_DATABASE = "src_db"
+"""
+
+
+def setup_app():
+    """Configure a test application, if none is, and return its config module"""
+    if not hasattr(biothings,"config"):
+        root = tempfile.mkdtemp(prefix="test_hub_")
+        with open(os.path.join(root,"config.py"),"w") as fout:
+            fout.write(APP_CONFIG.format(root=root))
+        sys.path.insert(0,root)
+        biothings.config_for_app(importlib.import_module("config"))
+    return biothings.config
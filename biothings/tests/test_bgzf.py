@@ -0,0 +1,75 @@
+import os, io, gzip, tempfile
+
+from biothings.utils import bgzf
+from biothings.utils.common import dump, loadobj, anyfile, open_compressed_file
+
+
+DATA = b"".join([b"line %d %s\n" % (i,os.urandom(i % 40).hex().encode()) for i in range(50000)])
+
+
+def write(path, data, **kwargs):
+    with bgzf.BGZFWriter(path,**kwargs) as fout:
+        # small writes, buffered in blocks
+        for i in range(0,len(data),7000):
+            fout.write(data[i:i+7000])
+
+
+def test_roundtrip():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for threads in (1,4):
+            path = os.path.join(tmpdir,"data%d.gz" % threads)
+            write(path,DATA,threads=threads)
+            assert bgzf.is_bgzf(path)
+            # still a regular (multi-member) gzip file
+            assert gzip.decompress(open(path,"rb").read()) == DATA
+            with bgzf.open_bgzf(path,threads=threads) as fin:
+                assert fin.read() == DATA
+            with bgzf.open_bgzf(path,"rt") as fin:
+                assert len(fin.readlines()) == 50000
+        plain = os.path.join(tmpdir,"plain.gz")
+        open(plain,"wb").write(gzip.compress(DATA))
+        assert not bgzf.is_bgzf(plain)
+        empty = os.path.join(tmpdir,"empty.gz")
+        write(empty,b"")
+        assert open(empty,"rb").read() == bgzf.EOF_BLOCK
+        assert bgzf.open_bgzf(empty).read() == b""
+
+
+def test_seek():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,"data.gz")
+        write(path,DATA,threads=4)
+        assert os.path.exists(bgzf.get_index_path(path))
+        for use_index in (True,False):
+            if not use_index:
+                # offsets found by scanning block headers
+                os.unlink(bgzf.get_index_path(path))
+            with bgzf.open_bgzf(path) as fin:
+                for offset in [0,5,bgzf.BLOCK_SIZE - 1,bgzf.BLOCK_SIZE,bgzf.BLOCK_SIZE * 3 + 17,
+                               len(DATA) - 3,len(DATA),len(DATA) + 10,1234]:
+                    fin.seek(offset)
+                    assert fin.read(100) == DATA[offset:offset+100]
+                fin.seek(-10,io.SEEK_END)
+                assert fin.read() == DATA[-10:]
+                fin.seek(len(DATA) // 2)
+                fin.readline()
+                assert fin.tell() == DATA.index(b"\n",len(DATA) // 2) + 1
+
+
+def test_common_helpers():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        obj = {"data" : DATA, "list" : list(range(1000))}
+        path = os.path.join(tmpdir,"obj.pyobj")
+        dump(obj,path)
+        assert bgzf.is_bgzf(path)
+        assert loadobj(path) == obj
+        # files written with gzip module are still supported
+        gz = os.path.join(tmpdir,"old.pyobj")
+        with gzip.GzipFile(gz,"wb") as fout:
+            fout.write(open_compressed_file(path).read())
+        assert loadobj(gz) == obj
+        txt = os.path.join(tmpdir,"data.txt.gz")
+        write(txt,DATA)
+        in_f = anyfile(txt)
+        assert in_f.readline() == DATA[:DATA.index(b"\n") + 1].decode()
+        in_f.close()
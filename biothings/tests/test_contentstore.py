@@ -0,0 +1,57 @@
+import os, hashlib, tempfile
+
+from biothings.utils.contentstore import ContentStore, detach, hash_file
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    with open(path,"wb") as fout:
+        fout.write(data)
+
+
+def test_store_and_dedup():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = ContentStore(os.path.join(tmpdir,".store"))
+        rel1 = os.path.join(tmpdir,"src","1")
+        rel2 = os.path.join(tmpdir,"src","2")
+        write(os.path.join(rel1,"a.txt"),b"aaa")
+        write(os.path.join(rel1,"b.txt"),b"bbb")
+        write(os.path.join(rel2,"a.txt"),b"aaa")
+        write(os.path.join(rel2,"b.txt"),b"bbb2")
+        digests = {}
+        for rel in (rel1,rel2):
+            for name in ("a.txt","b.txt"):
+                path = os.path.join(rel,name)
+                digests[path] = store.add(path)
+        assert digests[os.path.join(rel1,"a.txt")] == hashlib.sha256(b"aaa").hexdigest()
+        # same content, same file
+        assert os.path.samefile(os.path.join(rel1,"a.txt"),os.path.join(rel2,"a.txt"))
+        assert not os.path.samefile(os.path.join(rel1,"b.txt"),os.path.join(rel2,"b.txt"))
+        assert os.stat(os.path.join(rel1,"a.txt")).st_nlink == 3
+        # adding again doesn't change anything
+        store.add(os.path.join(rel2,"a.txt"),digests[os.path.join(rel2,"a.txt")])
+        assert os.stat(os.path.join(rel1,"a.txt")).st_nlink == 3
+        assert not [f for f in os.listdir(rel2) if f.endswith(".tmp")]
+
+
+def test_link_detach_gc():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = ContentStore(os.path.join(tmpdir,".store"))
+        path = os.path.join(tmpdir,"1","a.txt")
+        write(path,b"content")
+        digest = store.add(path)
+        dest = os.path.join(tmpdir,"2","sub","a.txt")
+        assert store.link(digest,dest)
+        assert open(dest,"rb").read() == b"content"
+        assert not store.link("0" * 64,os.path.join(tmpdir,"2","nope"))
+        # file about to be rewritten, other copies are kept as is
+        assert detach(dest)
+        write(dest,b"new content")
+        assert open(path,"rb").read() == b"content"
+        assert hash_file(dest) == hashlib.sha256(b"new content").hexdigest()
+        assert not detach(dest)
+        assert store.gc() == 0
+        os.unlink(path)
+        # only the store refers to it now
+        assert store.gc() == 1
+        assert not store.has(digest)
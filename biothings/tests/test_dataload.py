@@ -0,0 +1,219 @@
+import os, csv, gzip, tempfile, random, copy, collections
+
+from biothings.utils import dataload
+from biothings.utils.dataload import tabfile_feeder, tab2list, tab2dict, tab2dict_iter, \
+        compile_pipeline, dict_sweep, unlist, value_convert_to_number, list_split, \
+        value_convert, boolean_convert, merge_struct, merge_lists, value_fingerprint
+
+
+def csv_rows(path, header=1, sep="\t"):
+    # reference implementation (csv module only)
+    with open(path) as fin:
+        reader = csv.reader(fin,delimiter=sep)
+        for _ in range(header):
+            next(reader)
+        return list(reader)
+
+
+def write(tmpdir, name, content):
+    path = os.path.join(tmpdir,name)
+    with open(path,"w") as fout:
+        fout.write(content)
+    return path
+
+
+LINES = ["a%d\tb%d\t%d\tsome text %d" % (i,i % 7,i,i) for i in range(5000)]
+
+
+def test_same_as_csv():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        contents = {
+            "plain" : "h1\th2\th3\th4\n" + "\n".join(LINES) + "\n",
+            "no_final_newline" : "h1\th2\n" + "\n".join(LINES),
+            "empty_lines" : "h\n\n" + "\n".join(LINES[:10]) + "\n\n" + "\n".join(LINES[10:20]) + "\n",
+            # quoted field spanning lines, after the first read block
+            "quoted" : "h\n" + "\n".join(LINES) + '\nx\t"multi\nline\tfield"\tz\n' + "\n".join(LINES[:100]) + "\n",
+            "quote_in_field" : "h\n" + 'a\tb"c\td\n' * 10,
+            "quoted_header" : 'h1\t"multi\nline header"\th3\n' + "\n".join(LINES[:100]) + "\n",
+        }
+        # small blocks, to test lines across blocks
+        orig = dataload.READ_BLOCK_SIZE
+        try:
+            for block_size in (orig,1000):
+                dataload.READ_BLOCK_SIZE = block_size
+                for name,content in contents.items():
+                    path = write(tmpdir,name + ".tsv",content)
+                    assert list(tabfile_feeder(path)) == csv_rows(path), name
+                    assert list(tabfile_feeder(path,header=0)) == csv_rows(path,header=0), name
+        finally:
+            dataload.READ_BLOCK_SIZE = orig
+        assert list(tabfile_feeder(write(tmpdir,"empty.tsv",""))) == []
+        csvpath = write(tmpdir,"data.csv",'h1,h2\n1,"a,b"\n2,c\n')
+        assert list(tabfile_feeder(csvpath,sep=",")) == [["1","a,b"],["2","c"]]
+        gz = os.path.join(tmpdir,"data.tsv.gz")
+        with gzip.open(gz,"wt") as fout:
+            fout.write(contents["plain"])
+        assert list(tabfile_feeder(gz)) == csv_rows(os.path.join(tmpdir,"plain.tsv"))
+
+
+def test_projection_and_converters():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = write(tmpdir,"data.tsv","h\n" + "\n".join(LINES) + "\n")
+        rows = csv_rows(path)
+        assert list(tabfile_feeder(path,cols=[2,0])) == [[r[2],r[0]] for r in rows]
+        assert list(tabfile_feeder(path,cols=[2,0],converters={2 : int})) == [[int(r[2]),r[0]] for r in rows]
+        assert list(tabfile_feeder(path,converters={2 : int}))[5] == ["a5","b5",5,"some text 5"]
+        # includefn gets the whole row
+        assert list(tabfile_feeder(path,cols=[0],includefn=lambda r: r[3].endswith("7"))) == \
+                [[r[0]] for r in rows if r[3].endswith("7")]
+        try:
+            list(tabfile_feeder(path,assert_column_no=3))
+            assert False, "should have raised"
+        except ValueError:
+            pass
+        assert tab2list(path,0) == [r[0] for r in rows]
+        assert tab2list(path,(3,1)) == [[r[3],r[1]] for r in rows]
+        assert tab2dict(path,(0,1),0) == dict([(r[0],r[1]) for r in rows])
+        # negative indexes, from the end of line
+        assert list(tabfile_feeder(path,cols=[0,-1])) == [[r[0],r[-1]] for r in rows]
+        assert tab2dict(path,(0,-1),0) == dict([(r[0],r[-1]) for r in rows])
+        assert tab2dict(path,(1,2),0,alwayslist=True)["b3"] == [r[2] for r in rows if r[1] == "b3"]
+        grouped = list(tab2dict_iter(path,(1,0),0))
+        assert len(grouped) == len(rows) and grouped[0] == {"b0" : "a0"}
+
+
+SCALARS = [".", "-", "", "NA", "12", "-3.5e2", "rs123", "a;b;", "1;2", "true", 0, 1.5, None]
+
+
+def random_value(depth=0):
+    r = random.random()
+    if depth < 4 and r < 0.2:
+        return random_doc(depth + 1)
+    elif depth < 4 and r < 0.4:
+        return [random_value(depth + 1) for _ in range(random.choice([0,1,1,2,3]))]
+    elif r < 0.43:
+        return tuple(random.sample(SCALARS[:10],2))
+    return random.choice(SCALARS)
+
+
+def random_doc(depth=0):
+    return dict([("k%d" % i,random_value(depth)) for i in range(random.randint(0,5))])
+
+
+STEPS = [
+    dict_sweep,
+    (dict_sweep, {"vals" : [".", "-", None]}),
+    unlist,
+    value_convert_to_number,
+    (value_convert_to_number, {"skipped_keys" : ["k1"]}),
+    (list_split, {"sep" : ";"}),
+    (value_convert, {"fn" : lambda v: v.upper() if isinstance(v,str) else v}),
+    (value_convert, {"fn" : lambda v: [v] if isinstance(v,dict) else v, "traverse_list" : False}),
+    (boolean_convert, {"convert_keys" : ["k2"]}),
+]
+
+
+def test_pipeline_same_as_helpers():
+    random.seed(46)
+    for _ in range(1000):
+        steps = [random.choice(STEPS) for _ in range(random.randint(1,6))]
+        doc = random_doc()
+        expected = copy.deepcopy(doc)
+        try:
+            for step in steps:
+                func, kwargs = step if isinstance(step,tuple) else (step,{})
+                expected = func(expected,**kwargs)
+        except (TypeError, AttributeError) as e:
+            # helpers themselves fail (eg. list_split on numbers)
+            expected = type(e)
+        try:
+            result = compile_pipeline(*steps)(doc)
+        except (TypeError, AttributeError) as e:
+            result = type(e)
+        assert result == expected, (steps,doc)
+
+
+def reference_merge_struct(v1, v2, aslistofdict=None):
+    # merge_struct() before fingerprints
+    if isinstance(v1, list):
+        if isinstance(v2, list):
+            v1 = v1 + [x for x in v2 if x not in v1]
+        else:
+            if v2 not in v1:
+                v1.append(v2)
+    elif isinstance(v2, list) and isinstance(v1, dict):
+        if v1 not in v2:
+            v2.append(v1)
+    elif isinstance(v1, dict):
+        assert isinstance(v2, dict)
+        for k in list(v1.keys()):
+            if k in v2:
+                if aslistofdict == k:
+                    v1elem = v1[k] if isinstance(v1[k], list) else [v1[k]]
+                    v2elem = v2[k] if isinstance(v2[k], list) else [v2[k]]
+                    if v1elem != v2elem:
+                        v1[k] = reference_merge_struct(v1elem,v2elem)
+                else:
+                    v1[k] = reference_merge_struct(v1[k], v2[k])
+            else:
+                v2[k] = v1[k]
+        for k in v2:
+            if not k in v1:
+                v1[k] = v2[k]
+    elif isinstance(v1, (str, int, float)):
+        if isinstance(v2, (str, int, float)):
+            if v1 != v2:
+                v1 = [v1, v2]
+        else:
+            return reference_merge_struct(v2, v1)
+    else:
+        raise TypeError("dunno how to merge type %s" % type(v1))
+    return v1
+
+
+NAN = float("nan")
+MERGE_SCALARS = [1, 1.0, True, 0, False, -0.0, "1", "a", "b", None, NAN, float("nan"), (1,2), (1,[2]), frozenset([1])]
+
+
+def random_element(depth=0):
+    r = random.random()
+    if depth < 3 and r < 0.15:
+        return dict([(random.choice(["a","b",1,True]),random_element(depth + 1)) for _ in range(random.randint(0,3))])
+    elif depth < 3 and r < 0.25:
+        return [random_element(depth + 1) for _ in range(random.randint(0,3))]
+    elif depth < 3 and r < 0.28:
+        return tuple([random_element(depth + 1) for _ in range(random.randint(0,2))])
+    elif r < 0.3:
+        return collections.OrderedDict(random.sample([("a",1),("b",2),("c",3)],2))
+    elif r < 0.32:
+        return set(random.sample([1,2,3],2))
+    return random.choice(MERGE_SCALARS)
+
+
+def test_merge_struct_same_as_reference():
+    random.seed(48)
+    for _ in range(3000):
+        # big lists, with many duplicates
+        l1 = [random_element() for _ in range(random.randint(0,40))]
+        l2 = [random_element() for _ in range(random.randint(0,40))] + random.sample(l1,len(l1) // 2)
+        random.shuffle(l2)
+        v1 = {"k" : l1, "s" : random.choice(MERGE_SCALARS[:5]), "sub" : {"l" : l1[:5]}}
+        v2 = {"k" : l2, "s" : random.choice(MERGE_SCALARS[:5]), "sub" : {"l" : l2[:5]}}
+        aslistofdict = random.choice([None,"k"])
+        expected = reference_merge_struct(copy.deepcopy(v1),copy.deepcopy(v2),aslistofdict)
+        result = merge_struct(copy.deepcopy(v1),copy.deepcopy(v2),aslistofdict)
+        # compare item by item, identity for nan
+        assert repr(result) == repr(expected)
+        assert merge_lists(l1,l2) == reference_merge_struct(l1,l2)
+
+
+def test_value_fingerprint():
+    values = [random_element() for _ in range(500)] + \
+             [{"a" : [1,{"b" : 2}]}, {"a" : [1.0,{"b" : True}]}, [1,2], (1,2), [(1,2)], [[1,2]]]
+    for v1 in values:
+        for v2 in values:
+            try:
+                fp1, fp2 = value_fingerprint(v1), value_fingerprint(v2)
+            except TypeError:
+                continue
+            assert (fp1 == fp2) == (v1 == v2), (v1,v2)
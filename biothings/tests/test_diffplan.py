@@ -0,0 +1,120 @@
+import json, time, threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from biothings.utils.diffplan import VersionPlanner, final_version
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # path => content
+    files = {}
+    active = 0
+    max_active = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.active,self.server.max_active)
+        time.sleep(0.05)
+        try:
+            content = self.server.files.get(self.path)
+            if content is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length",str(len(content)))
+            self.end_headers()
+            if body:
+                self.wfile.write(content)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+
+def publish(server, full_sizes, incrementals):
+    """
+    Publish full releases ({version:size}) and incremental ones
+    ({"old.new":[file sizes]}), as a BioThings hub would do
+    """
+    base = "http://localhost:%d" % server.server_address[1]
+    files = {}
+    for version,size in full_sizes.items():
+        meta = {"type" : "full", "build_version" : version, "metadata" : {"snapshot_name" : version}}
+        if size is not None:
+            meta["metadata"]["size"] = size
+        files["/app/%s.json" % version] = json.dumps(meta).encode()
+    for version,sizes in incrementals.items():
+        meta = {"type" : "incremental", "build_version" : version, "require_version" : version.split(".")[0],
+                "metadata" : {"url" : "%s/diff/%s/metadata.json" % (base,version)}}
+        files["/app/%s.json" % version] = json.dumps(meta).encode()
+        diff_files = []
+        for i,size in enumerate(sizes):
+            files["/diff/%s/%d.pyobj" % (version,i)] = b"x" * size
+            # sizes not published for odd files, planner has to ask the server
+            entry = {"name" : "%d.pyobj" % i, "md5sum" : "abc"}
+            if i % 2 == 0:
+                entry["size"] = size
+            diff_files.append(entry)
+        files["/diff/%s/metadata.json" % version] = json.dumps({"diff" : {"files" : diff_files}}).encode()
+    server.files = files
+    return sorted(list(full_sizes) + list(incrementals))
+
+
+def start_server():
+    server = Server(("localhost",0),Handler)
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    planner = VersionPlanner(lambda v: "http://localhost:%d/app/%s.json" % (server.server_address[1],v))
+    return server, planner
+
+
+def test_chained_incrementals():
+    server, planner = start_server()
+    versions = publish(server,{"1" : 10000, "4" : 10000},
+                       {"1.2" : [100,200], "2.3" : [300], "3.4" : [50,50,50], "1.3" : [5000]})
+    plan = planner.get_plan(versions,"1","4")
+    assert [s["version"] for s in plan] == ["1.2","2.3","3.4"]
+    assert [s["size"] for s in plan] == [300,300,150]
+    assert plan[0]["files"][1]["url"].endswith("/diff/1.2/1.pyobj")
+    # metadata was fetched concurrently
+    assert server.max_active > 1
+    server.shutdown()
+
+
+def test_full_is_cheaper():
+    server, planner = start_server()
+    versions = publish(server,{"1" : 10000, "4" : 100},{"1.2" : [100,200], "2.3" : [300], "3.4" : [50]})
+    assert [s["version"] for s in planner.get_plan(versions,"1","4")] == ["4"]
+    # nothing applied yet, only a full release can be used
+    assert [s["version"] for s in planner.get_plan(versions,None,"4")] == ["4"]
+    server.shutdown()
+
+
+def test_unknown_full_size():
+    server, planner = start_server()
+    versions = publish(server,{"1" : None, "3" : None},{"1.2" : [10**9], "2.3" : [10**9]})
+    # full release size unknown, incrementals preferred whatever their size
+    assert [s["version"] for s in planner.get_plan(versions,"1","3")] == ["1.2","2.3"]
+    # no other way
+    assert [s["version"] for s in planner.get_plan(versions,"0","3")] == ["3"]
+    server.shutdown()
+
+
+def test_no_path():
+    server, planner = start_server()
+    versions = publish(server,{"1" : 100},{"1.2" : [100], "3.4" : [100]})
+    assert planner.get_plan(versions,"1","4") is None
+    assert planner.get_plan(versions,"2","2") == []
+    assert final_version("1.2") == "2"
+    server.shutdown()
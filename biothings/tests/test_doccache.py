@@ -0,0 +1,49 @@
+import os, tempfile
+
+from biothings.utils.doccache import write_through, read_docs
+
+
+class Marker(object):
+
+    def __init__(self, state):
+        self.state = state
+
+
+def parse(num, fail_at=None):
+    for i in range(num):
+        if i == fail_at:
+            raise ValueError("parse error")
+        if i % 100 == 0:
+            yield Marker(i)
+        yield {"_id" : "doc%d" % i, "val" : i, "sub" : {"l" : [i,str(i)], "f" : i / 3}}
+
+
+def test_write_read():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,"cache","docs.bson.gz")
+        items = list(write_through(parse(1000),path))
+        assert os.listdir(os.path.dirname(path)) == ["docs.bson.gz"]
+        docs = [d for d in items if isinstance(d,dict)]
+        assert list(read_docs(path)) == docs
+        # markers restored, resuming after one of them
+        restored = list(read_docs(path,marker_class=Marker))
+        assert [m.state for m in restored if isinstance(m,Marker)] == list(range(0,1000,100))
+        assert list(read_docs(path,from_marker=500)) == docs[500:]
+
+
+def test_incomplete():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,"docs.bson.gz")
+        try:
+            list(write_through(parse(1000,fail_at=700),path))
+            assert False, "should have raised"
+        except ValueError:
+            pass
+        # partially consumed
+        gen = write_through(parse(1000),path)
+        next(gen)
+        gen.close()
+        # can't be encoded (non-string keys)
+        docs = list(write_through(iter([{"_id" : 1},{"_id" : 2, 3 : "x"}]),path))
+        assert len(docs) == 2
+        assert os.listdir(tmpdir) == []
@@ -0,0 +1,169 @@
+import os, time, tempfile, threading
+import asyncio
+
+from biothings.tests.hubapp import setup_app
+# dumpers need a configured application
+setup_app()
+
+from biothings.hub.dataload import dumper as dumper_mod
+from biothings.hub.dataload.dumper import BaseDumper, DumperException
+from biothings.utils.hub_db import get_src_dump
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+class HangingDumper(BaseDumper):
+    """remote_is_better() waits for the server until connection is closed"""
+
+    SRC_NAME = "hanging"
+    CHECK_TIMEOUT = 0.5
+
+    def prepare_client(self):
+        self.client = Connection()
+
+    def need_prepare(self):
+        return not self.client
+
+    def release_client(self):
+        self.client.close()
+        self.client = None
+
+    def remote_is_better(self, remotefile, localfile):
+        self.connection = self.client
+        self.connection.closed.wait(10)
+        raise EOFError("connection closed")
+
+    def create_todump_list(self, force=False, **kwargs):
+        self.to_dump.append({"remote" : "file1", "local" : "file1"})
+        self.remote_is_better("file2","file2")
+        self.to_dump.append({"remote" : "file2", "local" : "file2"})
+
+
+class ThreadJobManager(object):
+    """What check() needs from JobManager"""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    @asyncio.coroutine
+    def defer_to_thread(self, pinfo, func):
+        # returns job's future once submitted, as JobManager does
+        yield from asyncio.sleep(0)
+        return self.loop.run_in_executor(None,func)
+
+    # downloads too
+    defer_to_process = defer_to_thread
+
+
+def test_check_timeout():
+    loop = asyncio.get_event_loop()
+    dumper = HangingDumper(src_root_folder=tempfile.gettempdir())
+    t0 = time.time()
+    try:
+        loop.run_until_complete(dumper.check(ThreadJobManager(loop)))
+        assert False, "should have raised"
+    except DumperException:
+        pass
+    assert time.time() - t0 < 5
+    # connection closed to interrupt remote_is_better(), client can't be used again
+    assert dumper.connection.closed.is_set()
+    assert dumper.cancelled and dumper.to_dump == []
+    try:
+        dumper.client
+        assert False, "should have raised"
+    except DumperException:
+        pass
+
+
+def test_cancel_check():
+    loop = asyncio.get_event_loop()
+    dumper = HangingDumper(src_root_folder=tempfile.gettempdir())
+    dumper.CHECK_TIMEOUT = None
+    task = asyncio.ensure_future(dumper.check(ThreadJobManager(loop)))
+    loop.run_until_complete(asyncio.sleep(0.2))
+    assert not task.done()
+    task.cancel()
+    try:
+        loop.run_until_complete(task)
+        assert False, "should have been cancelled"
+    except asyncio.CancelledError:
+        pass
+    assert dumper.connection.closed.is_set()
+    assert dumper.cancelled and dumper.to_dump == []
+
+
+def test_progress():
+    dumper = HangingDumper(src_root_folder=tempfile.gettempdir())
+    get_src_dump().save({"_id" : "hanging", "download" : {"status" : "downloading"}})
+    dumper.progress = {"started" : time.time()}
+    files = [{"remote" : "f%d" % i, "local" : "f%d" % i, "status" : "done", "size" : 10} for i in range(3)]
+    dumper.update_progress(files,force=True)
+    # saved from status thread
+    dumper_mod._status_executor.submit(lambda: None).result()
+    download = get_src_dump().find_one({"_id" : "hanging"})["download"]
+    assert download["status"] == "downloading"
+    assert download["progress"]["done"] == 3 and download["progress"]["size"] == 30
+    # files are only saved with dump's status
+    assert not "files" in download["progress"] and dumper.progress["files"] == files
+
+
+class DatedDumper(BaseDumper):
+    """Release is the dump's date, content doesn't always change"""
+
+    SRC_NAME = "dated"
+    STOP_IF_UNCHANGED = True
+    CONTENT = None
+
+    def prepare_client(self):
+        self.client = Connection()
+
+    def need_prepare(self):
+        return not self.client
+
+    def release_client(self):
+        self.client = None
+
+    def create_todump_list(self, force=False, **kwargs):
+        self.release = self.next_release
+        self.to_dump.append({"remote" : "data.txt", "local" : os.path.join(self.new_data_folder,"data.txt")})
+
+    def download(self, remotefile, localfile):
+        self.prepare_local_folders(localfile)
+        with open(localfile,"wb") as fout:
+            fout.write(self.CONTENT)
+        tap = self.get_content_tap(localfile)
+        tap.feed(0,self.CONTENT)
+        return self.make_download_result(remotefile,localfile,tap)
+
+    def post_dump(self):
+        # eg. uncompressing
+        os.rename(os.path.join(self.new_data_folder,"data.txt"),os.path.join(self.new_data_folder,"data.json"))
+
+
+def test_stop_if_unchanged():
+    loop = asyncio.get_event_loop()
+    root = tempfile.mkdtemp()
+    def dump(release, content=b"same content"):
+        dumper = DatedDumper(src_root_folder=root)
+        dumper.next_release = release
+        dumper.CONTENT = content
+        loop.run_until_complete(dumper.dump(job_manager=ThreadJobManager(loop)))
+        return get_src_dump().find_one({"_id" : "dated"})
+    doc = dump("20260101")
+    assert doc["release"] == "20260101" and doc["download"]["status"] == "success"
+    assert os.listdir(doc["data_folder"]) == ["data.json"]
+    # same content, new date: previous (post-processed) release is kept
+    doc = dump("20260102")
+    assert doc["release"] == "20260101" and doc["data_folder"] == os.path.join(root,"20260101")
+    assert doc["download"]["status"] == "success"
+    assert sorted(os.listdir(root)) == ["20260101"]
+    # new content
+    doc = dump("20260103",b"new content")
+    assert doc["release"] == "20260103" and os.listdir(doc["data_folder"]) == ["data.json"]
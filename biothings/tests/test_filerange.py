@@ -0,0 +1,58 @@
+import os, tempfile
+
+from biothings.utils import bgzf
+from biothings.utils.filerange import split_file, get_size
+from biothings.utils.common import anyfile, open_anyfile
+from biothings.utils.dataload import tabfile_feeder
+
+
+HEADER = "id\tname\tvalue\n"
+LINES = ["%d\tname%d\t%s\n" % (i,i,"x" * (i % 97)) for i in range(20000)]
+
+
+def write_files(tmpdir):
+    plain = os.path.join(tmpdir,"data.tsv")
+    with open(plain,"w") as fout:
+        fout.write(HEADER + "".join(LINES))
+    gz = os.path.join(tmpdir,"data.tsv.gz")
+    with bgzf.BGZFWriter(gz) as fout:
+        fout.write((HEADER + "".join(LINES)).encode())
+    return plain, gz
+
+
+def test_split_lines():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for path in write_files(tmpdir):
+            assert get_size(path) == len(HEADER + "".join(LINES))
+            for parts in (1,3,7,50):
+                ranges = split_file(path,parts=parts,header=1)
+                assert len(ranges) == parts
+                assert [r.num for r in ranges] == list(range(parts))
+                content = []
+                for r in ranges:
+                    with open_anyfile(r) as fin:
+                        content.extend(fin.readlines())
+                # each line in one range, in order, header only once
+                assert content == [HEADER] + LINES
+            ranges = split_file(path,range_size=100000)
+            assert len(ranges) == get_size(path) // 100000 + 1
+
+
+def test_propagate_header():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        plain, gz = write_files(tmpdir)
+        for path in (plain,gz):
+            ranges = split_file(path,parts=4,header=1,propagate_header=True)
+            rows = []
+            for r in ranges:
+                in_f = anyfile(r)
+                assert in_f.readline() == HEADER
+                in_f.close()
+                rows.extend(tabfile_feeder(r,header=1))
+            assert [row[0] for row in rows] == [str(i) for i in range(len(LINES))]
+        # more parts than lines
+        small = os.path.join(tmpdir,"small.tsv")
+        open(small,"w").write(HEADER + "".join(LINES[:3]))
+        ranges = split_file(small,parts=10,header=1,propagate_header=True)
+        assert len(ranges) <= 3
+        assert sum([len(list(tabfile_feeder(r,header=1))) for r in ranges]) == 3
@@ -0,0 +1,208 @@
+import os, time, socket, tempfile, threading
+import socketserver
+from datetime import datetime
+
+from biothings.utils.ftp import FTPSession, parse_list_line
+
+
+FILES = {
+    "data/a.txt" : (b"a" * 10, "20170102030405"),
+    "data/b.txt" : (b"b" * 20, "20170203040506"),
+    "data/c.txt" : (b"c" * 30, "20170304050607"),
+}
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    mlsd = True
+    # close control connection on next command
+    drop = False
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Minimal FTP stand-in, only what's needed by ftplib for these tests"""
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def send_data(self, data):
+        self.reply("150 Opening data connection")
+        conn, _ = self.pasv.accept()
+        conn.sendall(data)
+        conn.close()
+        self.pasv.close()
+        self.reply("226 Transfer complete")
+
+    def listing(self, path, mlsd):
+        lines = []
+        for name,(data,mtime) in sorted(FILES.items()):
+            if os.path.dirname(name) != (path or "data"):
+                continue
+            if mlsd:
+                lines.append("type=file;size=%d;modify=%s; %s" % (len(data),mtime,os.path.basename(name)))
+            else:
+                dt = datetime.strptime(mtime,"%Y%m%d%H%M%S")
+                lines.append("-rw-r--r--   1 ftp ftp %8d %s %s" % \
+                        (len(data),dt.strftime("%b %d  %Y"),os.path.basename(name)))
+        return ("\r\n".join(lines) + "\r\n").encode()
+
+    def handle(self):
+        self.reply("220 welcome")
+        cwd = ""
+        for line in self.rfile:
+            line = line.decode().strip()
+            cmd, _, arg = line.partition(" ")
+            cmd = cmd.upper()
+            if self.server.drop:
+                self.server.drop = False
+                return
+            self.server.commands.append(cmd)
+            path = arg and (cwd and cwd + "/" + arg or arg)
+            if cmd == "USER":
+                self.reply("331 password please")
+            elif cmd == "PASS":
+                self.reply("230 logged in")
+            elif cmd in ("TYPE","NOOP","OPTS"):
+                self.reply("200 OK")
+            elif cmd == "CWD":
+                cwd = arg.strip("/")
+                self.reply("250 OK")
+            elif cmd == "PWD":
+                self.reply('257 "/%s"' % cwd)
+            elif cmd == "PASV":
+                self.pasv = socket.socket()
+                self.pasv.bind(("127.0.0.1",0))
+                self.pasv.listen(1)
+                port = self.pasv.getsockname()[1]
+                self.reply("227 Entering Passive Mode (127,0,0,1,%d,%d)" % (port >> 8,port & 0xff))
+            elif cmd in ("MLSD","LIST") and (cmd == "LIST" or self.server.mlsd) and \
+                    not [n for n in FILES if os.path.dirname(n) == ((arg and path or cwd) or "data")]:
+                self.pasv.close()
+                self.reply("550 No such file or directory")
+            elif cmd == "MLSD" and self.server.mlsd:
+                self.send_data(self.listing(arg and path or cwd,True))
+            elif cmd == "LIST":
+                self.send_data(self.listing(arg and path or cwd,False))
+            elif cmd in ("MDTM","SIZE","RETR") and path in FILES:
+                data, mtime = FILES[path]
+                if cmd == "MDTM":
+                    self.reply("213 %s" % mtime)
+                elif cmd == "SIZE":
+                    self.reply("213 %d" % len(data))
+                else:
+                    self.send_data(data)
+            elif cmd == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("500 unknown command")
+
+
+def start_server(**kwargs):
+    server = Server(("127.0.0.1",0),Handler)
+    server.commands = []
+    for k,v in kwargs.items():
+        setattr(server,k,v)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+
+def test_listing_with_mlsd():
+    server = start_server()
+    # connects on first command
+    session = FTPSession("127.0.0.1",cwd="data",port=server.server_address[1],keepalive=None)
+    try:
+        for name in ["a.txt","b.txt","c.txt"]:
+            data, mtime = FILES["data/" + name]
+            assert session.get_size(name) == len(data)
+            assert session.get_mtime(name) == int(time.mktime(datetime.strptime(mtime,"%Y%m%d%H%M%S").timetuple()))
+        # one listing for the whole directory, no per-file command
+        assert server.commands.count("MLSD") == 1
+        assert not [c for c in server.commands if c in ("MDTM","SIZE","LIST")]
+        # missing directory doesn't mean MLSD isn't supported
+        assert session.listing.get("missing/d.txt") is None
+        assert session.listing.use_mlsd
+        assert server.commands.count("MLSD") == 2 and not "LIST" in server.commands
+    finally:
+        session.close()
+        server.shutdown()
+
+
+def test_listing_fallback_to_list():
+    server = start_server(mlsd=False)
+    session = FTPSession("127.0.0.1",cwd="data",port=server.server_address[1],keepalive=None)
+    try:
+        assert session.get_size("b.txt") == 20
+        assert session.get_size("c.txt") == 30
+        # LIST only has a day resolution for old files
+        local = time.mktime(datetime(2017,2,3,1,0,0).timetuple())
+        assert not session.is_newer("b.txt",local)
+        assert session.is_newer("b.txt",local - 86400)
+        assert server.commands.count("LIST") == 1
+        assert not [c for c in server.commands if c in ("MDTM","SIZE")]
+    finally:
+        session.close()
+        server.shutdown()
+
+
+def test_reconnect():
+    server = start_server()
+    session = FTPSession("127.0.0.1",cwd="data",port=server.server_address[1],keepalive=None)
+    try:
+        with tempfile.TemporaryFile() as fout:
+            session.retrbinary("RETR a.txt",fout.write)
+            # server closes connection, session logs in again
+            server.drop = True
+            session.retrbinary("RETR b.txt",fout.write)
+            fout.seek(0)
+            assert fout.read() == FILES["data/a.txt"][0] + FILES["data/b.txt"][0]
+        assert server.commands.count("PASS") == 2
+        # back to working dir after reconnecting
+        assert server.commands.count("CWD") == 2
+    finally:
+        session.close()
+        server.shutdown()
+
+
+def test_keepalive():
+    server = start_server()
+    session = FTPSession("127.0.0.1",cwd="data",port=server.server_address[1],keepalive=0.2)
+    try:
+        session.connect()
+        time.sleep(1)
+        assert "NOOP" in server.commands
+    finally:
+        session.close()
+        server.shutdown()
+
+
+def test_keepalive_max_idle():
+    server = start_server()
+    session = FTPSession("127.0.0.1",cwd="data",port=server.server_address[1],keepalive=0.2,max_idle=0.5)
+    try:
+        session.connect()
+        time.sleep(1)
+        # disconnected, keepalive stopped
+        assert session.ftp is None and session.keepalive_thread is None
+        del server.commands[:]
+        time.sleep(0.5)
+        assert "NOOP" not in server.commands
+        # reconnects when used again
+        assert session.pwd() == "/data"
+        assert session.keepalive_thread is not None
+    finally:
+        session.close()
+        server.shutdown()
+
+
+def test_parse_list_line():
+    now = datetime(2017,6,1)
+    name, facts = parse_list_line("-rw-r--r--   1 ftp  ftp   1234 Nov 28 15:00 file.gz",now=now)
+    assert name == "file.gz"
+    assert facts["size"] == 1234 and facts["precision"] == 60
+    # in the future, so it's from last year
+    assert datetime.fromtimestamp(facts["modify"]) == datetime(2016,11,28,15,0)
+    name, facts = parse_list_line("drwxr-xr-x   2 ftp  ftp   4096 Nov 28  2012 some dir",now=now)
+    assert name == "some dir" and facts["type"] == "dir" and facts["precision"] == 86400
+    assert parse_list_line("total 12") is None
@@ -0,0 +1,39 @@
+import time
+import asyncio
+
+from biothings.utils.loopmonitor import LoopMonitor
+
+
+def blocking_helper():
+    time.sleep(0.5)
+
+
+def process():
+    blocking_helper()
+
+
+@asyncio.coroutine
+def task():
+    yield from asyncio.sleep(0.1)
+    process()
+    yield from asyncio.sleep(0.1)
+
+
+def test_stall():
+    loop = asyncio.get_event_loop()
+    monitor = LoopMonitor(loop=loop,interval=0.02,threshold=0.2)
+    loop.call_soon(monitor.start)
+    try:
+        loop.run_until_complete(task())
+        metrics = monitor.get_metrics()
+        assert metrics["loop_stalls"] == 1
+        assert metrics["loop_lag_max"] >= 0.4
+        offenders = monitor.get_offenders()
+        assert len(offenders) == 1
+        key, info = list(offenders.items())[0]
+        # blocking function, not the coroutine calling it
+        assert key.startswith("blocking_helper (") and key.endswith("test_loopmonitor.py)")
+        assert info["count"] == 1 and info["total"] >= 0.4
+        assert "in task" in "".join(info["stack"])
+    finally:
+        monitor.stop()
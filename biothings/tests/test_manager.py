@@ -0,0 +1,73 @@
+import os, time, signal
+
+from concurrent.futures.process import BrokenProcessPool
+
+from biothings.tests.hubapp import setup_app
+setup_app()
+
+from biothings.utils.manager import RecyclingProcessPoolExecutor
+
+
+def getpid(delay=0.0):
+    time.sleep(delay)
+    return os.getpid()
+
+
+def wait_for(cond, timeout=10):
+    t0 = time.time()
+    while not cond():
+        assert time.time() - t0 < timeout, "timed out"
+        time.sleep(0.05)
+
+
+def test_recycle_after_tasks():
+    executor = RecyclingProcessPoolExecutor(max_workers=1,max_tasks_per_worker=2)
+    try:
+        pids = [executor.submit(getpid).result(timeout=10) for i in range(5)]
+        # a new worker process every 2 jobs
+        assert pids[0] == pids[1] and pids[2] == pids[3]
+        assert len(set(pids)) == 3
+        assert executor.recycled == 2
+    finally:
+        executor.shutdown()
+
+
+def test_killed_worker():
+    executor = RecyclingProcessPoolExecutor(max_workers=2)
+    try:
+        # killed while running a job: only that job fails
+        running = executor.submit(getpid,5)
+        other = executor.submit(getpid,0.5)
+        wait_for(lambda: all([w["pid"] for w in executor.get_workers()]))
+        os.kill(executor.get_workers()[0]["pid"],signal.SIGKILL)
+        try:
+            running.result(timeout=10)
+            assert False, "should have raised"
+        except BrokenProcessPool:
+            pass
+        assert other.result(timeout=10)
+        wait_for(lambda: executor.recycled == 1)
+        # killed while idle: queued job goes to another worker
+        pid = executor.submit(getpid).result(timeout=10)
+        slot = [s for s in executor._slots if s.pid == pid][0]
+        os.kill(pid,signal.SIGKILL)
+        wait_for(lambda: slot.executor._broken)
+        for i in range(4):
+            assert executor.submit(getpid).result(timeout=10) != pid
+        assert executor.recycled == 2
+    finally:
+        executor.shutdown()
+
+
+def test_recycle_wait():
+    executor = RecyclingProcessPoolExecutor(max_workers=2)
+    try:
+        pids = set([f.result(timeout=10) for f in [executor.submit(getpid,0.2) for i in range(4)]])
+        for i in range(3):
+            executor.recycle(wait=True)
+            assert executor._retired == []
+            f = executor.submit(getpid)
+            assert not f.result(timeout=10) in pids
+        assert executor.recycled == 6
+    finally:
+        executor.shutdown()
@@ -0,0 +1,42 @@
+import os, glob, pickle, tempfile
+
+from biothings.utils import metrics
+
+
+def test_fork_doesnt_count_parent_metrics():
+    orig = metrics.get_metrics_dir
+    with tempfile.TemporaryDirectory() as tmpdir:
+        metrics.get_metrics_dir = lambda: tmpdir
+        try:
+            # recorded by the hub, before workers are forked
+            metrics.record("dump","src",docs=10,size=100)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    metrics.record("upload","src",docs=5,flush=True)
+                finally:
+                    os._exit(0)
+            os.waitpid(pid,0)
+            registries = [metrics.get_registry()]
+            # as read by MetricsCollector, hub's own file skipped
+            for fn in glob.glob(os.path.join(tmpdir,"*.pickle")):
+                if os.path.basename(fn) == "%s.pickle" % os.getpid():
+                    continue
+                registries.append(pickle.load(open(fn,"rb")))
+            assert len(registries) == 2
+            totals = metrics.merge_registries(registries)
+            assert totals[("dump","src")]["docs"] == 10
+            assert totals[("dump","src")]["bytes"] == 100
+            assert totals[("upload","src")]["docs"] == 5
+        finally:
+            metrics.get_metrics_dir = orig
+            metrics._registry.clear()
+
+
+def test_prometheus_labels():
+    collector = metrics.MetricsCollector()
+    counters = metrics.new_counters()
+    counters["docs"] = 3
+    collector.samples.append((0,{("upload",'a"b\\c\nd') : counters}))
+    line = [l for l in collector.render_prometheus().splitlines() if l.startswith("biothings_hub_docs_total{")][0]
+    assert line == 'biothings_hub_docs_total{step="upload",source="a\\"b\\\\c\\nd"} 3'
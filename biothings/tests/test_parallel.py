@@ -0,0 +1,111 @@
+import os, time, socket, struct, pickle, multiprocessing
+import psutil
+
+from biothings.utils.parallel import RemoteWorkerExecutor, RemoteWorkerError, run_worker, run_jobs
+
+AUTHKEY = "secret"
+
+
+def square(x):
+    time.sleep(0.05)
+    return (os.getppid(), x * x)
+
+def fail(x):
+    raise ValueError("boom %s" % x)
+
+
+def start_workers(port, num, capacity=2, authkey=AUTHKEY):
+    workers = [multiprocessing.Process(target=run_worker,args=("localhost",port,capacity),
+                                       kwargs={"authkey" : authkey}) for i in range(num)]
+    for w in workers:
+        w.start()
+    return workers
+
+def wait_capacity(executor, capacity, timeout=10):
+    t0 = time.time()
+    while executor.capacity < capacity:
+        assert time.time() - t0 < timeout, "workers didn't connect"
+        time.sleep(0.05)
+
+
+def test_remote_workers():
+    executor = RemoteWorkerExecutor(host="localhost",authkey=AUTHKEY)
+    _, port = executor.start()
+    workers = start_workers(port,3)
+    try:
+        wait_capacity(executor,6)
+        results = run_jobs(square,range(30),executor=executor)
+        assert [r[1] for r in results] == [x * x for x in range(30)]
+        # jobs were spread over all workers (results come from workers' sub-processes)
+        assert len(set([r[0] for r in results])) == 3
+        assert executor.load == 0
+        # exceptions are sent back
+        f = executor.submit(fail,1)
+        try:
+            f.result(timeout=10)
+            assert False, "should have raised an exception"
+        except ValueError as e:
+            assert str(e) == "boom 1"
+    finally:
+        executor.shutdown()
+        for w in workers:
+            w.join(10)
+    assert not [w for w in workers if w.is_alive()]
+
+
+def test_lost_worker():
+    executor = RemoteWorkerExecutor(host="localhost",max_retries=1,authkey=AUTHKEY)
+    _, port = executor.start()
+    workers = start_workers(port,2,capacity=1)
+    try:
+        wait_capacity(executor,2)
+        futures = [executor.submit(square,x) for x in range(10)]
+        # kill one worker while running, its job is re-submitted to the other one
+        time.sleep(0.1)
+        children = psutil.Process(workers[0].pid).children()
+        workers[0].kill()
+        for child in children:
+            child.kill()
+        assert [f.result(timeout=10)[1] for f in futures] == [x * x for x in range(10)]
+    finally:
+        executor.shutdown()
+        for w in workers:
+            w.join(10)
+
+
+def test_unpicklable_job():
+    executor = RemoteWorkerExecutor(host="localhost",authkey=AUTHKEY)
+    executor.start()
+    try:
+        f = executor.submit(lambda: None)
+        assert isinstance(f.exception(timeout=1),RemoteWorkerError)
+    finally:
+        executor.shutdown()
+
+
+def test_authentication():
+    for func in (RemoteWorkerExecutor,lambda: run_worker("localhost",1)):
+        try:
+            func()
+            assert False, "should have raised"
+        except ValueError:
+            pass
+    executor = RemoteWorkerExecutor(authkey=AUTHKEY)
+    host, port = executor.start()
+    assert host == "127.0.0.1"
+    workers = start_workers(port,1,authkey="wrong")
+    try:
+        # unsigned message, never unpickled
+        sock = socket.create_connection((host,port))
+        data = pickle.dumps(("hello",{"capacity" : 10}))
+        sock.sendall(struct.pack("!Q",len(data)) + b"\0" * 32 + data)
+        assert sock.recv(1) == b"" # connection closed by hub
+        sock.close()
+        # worker with wrong key is disconnected too
+        workers[0].join(10)
+        assert not workers[0].is_alive()
+        assert executor.capacity == 0 and executor.get_workers() == []
+    finally:
+        executor.shutdown()
+        for w in workers:
+            w.kill()
@@ -0,0 +1,42 @@
+import os, pickle, tempfile
+
+from biothings.utils import resultchannel
+from biothings.utils.resultchannel import wrap_result, unwrap_result, ResultHandle
+
+
+class Counted(object):
+    """Count how many times instances are pickled"""
+    pickled = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        Counted.pickled += 1
+        return (Counted,(self.value,))
+
+
+def test_inline():
+    Counted.pickled = 0
+    res = wrap_result([Counted(i) for i in range(10)])
+    assert isinstance(res,ResultHandle) and res.mode == "inline"
+    # sent to the parent process
+    res = pickle.loads(pickle.dumps(res))
+    assert [c.value for c in unwrap_result(res)] == list(range(10))
+    # value pickled once, by wrap_result()
+    assert Counted.pickled == 10
+
+
+def test_large():
+    value = {"ids" : list(range(10000))}
+    modes = ["file"]
+    if resultchannel.shared_memory:
+        modes.append("shm")
+    for mode in modes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            res = wrap_result(value,threshold=1024,mode=mode,spill_dir=tmpdir)
+            assert res.mode == mode and res.size > 1024
+            assert unwrap_result(pickle.loads(pickle.dumps(res))) == value
+            # resources released once loaded
+            assert os.listdir(tmpdir) == []
+    assert unwrap_result("not wrapped") == "not wrapped"
@@ -0,0 +1,80 @@
+import os, json, tempfile
+import asyncio
+
+from biothings.hub.dataload.scheduler import DownloadScheduler
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_limits_and_order():
+    sched = DownloadScheduler(max_downloads=2)
+    started = []
+
+    @asyncio.coroutine
+    def download(dumper, host, priority=0, host_limit=None):
+        ticket = yield from sched.acquire(dumper,host,priority=priority,host_limit=host_limit)
+        started.append(dumper)
+        yield from asyncio.sleep(0.05)
+        sched.release(ticket,size=100)
+
+    @asyncio.coroutine
+    def main():
+        jobs = [asyncio.ensure_future(download("big","a",host_limit=1)) for _ in range(3)]
+        yield from asyncio.sleep(0)
+        jobs += [asyncio.ensure_future(download("small","b",priority=1)) for _ in range(2)]
+        yield from asyncio.gather(*jobs)
+
+    run(main())
+    # one connection to host "a" at a time, so "small" gets the second slot,
+    # then high priority downloads are started before queued "big" ones
+    assert started == ["big","small","small","big","big"]
+    stats = sched.get_throughputs()
+    assert stats["big"]["files"] == 3 and stats["big"]["bytes"] == 300
+    assert stats["small"]["throughput"] > 0
+    assert not sched.active and not sched.waiting
+
+
+def test_fair_share():
+    sched = DownloadScheduler(max_downloads=1)
+    started = []
+
+    @asyncio.coroutine
+    def main():
+        first = yield from sched.acquire("a","h")
+        waiting = [asyncio.ensure_future(sched.acquire(d,"h")) for d in ["a","a","b"]]
+        yield from asyncio.sleep(0)
+        for _ in range(3):
+            sched.release(first)
+            first = list(sched.active.values())[0]
+            started.append(first.dumper)
+        sched.release(first)
+        yield from asyncio.gather(*waiting)
+
+    run(main())
+    # "a" already had its turn, "b" goes before "a"'s other queued downloads
+    assert started == ["b","a","a"]
+
+
+def test_bandwidth_allocation():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sched = DownloadScheduler(bandwidth=3000,alloc_dir=tmpdir)
+
+        @asyncio.coroutine
+        def main():
+            t1 = yield from sched.acquire("low","h")
+            t2 = yield from sched.acquire("low","h")
+            rate = lambda t: json.load(open(t.alloc_file))["rate"]
+            assert rate(t1) == rate(t2) == 1500
+            t3 = yield from sched.acquire("high","h",priority=1)
+            # weighted by priority, split between dumper's downloads
+            assert rate(t3) == 2000 and rate(t1) == 500
+            sched.release(t3)
+            assert not os.path.exists(t3.alloc_file)
+            assert rate(t1) == 1500
+            sched.release(t1)
+            sched.release(t2)
+
+        run(main())
+        assert os.listdir(tmpdir) == []
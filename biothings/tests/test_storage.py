@@ -0,0 +1,253 @@
+import time, threading, random, tempfile, os
+
+from pymongo.errors import BulkWriteError, AutoReconnect
+
+from biothings.hub.dataload.storage import BasicStorage, MergerStorage
+from biothings.utils.inspect import inspect_docs, merge_inspect, merge_scalar_list
+
+
+class FakeCollection(object):
+    """Collection storing inserted docs, "latency" seconds per insert"""
+
+    def __init__(self, latency=0.0, fail_after=None):
+        self.docs = []
+        self.latency = latency
+        self.fail_after = fail_after
+        self.lock = threading.Lock()
+
+    def insert(self, doc_li, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            if self.fail_after is not None and len(self.docs) >= self.fail_after:
+                raise IOError("write failed")
+            self.docs.extend(doc_li)
+
+    def insert_many(self, doc_li, ordered=True):
+        ids = set([d["_id"] for d in self.docs])
+        errors = [{"code" : 11000, "op" : d} for d in doc_li if d["_id"] in ids]
+        inserted = [d for d in doc_li if not d["_id"] in ids]
+        self.insert(inserted)
+        if errors:
+            raise BulkWriteError({"nInserted" : len(inserted), "writeErrors" : errors})
+        return type("InsertManyResult",(),{"inserted_ids" : [d["_id"] for d in inserted]})
+
+    def find(self, query):
+        ids = query["_id"]["$in"]
+        return [d for d in self.docs if d["_id"] in ids]
+
+    def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            self.docs = [d for d in self.docs if d["_id"] != op._filter["_id"]] + [op._doc]
+
+
+def make_storage(col, klass=None, **attrs):
+    storage = (klass or BasicStorage)({"test" : col},"test")
+    for k,v in attrs.items():
+        setattr(storage,k,v)
+    return storage
+
+
+def docs(num, delay=0.0, fail_at=None, parsed=None):
+    for i in range(num):
+        if i == fail_at:
+            raise ValueError("parse failed")
+        if i % 10 == 0:
+            time.sleep(delay)
+        if parsed is not None:
+            parsed.append(i)
+        yield {"_id" : i}
+
+
+def test_overlap():
+    timings = {}
+    for writers in (0,1):
+        col = FakeCollection(latency=0.02)
+        storage = make_storage(col,writers=writers)
+        t0 = time.time()
+        assert storage.process(docs(200,delay=0.02),10) == 200
+        timings[writers] = time.time() - t0
+        # whole processing time, parsing included
+        assert storage.stats["docs"] == 200 and storage.stats["batches"] == 20
+        assert 0.4 <= storage.stats["elapsed_s"] <= timings[writers]
+        assert storage.stats["docs_per_s"] <= 200 / 0.4
+        assert storage.stats["parse_s"] >= 0.4 and storage.stats["write_s"] >= 0.4
+        # one writer: stored in order
+        assert [d["_id"] for d in col.docs] == list(range(200))
+    # parsing (0.4s) and writing (0.4s) overlap
+    assert timings[1] < timings[0] * 0.75
+    col = FakeCollection(latency=0.01)
+    assert make_storage(col,writers=4).process(docs(500),10) == 500
+    assert sorted([d["_id"] for d in col.docs]) == list(range(500))
+
+
+def test_errors_and_backpressure():
+    # parsing error: already parsed batches are stored, then error is raised
+    col = FakeCollection(latency=0.01)
+    try:
+        make_storage(col).process(docs(100,fail_at=55),10)
+        assert False, "should have raised"
+    except ValueError:
+        pass
+    assert len(col.docs) == 50
+    # writing error stops parsing, even if writers are slow
+    col = FakeCollection(latency=0.05,fail_after=20)
+    parsed = []
+    try:
+        make_storage(col,writers=1,max_pending_batches=2).process(docs(1000,parsed=parsed),10)
+        assert False, "should have raised"
+    except IOError:
+        pass
+    # parsing is bounded by pending batches
+    assert len(parsed) <= 20 + 10 * (2 + 3)
+
+
+def test_merger():
+    random.seed(42)
+    rows = [(random.randint(0,300),i) for i in range(3000)]
+    def parse():
+        for _id,val in rows:
+            yield {"_id" : _id, "vals" : [val], "name" : "doc%d" % _id}
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # all in memory, then with sorted runs on disk, bounded by count or size
+        for limits,num_runs in (({"max_docs_in_memory" : 10000},0),
+                                ({"max_docs_in_memory" : 50},30),
+                                ({"max_memory" : 10000},9)):
+            col = FakeCollection()
+            storage = make_storage(col,MergerStorage,spill_dir=tmpdir,**limits)
+            runs = []
+            def write_run(docs, spill_dir, orig=storage.write_run):
+                runs.append(len(docs))
+                return orig(docs,spill_dir)
+            storage.write_run = write_run
+            assert storage.process(parse(),100) == len(set([r[0] for r in rows]))
+            assert len(runs) == num_runs
+            assert os.listdir(tmpdir) == []
+            # each _id written once
+            assert len(col.docs) == len(set([d["_id"] for d in col.docs]))
+            results.append(dict([(d["_id"],d) for d in col.docs]))
+    assert results[0] == results[1]
+    for _id,doc in results[0].items():
+        # merge_struct(new,existing): last parsed values first
+        assert doc["vals"] == [v for i,v in reversed(rows) if i == _id]
+        assert doc["name"] == "doc%d" % _id
+    # docs already stored (eg. by another process) are merged too
+    col = FakeCollection()
+    col.insert([{"_id" : 1, "vals" : ["before"]}])
+    make_storage(col,MergerStorage,max_docs_in_memory=2).process(({"_id" : i % 3, "vals" : [i]} for i in range(9)),2)
+    docs = dict([(d["_id"],d) for d in col.docs])
+    assert len(col.docs) == 3
+    assert docs[1]["vals"] == [7,4,1,"before"] and docs[2]["vals"] == [8,5,2]
+
+
+def test_stored_progress():
+    col = FakeCollection()
+    orig_insert = col.insert
+    def insert(doc_li, **kwargs):
+        # batches complete out of order
+        time.sleep(random.random() * 0.01)
+        orig_insert(doc_li)
+    col.insert = insert
+    progress = []
+    def on_stored(count):
+        # all documents up to "count" are stored
+        assert set(range(count)) <= set([d["_id"] for d in col.docs])
+        progress.append(count)
+    storage = make_storage(col,writers=4)
+    storage.on_stored = on_stored
+    assert storage.process(docs(1000),10) == 1000
+    assert progress == sorted(progress) and progress[-1] == 1000
+    # resuming: documents already stored are ignored
+    col = FakeCollection()
+    col.insert([{"_id" : i} for i in range(15)])
+    storage = make_storage(col,resumed=True)
+    assert storage.process(docs(30),10) == 30
+    assert sorted([d["_id"] for d in col.docs]) == list(range(30))
+
+
+def test_inspect():
+    def parse(start, end):
+        for i in range(start,end):
+            doc = {"_id" : "d%d" % i, "pos" : i, "name" : "gene %d" % i if i % 2 else "g%d" % i}
+            if i % 3 == 0:
+                doc["xref"] = [{"db" : "x", "id" : i}]
+            else:
+                doc["xref"] = {"db" : "y", "id" : str(i)}
+            if i == 250:
+                doc["extra"] = {"score" : 1.5}
+            yield doc
+    expected = inspect_docs(parse(0,300),mode="mapping")
+    # one storage per job, results merged
+    results = []
+    for start in (0,100,200):
+        storage = make_storage(FakeCollection(),inspect_mode="mapping",writers=3)
+        assert storage.process(parse(start,start + 100),7) == 100
+        results.append(storage.inspected)
+    merged = {}
+    for res in results + results:
+        # merging again changes nothing
+        merge_inspect(merged,res)
+    merge_scalar_list(merged,"mapping")
+    assert merged == expected
+    assert merged["name"] == {str : {"split" : {}}}
+    assert merged["extra"] == {"score" : {float : {}}}
+    # not inspected by default, disabled if documents can't be inspected
+    storage = make_storage(FakeCollection())
+    storage.process(parse(0,10),5)
+    assert storage.inspected == {}
+    storage = make_storage(FakeCollection(),inspect_mode="type")
+    storage.process(({"_id" : i, "v" : object()} for i in range(3)),5)
+    assert storage.inspected is None
+
+
+def test_concurrent_inspect():
+    class SlowInspectStorage(BasicStorage):
+        def inspect_batch(self, doc_li):
+            time.sleep(0.05)
+            return super(SlowInspectStorage,self).inspect_batch(doc_li)
+    storage = make_storage(FakeCollection(),SlowInspectStorage,inspect_mode="type",writers=4)
+    t0 = time.time()
+    assert storage.process(({"_id" : i, "v" : i} for i in range(80)),10) == 80
+    # batches inspected by writers at the same time (0.4s one after another)
+    assert time.time() - t0 < 0.3
+    assert storage.inspected == inspect_docs([{"_id" : 0, "v" : 0}],mode="type")
+
+
+def test_retries():
+    col = FakeCollection()
+    orig_insert = col.insert
+    failed = set()
+    def insert(doc_li, **kwargs):
+        # first attempt fails for one batch out of 10
+        first = doc_li and doc_li[0]["_id"]
+        if first % 100 == 0 and not first in failed:
+            failed.add(first)
+            # connection lost after part of the batch was stored
+            orig_insert(doc_li[:len(doc_li) // 2])
+            raise AutoReconnect("connection lost")
+        orig_insert(doc_li)
+    col.insert = insert
+    storage = make_storage(col,retry_delay=0.001)
+    assert storage.process(docs(500),10) == 500
+    assert sorted([d["_id"] for d in col.docs]) == list(range(500))
+    assert storage.stats["docs"] == 500 and storage.stats["batches"] == 50
+    assert storage.stats["retries"] == 5
+    # too many failures
+    col = FakeCollection()
+    attempts = []
+    def insert(doc_li, **kwargs):
+        attempts.append(len(doc_li))
+        raise AutoReconnect("connection lost")
+    col.insert = insert
+    try:
+        make_storage(col,retry_delay=0.001,max_retries=2).process(docs(10),10)
+        assert False, "should have raised"
+    except AutoReconnect:
+        pass
+    assert attempts == [10,10,10]
+    # duplicates in input are still errors, unless retrying/resuming
+    try:
+        make_storage(FakeCollection(),writers=1).process(({"_id" : i % 5} for i in range(10)),5)
+        assert False, "should have raised"
+    except BulkWriteError:
+        pass
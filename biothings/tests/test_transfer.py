@@ -0,0 +1,223 @@
+import os, re, gzip, json, time, hashlib, tempfile, threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import requests
+
+from biothings.utils import transfer
+
+
+DATA = os.urandom(1024 * 1024 + 17)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # settings changed by tests
+    ranges = True
+    # Accept-Ranges advertised but range requests answered with whole content
+    ignore_ranges = False
+    # expected Authorization header
+    auth = None
+    # drop connection after sending that many bytes (once per request, while > 0)
+    drop_after = None
+    drops = 0
+    sent = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send_headers(self, status, length, start=None, end=None):
+        self.send_response(status)
+        self.send_header("Content-Length",str(length))
+        self.send_header("ETag",'"abc"')
+        if self.server.ranges:
+            self.send_header("Accept-Ranges","bytes")
+        if start is not None:
+            self.send_header("Content-Range","bytes %d-%d/%d" % (start,end,len(DATA)))
+        self.end_headers()
+
+    def authorized(self):
+        if self.server.auth and self.headers.get("Authorization") != self.server.auth:
+            self.send_headers(401,0)
+            return False
+        return True
+
+    def do_HEAD(self):
+        if self.authorized():
+            self.send_headers(200,len(DATA))
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        rng = self.headers.get("Range")
+        if rng and self.server.ranges and not self.server.ignore_ranges:
+            start, end = re.match(r"bytes=(\d+)-(\d*)",rng).groups()
+            start = int(start)
+            end = end and int(end) or len(DATA) - 1
+            self.send_headers(206,end - start + 1,start,end)
+        else:
+            start, end = 0, len(DATA) - 1
+            self.send_headers(200,len(DATA))
+        data = DATA[start:end+1]
+        if self.server.drop_after and self.server.drops > 0:
+            self.server.drops -= 1
+            data = data[:self.server.drop_after]
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.sent += len(data)
+        self.close_connection = True
+
+
+def start_server(**kwargs):
+    server = Server(("localhost",0),Handler)
+    server.lock = threading.Lock()
+    for k,v in kwargs.items():
+        setattr(server,k,v)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server, "http://localhost:%d/file.bin" % server.server_address[1]
+
+
+def test_segmented_download():
+    server, url = start_server()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        localfile = os.path.join(tmpdir,"file.bin")
+        res = transfer.download(requests.Session(),url,localfile,segments=4,min_segment_size=1024)
+        assert res.headers["ETag"] == '"abc"'
+        assert open(localfile,"rb").read() == DATA
+        assert not os.path.exists(transfer.get_segment_map_path(localfile))
+        # each byte was sent once
+        assert server.sent == len(DATA)
+    server.shutdown()
+
+
+def test_dropped_connections_are_retried():
+    server, url = start_server(drop_after=1000,drops=3)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        localfile = os.path.join(tmpdir,"file.bin")
+        transfer.download(requests.Session(),url,localfile,segments=4,min_segment_size=1024)
+        assert open(localfile,"rb").read() == DATA
+        # retries started from last received byte
+        assert server.sent == len(DATA)
+    server.shutdown()
+
+
+def test_interrupted_download_is_resumed():
+    server, url = start_server(drop_after=100000,drops=100)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        localfile = os.path.join(tmpdir,"file.bin")
+        try:
+            transfer.download(requests.Session(),url,localfile,segments=2,min_segment_size=1024,max_retries=1)
+            assert False, "download should have failed"
+        except transfer.TransferError:
+            pass
+        segmap = transfer.SegmentMap.load(transfer.get_segment_map_path(localfile))
+        assert segmap.remaining() == len(DATA) - server.sent
+        server.drops = 0
+        transfer.download(requests.Session(),url,localfile,segments=2,min_segment_size=1024)
+        assert open(localfile,"rb").read() == DATA
+        # only missing bytes were downloaded
+        assert server.sent == len(DATA)
+        assert not os.path.exists(transfer.get_segment_map_path(localfile))
+    server.shutdown()
+
+
+def test_no_range_support():
+    server, url = start_server(ranges=False,drop_after=1000,drops=1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        localfile = os.path.join(tmpdir,"file.bin")
+        transfer.download(requests.Session(),url,localfile,segments=4,min_segment_size=1024)
+        assert open(localfile,"rb").read() == DATA
+        # restarted from scratch after dropped connection
+        assert server.sent == len(DATA) + 1000
+    server.shutdown()
+
+
+def test_range_ignored():
+    server, url = start_server(ignore_ranges=True)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        localfile = os.path.join(tmpdir,"file.bin")
+        tap = transfer.ContentTap([transfer.Checksums()])
+        transfer.download(requests.Session(),url,localfile,segments=4,min_segment_size=1024,tap=tap)
+        assert open(localfile,"rb").read() == DATA
+        assert tap.finish(localfile)["md5"] == hashlib.md5(DATA).hexdigest()
+        assert not os.path.exists(transfer.get_segment_map_path(localfile))
+    server.shutdown()
+
+
+def test_segments_use_session_settings():
+    server, url = start_server(auth="Basic dXNlcjpwYXNz") # user:pass
+    with tempfile.TemporaryDirectory() as tmpdir:
+        localfile = os.path.join(tmpdir,"file.bin")
+        session = requests.Session()
+        session.auth = ("user","pass")
+        session.verify = False
+        transfer.download(session,url,localfile,segments=4,min_segment_size=1024)
+        assert open(localfile,"rb").read() == DATA
+        assert server.sent == len(DATA)
+        clone = transfer.clone_session(session)
+        assert clone.auth == ("user","pass") and clone.verify is False
+    server.shutdown()
+
+
+def test_content_tap():
+    server, url = start_server(drop_after=1000,drops=2)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        localfile = os.path.join(tmpdir,"file.bin")
+        tap = transfer.ContentTap([transfer.Checksums(("md5","sha256"))])
+        transfer.download(requests.Session(),url,localfile,segments=4,min_segment_size=1024,tap=tap)
+        res = tap.finish(localfile)
+        assert res["md5"] == hashlib.md5(DATA).hexdigest()
+        assert res["sha256"] == hashlib.sha256(DATA).hexdigest()
+        # out-of-order segments were buffered, not read again from the file
+        assert tap.reread == 0
+        # small buffer: chunks too far ahead are read back from the file
+        tap = transfer.ContentTap([transfer.Checksums()],max_buffer=1024)
+        half = len(DATA) // 2
+        tap.feed(half,DATA[half:half + 1000])
+        tap.feed(half + 1000,DATA[half + 1000:])
+        tap.feed(0,DATA[:half])
+        assert tap.finish(localfile)["md5"] == hashlib.md5(DATA).hexdigest()
+        assert tap.reread == len(DATA) - half - 1000
+    server.shutdown()
+
+
+def test_content_tap_decompress():
+    global DATA
+    orig = DATA
+    # two gzip members, as produced by "cat a.gz b.gz"
+    content = os.urandom(300000)
+    DATA = gzip.compress(content[:100000]) + gzip.compress(content[100000:])
+    server, url = start_server(ranges=False,drop_after=5000,drops=1)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            localfile = os.path.join(tmpdir,"file.txt.gz")
+            tap = transfer.ContentTap([transfer.Checksums(),transfer.Decompressor(localfile)])
+            transfer.download(requests.Session(),url,localfile,tap=tap)
+            res = tap.finish(localfile)
+            assert res["md5"] == hashlib.md5(DATA).hexdigest()
+            assert res["decompressed"] == os.path.join(tmpdir,"file.txt")
+            assert open(res["decompressed"],"rb").read() == content
+            # dropped connection, content was sent again from the beginning
+            assert sorted(os.listdir(tmpdir)) == ["file.txt","file.txt.gz"]
+    finally:
+        DATA = orig
+        server.shutdown()
+
+
+def test_throttle():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        allocation = os.path.join(tmpdir,"alloc.json")
+        json.dump({"rate" : 200000},open(allocation,"w"))
+        server, url = start_server()
+        localfile = os.path.join(tmpdir,"file.bin")
+        throttle = transfer.Throttle(path=allocation)
+        tap = transfer.ContentTap([transfer.Checksums()],throttle=throttle)
+        t0 = time.time()
+        transfer.download(requests.Session(),url,localfile,segments=4,min_segment_size=1024,tap=tap)
+        # ~1MB at 200KB/s, whatever the number of segments
+        assert time.time() - t0 > 4
+        assert tap.finish(localfile)["md5"] == hashlib.md5(DATA).hexdigest()
+        server.shutdown()
@@ -0,0 +1,441 @@
+import os, glob, json, time, tempfile, threading
+import asyncio
+from collections import OrderedDict
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from biothings.tests.hubapp import setup_app
+config = setup_app()
+
+from biothings.hub.dataload import uploader, storage
+from biothings.hub.dataload.uploader import BaseSourceUploader, ParallelizedSourceUploader, \
+                                            RangeParallelSourceUploader, UploaderManager, \
+                                            Checkpoint, CheckpointTracker, cached_load
+from biothings.hub.dataload.storage import IgnoreDuplicatedStorage
+from biothings.utils.dataload import tabfile_feeder
+from biothings.utils.hub_db import get_src_dump
+
+
+class FakeCollection(object):
+    """What uploaders and BasicStorage need from a mongo collection"""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.docs = OrderedDict()
+
+    def insert_many(self, doc_li, ordered=True):
+        errors = []
+        with self.db.lock:
+            for doc in doc_li:
+                if doc["_id"] in self.docs:
+                    errors.append({"code" : 11000, "op" : doc})
+                else:
+                    self.docs[doc["_id"]] = doc
+        if errors:
+            raise BulkWriteError({"nInserted" : len(doc_li) - len(errors), "writeErrors" : errors})
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulkOp(self)
+
+    def count(self):
+        return len(self.docs)
+
+    def drop(self):
+        self.db.cols.pop(self.name,None)
+
+    def rename(self, new_name, dropTarget=False):
+        with self.db.lock:
+            del self.db.cols[self.name]
+            self.name = new_name
+            self.db.cols[new_name] = self
+
+
+class FakeBulkOp(object):
+
+    def __init__(self, col):
+        self.col = col
+        self.docs = []
+
+    def insert(self, doc):
+        self.docs.append(doc)
+
+    def execute(self):
+        self.col.insert_many(self.docs,ordered=False)
+        return {"nInserted" : len(self.docs)}
+
+
+class FakeDatabase(object):
+
+    def __init__(self):
+        self.cols = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self.lock:
+            return self.cols.setdefault(name,FakeCollection(self,name))
+
+    def collection_names(self):
+        return [name for name,col in self.cols.items() if col.docs]
+
+
+class ThreadJobManager(object):
+    """What uploaders and UploaderManager need from JobManager, jobs running in threads"""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def submit(self, pfunc):
+        return asyncio.ensure_future(pfunc())
+
+    @asyncio.coroutine
+    def defer_to_thread(self, pinfo, func):
+        yield from asyncio.sleep(0)
+        return self.loop.run_in_executor(None,func)
+
+    defer_to_process = defer_to_thread
+
+
+@pytest.fixture
+def src_db(monkeypatch):
+    db = FakeDatabase()
+    monkeypatch.setattr(uploader,"get_src_conn",lambda: {config.DATA_SRC_DATABASE : db})
+    monkeypatch.setattr(storage,"get_src_db",lambda conn=None: db)
+    return db
+
+
+def make_source(name, content):
+    """Register a successful dump of "content" in a file for source "name", return data folder"""
+    data_folder = tempfile.mkdtemp(prefix="%s_" % name)
+    path = os.path.join(data_folder,"%s.txt" % name)
+    with open(path,"w") as fout:
+        fout.write(content)
+    get_src_dump().save({"_id" : name, "data_folder" : data_folder, "release" : "1",
+                         "download" : {"status" : "success",
+                                       "remote_files" : [{"local" : path, "sha256" : str(hash(content))}]}})
+    return data_folder
+
+
+def upload(manager, name, **kwargs):
+    """Upload source "name" through the manager, return error if any"""
+    loop = asyncio.get_event_loop()
+    jobs = manager.upload_src(name,batch_size=10,**kwargs)
+    res = loop.run_until_complete(asyncio.gather(*jobs,return_exceptions=True))
+    return [r for r in res if isinstance(r,Exception)]
+
+
+def make_manager(*klasses):
+    manager = UploaderManager(job_manager=ThreadJobManager(asyncio.get_event_loop()))
+    manager.register_classes(klasses)
+    return manager
+
+
+def numbers(checkpoint=None, num=30):
+    for i in range(checkpoint or 0,num):
+        if i % 10 == 0:
+            yield Checkpoint(i)
+        yield {"_id" : i}
+
+
+def test_checkpoint_tracker():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,"checkpoints","col_1.json")
+        calls = []
+        def load(checkpoint=None):
+            calls.append(checkpoint)
+            return numbers(checkpoint)
+        tracker = CheckpointTracker(path)
+        tracker.write_interval = 0
+        assert not tracker.resumed
+        docs = tracker.load(load)
+        assert [next(docs)["_id"] for i in range(25)] == list(range(25))
+        # 25 documents parsed, 15 stored: last checkpoint before them is kept
+        tracker.stored(15)
+        assert json.load(open(path)) == {"records" : 15, "state" : 10, "state_records" : 10}
+        # resumed from that checkpoint, already stored documents skipped
+        tracker = CheckpointTracker(path)
+        assert tracker.resumed
+        assert [d["_id"] for d in tracker.load(load)] == list(range(15,30))
+        assert calls == [None,10]
+        # progress written at most every write_interval seconds
+        tracker.write_interval = 60
+        saved = []
+        tracker.stored(10,before_write=lambda: saved.append("stored"))
+        assert json.load(open(path))["records"] == 15 and saved == []
+        tracker.flush(lambda: saved.append("flush"))
+        assert json.load(open(path)) == {"records" : 25, "state" : 20, "state_records" : 20}
+        assert saved == ["flush"]
+
+
+def test_cached_load():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_file = os.path.join(tmpdir,"cache","docs.bson.gz")
+        calls = []
+        def load(checkpoint=None):
+            calls.append(checkpoint)
+            return numbers(checkpoint)
+        # resuming without cache: partial content, not cached
+        assert [d["_id"] for d in uploader.strip_checkpoints(cached_load(load,cache_file,checkpoint=20))] == \
+                list(range(20,30))
+        assert not os.path.exists(cache_file)
+        # cache written while documents are consumed
+        assert [d["_id"] for d in uploader.strip_checkpoints(cached_load(load,cache_file))] == list(range(30))
+        assert os.path.exists(cache_file)
+        # read from cache, from a checkpoint
+        res = list(cached_load(load,cache_file,checkpoint=10))
+        assert calls == [20,None]
+        assert [d["_id"] for d in res if not isinstance(d,Checkpoint)] == list(range(10,30))
+        assert [d.state for d in res if isinstance(d,Checkpoint)] == [20]
+
+
+class NumbersUploader(BaseSourceUploader):
+
+    name = "numbers"
+    resumable = True
+    # parsing error raised at this line
+    fail_at = None
+    parsed = []
+
+    def load_data(self, data_folder, checkpoint=None):
+        with open(os.path.join(data_folder,"numbers.txt")) as fin:
+            for i,line in enumerate(fin):
+                if i < (checkpoint or 0):
+                    continue
+                if i % 10 == 0:
+                    yield Checkpoint(i)
+                if i == self.__class__.fail_at:
+                    raise IOError("parsing failed")
+                self.__class__.parsed.append(i)
+                yield {"_id" : line.strip()}
+
+
+def test_resume(src_db):
+    make_source("numbers","\n".join(["n%d" % i for i in range(100)]))
+    manager = make_manager(NumbersUploader)
+    try:
+        NumbersUploader.fail_at = 55
+        assert upload(manager,"numbers")
+        job = get_src_dump().find_one({"_id" : "numbers"})["upload"]["jobs"]["numbers"]
+        assert job["status"] == "failed"
+        temp = job["checkpoint"]["temp_collection"]
+        assert src_db[temp].count() == 50
+        # resumed from last checkpoint before failure, into the same collection
+        NumbersUploader.fail_at = None
+        NumbersUploader.parsed = []
+        assert upload(manager,"numbers") == []
+        assert NumbersUploader.parsed == list(range(50,100))
+        assert sorted(src_db["numbers"].docs) == sorted(["n%d" % i for i in range(100)])
+        assert not temp in src_db.collection_names()
+        job = get_src_dump().find_one({"_id" : "numbers"})["upload"]["jobs"]["numbers"]
+        assert job["status"] == "success" and job["checkpoint"] is None
+    finally:
+        NumbersUploader.fail_at = None
+        NumbersUploader.parsed = []
+
+
+class PartsUploader(ParallelizedSourceUploader):
+
+    name = "parts"
+    resumable = True
+    fail_part = None
+    parsed = []
+
+    def jobs(self):
+        return [(part,) for part in range(3)]
+
+    def load_data(self, part):
+        if part == self.__class__.fail_part:
+            # once other jobs are done
+            time.sleep(0.5)
+            raise IOError("parsing failed")
+        self.__class__.parsed.append(part)
+        for i in range(10):
+            yield {"_id" : part * 10 + i}
+
+
+def test_resume_parallelized(src_db):
+    make_source("parts","")
+    manager = make_manager(PartsUploader)
+    try:
+        PartsUploader.fail_part = 1
+        assert upload(manager,"parts")
+        job = get_src_dump().find_one({"_id" : "parts"})["upload"]["jobs"]["parts"]
+        assert job["checkpoint"]["done_jobs"] == [0,2]
+        # completed jobs are skipped
+        PartsUploader.fail_part = None
+        PartsUploader.parsed = []
+        assert upload(manager,"parts") == []
+        assert PartsUploader.parsed == [1]
+        assert sorted(src_db["parts"].docs) == list(range(30))
+    finally:
+        PartsUploader.fail_part = None
+        PartsUploader.parsed = []
+
+
+class FilesUploader(BaseSourceUploader):
+
+    name = "files"
+    # file_unchanged() as seen by load_data()
+    unchanged = []
+
+    def load_data(self, data_folder):
+        self.__class__.unchanged.append(self.file_unchanged(os.path.join(data_folder,"%s.txt" % self.name)))
+        yield {"_id" : "doc"}
+
+
+class SkippingUploader(FilesUploader):
+
+    name = "skipping"
+    skip_unchanged = True
+    unchanged = []
+
+
+def test_unchanged_files(src_db):
+    manager = make_manager(FilesUploader,SkippingUploader)
+    for name in ("files","skipping"):
+        make_source(name,"content")
+        assert upload(manager,name) == []
+        # same file digests as previous upload
+        assert upload(manager,name) == []
+        make_source(name,"new content")
+        assert upload(manager,name) == []
+        job = get_src_dump().find_one({"_id" : name})["upload"]["jobs"][name]
+        assert job["status"] == "success"
+        assert job["files"] == [{"path" : "%s.txt" % name, "sha256" : str(hash("new content"))}]
+    assert FilesUploader.unchanged == [False,True,False]
+    # not uploaded again
+    assert SkippingUploader.unchanged == [False,False]
+
+
+class CachedUploader(BaseSourceUploader):
+
+    main_source = "cached"
+    name = "cached"
+    cache_parsed = True
+    version = 1
+    parsed = []
+    versions = []
+
+    def get_parser_version(self):
+        self.__class__.versions.append(self.name)
+        return "v%s" % self.__class__.version
+
+    def load_data(self, data_folder):
+        self.__class__.parsed.append(self.name)
+        for i in range(30):
+            yield {"_id" : i}
+
+
+class CachedPartsUploader(ParallelizedSourceUploader,CachedUploader):
+
+    # sub-source named after its sibling, caches kept apart
+    name = "cached_parts"
+    version = 1
+    parsed = []
+    versions = []
+
+    def jobs(self):
+        return [(part,) for part in range(12)]
+
+    def load_data(self, part):
+        self.__class__.parsed.append(part)
+        for i in range(3):
+            yield {"_id" : part * 3 + i}
+
+
+def test_cache(src_db):
+    make_source("cached","")
+    manager = make_manager(CachedUploader,CachedPartsUploader)
+    try:
+        assert upload(manager,"cached") == []
+        assert CachedUploader.parsed == ["cached"]
+        assert sorted(CachedPartsUploader.parsed) == list(range(12))
+        # parser version computed once per upload, not per job
+        assert CachedUploader.versions == ["cached"]
+        assert CachedPartsUploader.versions == ["cached_parts"]
+        # uploaded again from cache
+        CachedUploader.parsed = []
+        CachedPartsUploader.parsed = []
+        src_db["cached"].drop()
+        src_db["cached_parts"].drop()
+        assert upload(manager,"cached") == []
+        assert CachedUploader.parsed == [] and CachedPartsUploader.parsed == []
+        assert sorted(src_db["cached"].docs) == list(range(30))
+        assert sorted(src_db["cached_parts"].docs) == list(range(36))
+        parts = manager.create_instance(CachedPartsUploader)
+        parts.prepare()
+        parts_files = glob.glob(parts.get_cache_file("*"))
+        assert len(parts_files) == 12
+        # in job order
+        assert [d["_id"] for d in parts.cached_docs()] == list(range(36))
+        # new parser version: parsed again, previous cache files deleted
+        CachedUploader.version = 2
+        assert upload(manager,"cached") == []
+        assert CachedUploader.parsed == ["cached"] and CachedPartsUploader.parsed == []
+        cached = manager.create_instance(CachedUploader)
+        cached.prepare()
+        assert [os.path.basename(f) for f in glob.glob(os.path.join(cached.get_cache_folder(),"*"))] == \
+                ["1_v2_1.bson.gz"]
+        assert sorted(glob.glob(parts.get_cache_file("*"))) == sorted(parts_files)
+    finally:
+        CachedUploader.version = 1
+        CachedUploader.parsed = []
+        CachedUploader.versions = []
+        CachedPartsUploader.parsed = []
+        CachedPartsUploader.versions = []
+
+
+class RangesUploader(RangeParallelSourceUploader):
+
+    name = "ranges"
+    range_parts = 4
+    range_header = 1
+    propagate_header = True
+    storage_class = IgnoreDuplicatedStorage
+    parsed = []
+
+    def load_data(self, frange):
+        # all ranges parsed at the same time, last one done first
+        self.__class__.barrier.wait()
+        time.sleep((3 - frange.num) * 0.1)
+        self.__class__.parsed.append(frange.num)
+        for row in tabfile_feeder(frange,header=1):
+            yield {"_id" : row[0], "value" : int(row[1])}
+
+
+class OrderedRangesUploader(RangesUploader):
+
+    name = "ordered_ranges"
+    ordered = True
+    parsed = []
+
+
+def test_ranges(src_db, monkeypatch):
+    spill_files = []
+    def range_parse_worker(name, loaddata_func, spill_file, *args, **kwargs):
+        spill_files.append(spill_file)
+        return parse_worker(name,loaddata_func,spill_file,*args,**kwargs)
+    parse_worker = uploader.range_parse_worker
+    monkeypatch.setattr(uploader,"range_parse_worker",range_parse_worker)
+    manager = make_manager(RangesUploader,OrderedRangesUploader)
+    # ids found twice, in first and second half of the file
+    content = "id\tvalue\n" + "".join(["d%02d\t%d\n" % (i % 50,i) for i in range(100)])
+    for klass in (RangesUploader,OrderedRangesUploader):
+        klass.barrier = threading.Barrier(4,timeout=5)
+        data_folder = make_source(klass.name,content)
+        assert upload(manager,klass.name) == []
+        assert klass.parsed == [3,2,1,0]
+        assert os.listdir(data_folder) == ["%s.txt" % klass.name]
+    # concurrently stored (any of the duplicates kept), header propagated to
+    # each range (so not stored)
+    values = dict([(d["_id"],d["value"]) for d in src_db["ranges"].docs.values()])
+    assert sorted(values) == ["d%02d" % i for i in range(50)]
+    # stored in file order, first document kept
+    values = dict([(d["_id"],d["value"]) for d in src_db["ordered_ranges"].docs.values()])
+    assert values == dict([("d%02d" % i,i) for i in range(50)])
+    # parsed ranges spilled in run folder, deleted once stored
+    assert len(spill_files) == 4
+    spill_dir = os.path.dirname(spill_files[0])
+    assert spill_dir.startswith(os.path.join(config.RUN_DIR,"ranges",""))
+    assert not os.path.exists(spill_dir)
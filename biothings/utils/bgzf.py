@@ -0,0 +1,328 @@
+"""
+Block-compressed gzip (BGZF, as used by samtools/htslib).
+
+A BGZF file is a series of independent gzip members ("blocks") of at most
+64KB of uncompressed data, each one announcing its compressed size in a gzip
+extra field, followed by an empty EOF block. It's still a valid gzip file
+(gzip, zcat, gzip module, ... can read it) but blocks can be compressed and
+decompressed in parallel, and an index (".gzi" file, htslib format) mapping
+compressed to uncompressed offsets allows random access.
+
+    with BGZFWriter("data.gz") as fout:
+        fout.write(b"...")
+    with open_bgzf("data.gz") as fin:
+        fin.seek(123456)
+        fin.readline()
+"""
+import os, io, zlib, struct, bisect
+import concurrent.futures
+from collections import deque
+
+# uncompressed data per block, compressed block must fit in 64KB even if data
+# can't be compressed
+BLOCK_SIZE = 0xff00
+HEADER = struct.Struct("<4BI2BH2BHH")
+HEADER_SIZE = HEADER.size
+EOF_BLOCK = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00" + \
+            b"\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+# default number of compression/decompression threads
+THREADS = min(os.cpu_count() or 1,4)
+
+_pool = None
+_pool_pid = None
+
+
+def get_pool(threads=None):
+    """Return threads shared by readers and writers (recreated in forked processes)"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads or THREADS)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def is_bgzf(filename):
+    """Return True if "filename" starts with a BGZF block"""
+    try:
+        with open(filename,"rb") as fin:
+            header = fin.read(HEADER_SIZE)
+    except (OSError, TypeError):
+        return False
+    if len(header) < HEADER_SIZE:
+        return False
+    id1, id2, cm, flg, _, _, _, xlen, si1, si2, slen, _ = HEADER.unpack(header)
+    return (id1, id2, cm) == (31, 139, 8) and bool(flg & 4) and xlen == 6 and \
+            (si1, si2, slen) == (66, 67, 2)
+
+
+def get_index_path(filename):
+    return filename + ".gzi"
+
+
+def compress_block(data, level=6):
+    comp = zlib.compressobj(level,zlib.DEFLATED,-15)
+    cdata = comp.compress(data) + comp.flush()
+    bsize = HEADER_SIZE + len(cdata) + 8
+    return HEADER.pack(31,139,8,4,0,0,255,6,66,67,2,bsize - 1) + cdata + \
+            struct.pack("<II",zlib.crc32(data) & 0xffffffff,len(data))
+
+
+def decompress_block(block):
+    # block: whole block, header included
+    data = zlib.decompress(block[HEADER_SIZE:-8],-15)
+    crc, isize = struct.unpack("<II",block[-8:])
+    if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+        raise IOError("Corrupted BGZF block (CRC or size mismatch)")
+    return data
+
+
+def read_block(fin):
+    """Read next compressed block from "fin", return None at end of file"""
+    header = fin.read(HEADER_SIZE)
+    if not header:
+        return None
+    if len(header) < HEADER_SIZE:
+        raise IOError("Truncated BGZF block")
+    fields = HEADER.unpack(header)
+    if fields[:3] != (31,139,8) or not fields[3] & 4 or fields[8:10] != (66,67):
+        raise IOError("Not a BGZF block")
+    rest = fin.read(fields[11] + 1 - HEADER_SIZE)
+    return header + rest
+
+
+def write_index(path, offsets):
+    # htslib format: number of entries, then (compressed,uncompressed) offsets
+    # of each block but the first one, uint64 little-endian
+    entries = [o for o in offsets if o != (0,0)]
+    with open(path,"wb") as fout:
+        fout.write(struct.pack("<Q",len(entries)))
+        for coff,uoff in entries:
+            fout.write(struct.pack("<QQ",coff,uoff))
+
+
+def read_index(path):
+    with open(path,"rb") as fin:
+        num, = struct.unpack("<Q",fin.read(8))
+        data = fin.read(16 * num)
+    return [(0,0)] + [struct.unpack_from("<QQ",data,16 * i) for i in range(num)]
+
+
+class BGZFWriter(io.BufferedIOBase):
+    """
+    Write BGZF file "filename" (or file object "fileobj"). Blocks are compressed
+    in parallel, by batches, and written in order. If "index" is True (and a
+    filename is given), ".gzi" index is written on close.
+    """
+
+    def __init__(self, filename=None, fileobj=None, level=6, threads=None, index=True):
+        super(BGZFWriter,self).__init__()
+        assert filename or fileobj
+        self.filename = filename
+        self.fileobj = fileobj or open(filename,"wb")
+        self.own_fileobj = fileobj is None
+        self.level = level
+        self.threads = threads or THREADS
+        self.index = index and filename
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.coffset = 0
+        self.uoffset = 0
+        self.offsets = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self.buffer.extend(data)
+        if len(self.buffer) >= BLOCK_SIZE * self.threads:
+            self._submit(flush=False)
+        return len(data)
+
+    def _submit(self, flush):
+        while len(self.buffer) >= BLOCK_SIZE or (flush and self.buffer):
+            chunk = bytes(self.buffer[:BLOCK_SIZE])
+            del self.buffer[:BLOCK_SIZE]
+            if self.threads > 1:
+                self.pending.append((len(chunk),get_pool().submit(compress_block,chunk,self.level)))
+            else:
+                self._write_block(len(chunk),compress_block(chunk,self.level))
+        # keep a bounded number of blocks in memory
+        while self.pending and (flush or len(self.pending) > self.threads * 2):
+            size, fut = self.pending.popleft()
+            self._write_block(size,fut.result())
+
+    def _write_block(self, size, block):
+        self.offsets.append((self.coffset,self.uoffset))
+        self.fileobj.write(block)
+        self.coffset += len(block)
+        self.uoffset += size
+
+    def flush(self):
+        # also called by close(), once file object is closed
+        if not self.closed and not self.fileobj.closed:
+            self._submit(flush=True)
+            self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(flush=True)
+            self.fileobj.write(EOF_BLOCK)
+            if self.own_fileobj:
+                self.fileobj.close()
+            else:
+                self.fileobj.flush()
+            if self.index:
+                write_index(get_index_path(self.filename),self.offsets)
+        finally:
+            super(BGZFWriter,self).close()
+
+
+class BGZFRawReader(io.RawIOBase):
+    """
+    Read BGZF file "filename" (use open_bgzf() to get a buffered reader).
+    Next blocks are decompressed in parallel while current one is consumed.
+    Seeking uses ".gzi" index if it exists, otherwise blocks' offsets are
+    found by scanning block headers.
+    """
+
+    def __init__(self, filename, threads=None):
+        super(BGZFRawReader,self).__init__()
+        self.filename = filename
+        self.fileobj = open(filename,"rb")
+        self.threads = threads or THREADS
+        self.pending = deque()
+        self.eof = False
+        self.data = b""
+        self.pos = 0
+        # uncompressed offset of current block
+        self.block_start = 0
+        self.next_start = 0
+        self.offsets = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _fill(self):
+        while not self.eof and len(self.pending) < self.threads * 2:
+            block = read_block(self.fileobj)
+            if block is None:
+                self.eof = True
+            elif self.threads > 1:
+                self.pending.append(get_pool().submit(decompress_block,block))
+            else:
+                self.pending.append(block)
+
+    def _next_block(self):
+        self._fill()
+        if not self.pending:
+            return False
+        item = self.pending.popleft()
+        self.block_start = self.next_start
+        if self.threads > 1:
+            self.data = item.result()
+        else:
+            self.data = decompress_block(item)
+        self.next_start += len(self.data)
+        self.pos = 0
+        return True
+
+    def readinto(self, b):
+        # skip empty blocks (EOF marker)
+        while self.pos >= len(self.data):
+            if not self._next_block():
+                return 0
+        size = min(len(b),len(self.data) - self.pos)
+        b[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def tell(self):
+        return self.block_start + self.pos
+
+    def get_offsets(self):
+        """Return (compressed,uncompressed) offsets of blocks"""
+        if self.offsets is None:
+            idx = get_index_path(self.filename)
+            if os.path.exists(idx) and os.path.getmtime(idx) >= os.path.getmtime(self.filename):
+                self.offsets = read_index(idx)
+            else:
+                self.offsets = []
+                with open(self.filename,"rb") as fin:
+                    coff = uoff = 0
+                    while True:
+                        header = fin.read(HEADER_SIZE)
+                        if len(header) < HEADER_SIZE:
+                            break
+                        bsize = HEADER.unpack(header)[11] + 1
+                        fin.seek(coff + bsize - 4)
+                        isize, = struct.unpack("<I",fin.read(4))
+                        if isize:
+                            self.offsets.append((coff,uoff))
+                        coff += bsize
+                        uoff += isize
+        return self.offsets
+
+    def get_size(self):
+        """Return uncompressed size"""
+        offsets = self.get_offsets()
+        if not offsets:
+            return 0
+        coff, uoff = offsets[-1]
+        with open(self.filename,"rb") as fin:
+            fin.seek(coff)
+            return uoff + len(decompress_block(read_block(fin)))
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset = self.tell() + offset
+        elif whence == io.SEEK_END:
+            offset = self.get_size() + offset
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        if not self.block_start <= offset <= self.block_start + len(self.data):
+            offsets = self.get_offsets()
+            i = bisect.bisect_right([u for _,u in offsets],offset) - 1
+            coff, uoff = i >= 0 and offsets[i] or (0,0)
+            # drop read-ahead blocks
+            self.cancel_pending()
+            self.fileobj.seek(coff)
+            self.eof = False
+            self.data = b""
+            self.block_start = self.next_start = uoff
+            self._next_block()
+        # can be past the end of data, then nothing will be read
+        self.pos = offset - self.block_start
+        return offset
+
+    def cancel_pending(self):
+        for item in self.pending:
+            if hasattr(item,"cancel"):
+                item.cancel()
+        self.pending = deque()
+
+    def close(self):
+        if not self.closed:
+            self.cancel_pending()
+            self.fileobj.close()
+        super(BGZFRawReader,self).close()
+
+
+def open_bgzf(filename, mode="rb", threads=None, **kwargs):
+    """
+    Open BGZF file for reading ("rb"), writing ("wb") or text equivalents
+    ("r", "rt", "w", "wt", extra kwargs passed to io.TextIOWrapper)
+    """
+    if "w" in mode:
+        fobj = BGZFWriter(filename,threads=threads)
+    else:
+        fobj = io.BufferedReader(BGZFRawReader(filename,threads=threads),buffer_size=BLOCK_SIZE)
+    if not "b" in mode:
+        fobj = io.TextIOWrapper(fobj,**kwargs)
+    return fobj
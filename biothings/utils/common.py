@@ -153,16 +153,28 @@ def anyfile(infile, mode='r'):
     if infile is a two value tuple, then first one is the compressed file;
       the second one is the actual filename in the compressed file.
       e.g., ('a.zip', 'aa.txt')
+    infile can also be a FileRange (part of a file, see utils.filerange)
+    or an already opened file handle, returned as is.
 
     '''
+    if is_filehandle(infile):
+        return infile
+    if hasattr(infile, 'filename') and hasattr(infile, 'open'):
+        # FileRange
+        return infile.open(mode)
     if isinstance(infile, tuple):
         infile, rawfile = infile[:2]
     else:
         rawfile = os.path.splitext(infile)[0]
     filetype = os.path.splitext(infile)[1].lower()
     if filetype == '.gz':
-        import gzip
-        in_f = io.TextIOWrapper(gzip.GzipFile(infile, 'r'))
+        from biothings.utils.bgzf import is_bgzf, open_bgzf
+        if is_bgzf(infile):
+            # block-compressed, decompressed with multiple threads
+            in_f = io.TextIOWrapper(open_bgzf(infile, 'rb'))
+        else:
+            import gzip
+            in_f = io.TextIOWrapper(gzip.GzipFile(infile, 'r'))
     elif filetype == '.zip':
         import zipfile
         in_f = io.TextIOWrapper(zipfile.ZipFile(infile, 'r').open(rawfile, 'r'))
@@ -260,11 +272,13 @@ def split_ids(q):
 
 def get_compressed_outfile(filename, compress='gzip'):
     '''Get a output file handler with given compress method.
-       currently support gzip/bz2/lzma, lzma only available in py3
+       currently support gzip/bz2/lzma, lzma only available in py3.
+       gzip files are block-compressed (BGZF, still readable as gzip),
+       compressed with multiple threads.
     '''
-    if compress == "gzip":
-        import gzip
-        out_f = gzip.GzipFile(filename, 'wb')
+    if compress == "gzip" or compress == "bgzf":
+        from biothings.utils.bgzf import BGZFWriter
+        out_f = BGZFWriter(filename, index=False)
     elif compress == 'bz2':
         import bz2
         out_f = bz2.BZ2File(filename, 'wb')
@@ -287,8 +301,12 @@ def open_compressed_file(filename):
     in_f.close()
     if sig[:3] == b'\x1f\x8b\x08':
         # this is a gzip file
-        import gzip
-        fobj = gzip.GzipFile(filename, 'rb')
+        from biothings.utils.bgzf import is_bgzf, open_bgzf
+        if is_bgzf(filename):
+            fobj = open_bgzf(filename, 'rb')
+        else:
+            import gzip
+            fobj = gzip.GzipFile(filename, 'rb')
     elif sig[:3] == b'BZh':
         # this is a bz2 file
         import bz2
@@ -611,6 +629,10 @@ def gunzipall(folder,pattern="*.gz"):
     for f in glob.glob(os.path.join(folder,pattern)):
         # build uncompress filename from gz file and pattern
         destf = f.replace(pattern.replace("*",""),"")
+        if os.path.exists(destf) and os.path.getmtime(destf) >= os.path.getmtime(f):
+            # already uncompressed (eg. while downloading)
+            logging.info("'%s' already uncompressed" % f)
+            continue
         fout = open(destf,"wb")
         with gzip.GzipFile(f) as gz:
             logging.info("gunzip '%s'" % gz.name)
@@ -0,0 +1,101 @@
+"""
+Content-addressed file store.
+
+Files are stored once, named after a hash of their content
+("<root>/<algo>/ab/abcdef..."), and hardlinked wherever they're used (eg.
+release data folders), so a file identical in several releases only takes
+disk space once and doesn't need to be copied. Store's root must be on the
+same filesystem as the folders it links to.
+
+Hardlinked files share their content: they must never be modified in place.
+Call detach() before writing to a file which may come from the store.
+"""
+import os, hashlib, glob
+import logging
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, algo="sha256", chunk_size=CHUNK_SIZE):
+    h = hashlib.new(algo)
+    with open(path,"rb") as fin:
+        for data in iter(lambda: fin.read(chunk_size),b""):
+            h.update(data)
+    return h.hexdigest()
+
+
+def detach(path):
+    """Remove "path" if it's a hardlink, so writing to it won't change other copies"""
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.unlink(path)
+            return True
+    except FileNotFoundError:
+        pass
+    return False
+
+
+class ContentStore(object):
+
+    def __init__(self, root, algo="sha256", logger=logging):
+        self.root = root
+        self.algo = algo
+        self.logger = logger
+
+    def path_for(self, digest):
+        return os.path.join(self.root,self.algo,digest[:2],digest)
+
+    def has(self, digest):
+        return bool(digest) and os.path.exists(self.path_for(digest))
+
+    def _link(self, src, dest):
+        # link next to dest then rename, so dest is replaced atomically
+        tmp = "%s.%d.tmp" % (dest,os.getpid())
+        os.link(src,tmp)
+        os.rename(tmp,dest)
+
+    def add(self, path, digest=None):
+        """
+        Store file "path" (hashing it if its "digest" isn't known yet). If the
+        same content is already stored, "path" is replaced by a hardlink to it.
+        Return file's digest.
+        """
+        digest = digest or hash_file(path,self.algo)
+        blob = self.path_for(digest)
+        try:
+            if os.path.exists(blob):
+                if not os.path.samefile(blob,path):
+                    if os.path.getsize(blob) != os.path.getsize(path):
+                        raise ValueError("Stored file '%s' doesn't match '%s' (same %s, different sizes)" % \
+                                (blob,path,self.algo))
+                    self._link(blob,path)
+            else:
+                os.makedirs(os.path.dirname(blob),exist_ok=True)
+                try:
+                    os.link(path,blob)
+                except FileExistsError:
+                    # stored meanwhile by another process
+                    self._link(blob,path)
+        except OSError as e:
+            # eg. not the same filesystem, file is kept as is
+            self.logger.warning("Can't store '%s' in '%s': %s" % (path,self.root,e))
+        return digest
+
+    def link(self, digest, path):
+        """Hardlink stored file to "path", return False if not stored"""
+        if not self.has(digest):
+            return False
+        if os.path.exists(path) and os.path.samefile(self.path_for(digest),path):
+            return True
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        self._link(self.path_for(digest),path)
+        return True
+
+    def gc(self):
+        """Delete stored files which aren't linked anywhere anymore, return number of deleted files"""
+        deleted = 0
+        for blob in glob.glob(os.path.join(self.root,self.algo,"*","*")):
+            if os.stat(blob).st_nlink == 1:
+                os.unlink(blob)
+                deleted += 1
+        return deleted
@@ -9,8 +9,11 @@ import csv
 import os, os.path
 import json
 import collections
+import inspect
+import textwrap
+import functools
 
-from .common import open_anyfile, is_str, ask, safewfile, anyfile
+from .common import open_anyfile, is_str, ask, safewfile, anyfile, is_filehandle
 
 csv.field_size_limit(10000000)   # default is 131072, too small for some big files
 
@@ -339,21 +342,70 @@ def dupline_seperator(dupline, dup_sep, dup_idx=None, strip=False):
     return itertools.product(*value_li)    # itertools.product fits exactly the purpose here
 
 
+# size of blocks read by tabfile_feeder
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def split_lines(in_f, block_size=None):
+    """
+    Iterate over lines (without line ending) read from in_f, by blocks.
+    Yield (lines,quoted) tuples, quoted is True if one of the lines contains
+    a double-quote.
+    """
+    block_size = block_size or READ_BLOCK_SIZE
+    rest = ""
+    for block in iter(lambda: in_f.read(block_size), ""):
+        block = rest + block
+        lines = block.split("\n")
+        rest = lines.pop()
+        yield lines, block.find('"', 0, len(block) - len(rest)) != -1
+    if rest:
+        yield [rest], '"' in rest
+
+
 def tabfile_feeder(datafile, header=1, sep='\t',
                    includefn=None,
                    coerce_unicode=True,
-                   assert_column_no=None):
-    '''a generator for each row in the file.'''
-
+                   assert_column_no=None,
+                   cols=None,
+                   converters=None):
+    '''a generator for each row in the file.
+       "cols" is an optional list of column indexes, only these columns are
+       returned, in this order. "converters" is an optional dict of
+       column index => function, applied to these columns (eg. int).
+       "includefn" is always called with the whole row.
+       Lines are split on "sep", using csv module only once a quote
+       character is found. (coerce_unicode is kept for compatibility,
+       values are always str)
+    '''
     in_f = anyfile(datafile)
-    reader = csv.reader(in_f, delimiter=sep)
     lineno = 0
+    # when only some columns are needed, don't split the rest of the line
+    # (unless counting from the end)
+    maxsplit = cols and not includefn and not assert_column_no and min(cols) >= 0 \
+            and max(cols) + 1 or -1
+    if converters:
+        positions = cols and dict([(c,i) for i,c in enumerate(cols)]) or dict([(c,c) for c in converters])
+        converters = [(positions[c],func) for c,func in converters.items() if c in positions]
     try:
+        # header is a csv record, which can span multiple lines if quoted
+        header_reader = csv.reader(iter(in_f.readline, ""), delimiter=sep)
         for i in range(header):
-            next(reader)
+            next(header_reader, None)
             lineno += 1
 
-        for ld in reader:
+        blocks = split_lines(in_f)
+        # rows, split on "sep" until a quote is found, then parsed by csv module
+        def split_rows():
+            for lines, quoted in blocks:
+                if quoted:
+                    remaining = itertools.chain(lines,itertools.chain.from_iterable(b[0] for b in blocks))
+                    yield from csv.reader((line + "\n" for line in remaining), delimiter=sep)
+                    return
+                for line in lines:
+                    yield line and line.split(sep, maxsplit) or []
+
+        for ld in split_rows():
             if assert_column_no:
                 if len(ld) != assert_column_no:
                     err = "Unexpected column number:" \
@@ -361,21 +413,26 @@ def tabfile_feeder(datafile, header=1, sep='\t',
                     raise ValueError(err)
             if not includefn or includefn(ld):
                 lineno += 1
-                if coerce_unicode:
-                    yield [str(x) for x in ld]
-                else:
-                    yield ld
+                if cols:
+                    ld = [ld[c] for c in cols]
+                if converters:
+                    for i, func in converters:
+                        ld[i] = func(ld[i])
+                yield ld
     except ValueError:
         print("Error at line number:", lineno)
         raise
+    finally:
+        if not is_filehandle(datafile):
+            in_f.close()
 
 
 def tab2list(datafile, cols, **kwargs):
     if os.path.exists(datafile):
         if isinstance(cols, int):
-            return [ld[cols] for ld in tabfile_feeder(datafile, **kwargs)]
+            return [ld[0] for ld in tabfile_feeder(datafile, cols=[cols], **kwargs)]
         else:
-            return [listitems(ld, *cols) for ld in tabfile_feeder(datafile, **kwargs)]
+            return list(tabfile_feeder(datafile, cols=cols, **kwargs))
     else:
         print('Error: missing "%s". Skipped!' % os.path.split(datafile)[1])
         return {}
@@ -387,7 +444,7 @@ def tab2dict(datafile, cols, key, alwayslist=False, **kwargs):
     else:
         _datafile = datafile
     if os.path.exists(_datafile):
-        return list2dict([listitems(ld, *cols) for ld in tabfile_feeder(datafile, **kwargs)], key, alwayslist=alwayslist)
+        return list2dict(list(tabfile_feeder(datafile, cols=cols, **kwargs)), key, alwayslist=alwayslist)
     else:
         print('Error: missing "%s". Skipped!' % os.path.split(_datafile)[1])
         return {}
@@ -401,9 +458,7 @@ def tab2dict_iter(datafile, cols, key, alwayslist=False, **kwargs):
     if os.path.exists(_datafile):
         bulk = []
         prev_id = None
-        for ld in tabfile_feeder(datafile, **kwargs):
-            #print(ld)
-            li = listitems(ld, *cols)
+        for li in tabfile_feeder(datafile, cols=cols, **kwargs):
             #print("key %s len bulk %s prev %s" % (li[key],len(bulk),prev_id))
             if prev_id == None or (li[key] == prev_id):
                 #print("\t\tfound same")
@@ -679,6 +734,49 @@ def dict_to_list(gene_d):
     return doc_li
 
 
+# tags for value_fingerprint(), can't be found in actual values
+_LIST = object()
+_TUPLE = object()
+_DICT = object()
+
+def value_fingerprint(value):
+    """
+    Return a hashable equivalent of value: fingerprints of two values are
+    equal if and only if values are equal. Raise TypeError if value (or
+    one of its elements) can't be turned into a hashable.
+    """
+    if isinstance(value, collections.OrderedDict):
+        # order matters between OrderedDicts only
+        raise TypeError("Can't fingerprint OrderedDict")
+    elif isinstance(value, dict):
+        return (_DICT, frozenset([(k, value_fingerprint(v)) for k, v in value.items()]))
+    elif isinstance(value, list):
+        return (_LIST, tuple([value_fingerprint(v) for v in value]))
+    elif isinstance(value, tuple):
+        return (_TUPLE, tuple([value_fingerprint(v) for v in value]))
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    hash(value)
+    return value
+
+
+# below this number of comparisons, merge lists without fingerprints
+MERGE_FINGERPRINT_THRESHOLD = 64
+
+def merge_lists(l1, l2):
+    """
+    Return l1 followed by l2's elements not found in l1 (duplicates within
+    l2 are kept). Linear for big lists, using value_fingerprint().
+    """
+    if len(l1) * len(l2) > MERGE_FINGERPRINT_THRESHOLD:
+        try:
+            seen = set([value_fingerprint(x) for x in l1])
+            return l1 + [x for x in l2 if value_fingerprint(x) not in seen]
+        except TypeError:
+            pass
+    return l1 + [x for x in l2 if x not in l1]
+
+
 def merge_struct(v1, v2,aslistofdict=None):
 
     #print("v1 = %s" % repr(v1))
@@ -690,7 +788,7 @@ def merge_struct(v1, v2,aslistofdict=None):
             #print("v2 is list -> extend")
             #v1.extend(v2)
             #v1 = list(set(v1))
-            v1 = v1 + [x for x in v2 if x not in v1]
+            v1 = merge_lists(v1, v2)
         else:
             #print("v2 not list -> append")
             if v2 not in v1:
@@ -754,6 +852,195 @@ def merge_struct(v1, v2,aslistofdict=None):
     return v1
 
 
+#===============================================================================
+# Document post-processing pipeline
+#===============================================================================
+# Helpers like dict_sweep(), unlist() or value_convert_to_number() each walk
+# (and rebuild parts of) the whole document. compile_pipeline() turns a chain
+# of them into a single function, generated once, processing each key with
+# all steps in a row, so a document is walked only once whatever the number
+# of steps. Output is the same as calling helpers one after the other.
+
+class PipelineStep(object):
+    """
+    Per-key equivalent of a document helper: "code" updates "val", value of
+    "key", or removes it using "DELETE". Placeholders are replaced by names
+    of step's parameters. Recursive steps apply to nested dicts too: those
+    are walked (once, for all consecutive recursive steps) instead of running
+    "code". If delete_empty, dicts left empty are removed.
+    """
+    recursive = True
+    delete_empty = False
+    code = ""
+
+    def __init__(self, **params):
+        self.params = params
+
+
+class SweepStep(PipelineStep):
+    """dict_sweep()"""
+    delete_empty = True
+    code = """
+        if val in {vals}:
+            DELETE
+        if isinstance(val, list):
+            val = [v for v in val if v not in {vals}]
+            if not val:
+                DELETE
+            for item in val:
+                if isinstance(item, dict):
+                    dict_sweep(item, {vals})
+        """
+
+
+class UnlistStep(PipelineStep):
+    """unlist()"""
+    code = """
+        if isinstance(val, list) and len(val) == 1:
+            val = val[0]
+        """
+
+
+class NumberStep(PipelineStep):
+    """value_convert_to_number()"""
+    code = """
+        if key not in {skipped_keys}:
+            if isinstance(val, list):
+                val = [to_number(x) for x in val]
+            elif isinstance(val, tuple):
+                val = tuple([to_number(x) for x in val])
+            else:
+                val = to_number(val)
+        """
+
+
+class ListSplitStep(PipelineStep):
+    """list_split()"""
+    code = """
+        try:
+            if len(val.split({sep})) > 1:
+                val = val.rstrip().rstrip({sep}).split({sep})
+        except AttributeError:
+            pass
+        """
+
+
+class ValueConvertStep(PipelineStep):
+    """value_convert(), top-level values only"""
+    recursive = False
+    code = """
+        if {traverse_list} and isinstance(val, list):
+            val = [{fn}(x) for x in val]
+        else:
+            val = {fn}(val)
+        """
+
+
+PIPELINE_STEPS = {
+        dict_sweep : SweepStep,
+        unlist : UnlistStep,
+        value_convert_to_number : NumberStep,
+        list_split : ListSplitStep,
+        value_convert : ValueConvertStep,
+        }
+
+
+def fuse_steps(steps):
+    """
+    Generate a function applying steps (PipelineStep) to each key of a dict,
+    in place. "step" is the index of next step to apply on current value,
+    recursive steps applied on a dict value are skipped all together.
+    """
+    num = len(steps)
+    namespace = {"dict_sweep" : dict_sweep, "to_number" : to_number}
+    lines = ["def walk(d):",
+             "    for key, val in list(d.items()):",
+             "        step = 0"]
+    runs = {}
+    for i,step in enumerate(steps):
+        names = {}
+        for param,value in step.params.items():
+            names[param] = "p%d_%s" % (i,param)
+            namespace[names[param]] = value
+        code = []
+        for line in textwrap.dedent(step.code).strip().format(**names).splitlines():
+            if line.strip() == "DELETE":
+                indent = line[:line.index("DELETE")]
+                code.extend([indent + "del d[key]",indent + "continue"])
+            else:
+                code.append(line)
+        lines.append("        if step == %d:  # %s" % (i,step.__doc__))
+        indent = " " * 12
+        if step.recursive:
+            j = i
+            while j < num and steps[j].recursive:
+                j += 1
+            runs["run%d" % i] = (i,j)
+            lines.extend(["            if isinstance(val, dict):",
+                          "                run%d(val)" % i])
+            if any([s.delete_empty for s in steps[i:j]]):
+                lines.extend(["                if not val:",
+                              "                    del d[key]",
+                              "                    continue"])
+            lines.extend(["                step = %d" % j,
+                          "            else:"])
+            indent = " " * 16
+        lines.extend([indent + l for l in code])
+        lines.append(indent + "step = %d" % (i + 1))
+    lines.extend(["        d[key] = val",
+                  "    return d"])
+    source = "\n".join(lines)
+    exec(compile(source,"<pipeline>","exec"),namespace)
+    walk = namespace["walk"]
+    walk.source = source
+    for name,(i,j) in runs.items():
+        namespace[name] = walk if (i,j) == (0,num) else fuse_steps(steps[i:j])
+    return walk
+
+
+def compile_pipeline(*steps):
+    """
+    Compile document helpers into a function processing a document in place,
+    and returning it. Each step is a helper, or a (helper, kwargs) tuple:
+
+        process = compile_pipeline(
+            (value_convert_to_number, {"skipped_keys" : ["chrom"]}),
+            unlist,
+            (dict_sweep, {"vals" : [".", "-", None]}))
+        for doc in docs:
+            yield process(doc)
+
+    gives the same as dict_sweep(unlist(value_convert_to_number(doc,...)),...),
+    but consecutive dict_sweep, unlist, value_convert_to_number, list_split
+    and value_convert steps are fused in a single traversal. Any other
+    function (eg. boolean_convert) is called on the whole document.
+    """
+    stages = []
+    fused = []
+    for step in steps:
+        func, kwargs = step if isinstance(step, tuple) else (step, {})
+        if func in PIPELINE_STEPS:
+            # same defaults as helper
+            args = inspect.signature(func).bind(None, **kwargs)
+            args.apply_defaults()
+            params = list(args.arguments.items())[1:]
+            fused.append(PIPELINE_STEPS[func](**dict(params)))
+        else:
+            if fused:
+                stages.append(fuse_steps(fused))
+                fused = []
+            stages.append(func if not kwargs else functools.partial(func, **kwargs))
+    if fused:
+        stages.append(fuse_steps(fused))
+
+    def process(doc):
+        for stage in stages:
+            doc = stage(doc)
+        return doc
+
+    return process
+
+
 #===============================================================================
 # Network Utility functions
 #===============================================================================
@@ -4,6 +4,7 @@ Utils to compare two list of gene documents
 import os
 import time
 import os.path
+import logging
 from .common import timesofar, dump, get_timestamp, filter_dict
 from .backend import DocMongoDBBackend
 from ..hub.databuild.backend import create_backend
@@ -172,12 +173,14 @@ def get_mongodb_uri(backend):
     return uri
 
 
-def diff_collections(b1, b2, use_parallel=True, step=10000):
+def diff_collections(b1, b2, use_parallel=True, step=10000, executor=None):
     """
     b1, b2 are one of supported backend class in databuild.backend.
     e.g.,
         b1 = DocMongoDBBackend(c1)
         b2 = DocMongoDBBackend(c2)
+    If use_parallel, comparisons are run using "executor" (eg. a
+    biothings.utils.parallel.RemoteWorkerExecutor), or local processes if None.
     """
 
     id_s1 = set(b1.get_id_list())
@@ -198,20 +201,21 @@ def diff_collections(b1, b2, use_parallel=True, step=10000):
         if not use_parallel:
             _updates = _diff_doc_inner_worker(b1, b2, list(id_common))
         else:
-            from .parallel import run_jobs_on_ipythoncluster
+            from .parallel import run_jobs
             _path = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0] + "/.."
             id_common = list(id_common)
             _b1 = (get_mongodb_uri(b1), b1.target_collection.database.name, b1.target_name, b1.name)
             _b2 = (get_mongodb_uri(b2), b2.target_collection.database.name, b2.target_name, b2.name)
             task_li = [(_b1, _b2, id_common[i: i + step], _path) for i in range(0, len(id_common), step)]
-            job_results = run_jobs_on_ipythoncluster(_diff_doc_worker, task_li)
+            try:
+                job_results = run_jobs(_diff_doc_worker, task_li, executor=executor)
+            except Exception:
+                # a partial diff would look like a complete one
+                logging.exception("Parallel diff jobs failed")
+                raise
             _updates = []
-            if job_results:
-                for res in job_results:
-                    _updates.extend(res)
-            else:
-                print("Parallel jobs failed or were interrupted.")
-                return None
+            for res in job_results:
+                _updates.extend(res)
 
         print("Done. [{} docs changed]".format(len(_updates)))
 
@@ -0,0 +1,142 @@
+"""
+Update path planning for BioThings mirrors.
+
+Releases are published as build metadata files: "full" releases (snapshots,
+can be applied whatever the current version is) and "incremental" ones (diff
+files going from "require_version" to a new version, "old.new" build_version).
+VersionPlanner fetches all release metadata concurrently and finds the
+cheapest sequence of releases (by total bytes) going from current version to
+the target one.
+"""
+import heapq, threading
+import logging
+import concurrent.futures
+from urllib.parse import urljoin, urlparse
+
+import requests
+
+
+def final_version(version):
+    """Version reached once release is applied ("20170101.20170201" => "20170201")"""
+    return version.split(".")[-1]
+
+
+class VersionPlanner(object):
+    """
+    "meta_url" is a function returning the URL of a version's build metadata.
+    HTTP requests are sent concurrently, using "max_workers" threads.
+    """
+
+    def __init__(self, meta_url, max_workers=8, session_factory=requests.Session, logger=logging):
+        self.meta_url = meta_url
+        self.max_workers = max_workers
+        self.session_factory = session_factory
+        self.logger = logger
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        # requests.Session isn't thread-safe, one per thread
+        if not hasattr(self.local,"session"):
+            self.local.session = self.session_factory()
+        return self.local.session
+
+    def fetch_json(self, url):
+        res = self.session.get(url)
+        if res.status_code != 200:
+            self.logger.warning("Can't get '%s' (status: %s)" % (url,res.status_code))
+            return None
+        try:
+            return res.json()
+        except ValueError:
+            self.logger.warning("Invalid JSON from '%s'" % url)
+            return None
+
+    def get_size(self, url):
+        res = self.session.head(url,allow_redirects=True)
+        length = res.headers.get("Content-Length")
+        return length and int(length) or 0
+
+    def map(self, func, items):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(func,items))
+
+    def load_steps(self, versions):
+        """
+        Fetch build metadata for "versions", and for incremental ones, the list
+        of diff files (with their size). Return list of steps, ie. dict with
+        "version", "type", "meta" (build metadata), "files" and "size" (total bytes,
+        None if unknown, which can be the case for full releases)
+        """
+        metas = self.map(lambda v: self.fetch_json(self.meta_url(v)),versions)
+        steps = []
+        for version,meta in zip(versions,metas):
+            if not meta:
+                continue
+            steps.append({"version" : meta["build_version"], "type" : meta["type"], "meta" : meta,
+                          "files" : [], "size" : meta["type"] == "full" and \
+                                  meta.get("metadata",{}).get("size") or None})
+        incs = [s for s in steps if s["type"] == "incremental"]
+        diff_metas = self.map(lambda s: self.fetch_json(s["meta"]["metadata"]["url"]),incs)
+        to_size = []
+        for step,metadata in zip(incs,diff_metas):
+            if not metadata:
+                # can't use this release
+                steps.remove(step)
+                continue
+            step["metadata"] = metadata
+            # "/" or urljoin will remove previous fragment...
+            base_url = step["meta"]["metadata"]["url"].rsplit("/",1)[0] + "/"
+            for entry in metadata["diff"]["files"]:
+                furl = urlparse(entry["name"]).scheme and entry["name"] or urljoin(base_url,entry["name"])
+                finfo = {"name" : entry["name"], "url" : furl, "md5sum" : entry.get("md5sum"),
+                         "size" : entry.get("size")}
+                step["files"].append(finfo)
+                if finfo["size"] is None:
+                    to_size.append(finfo)
+        for finfo,size in zip(to_size,self.map(lambda f: self.get_size(f["url"]),to_size)):
+            finfo["size"] = size
+        for step in incs:
+            step["size"] = sum([f["size"] for f in step["files"]])
+        return steps
+
+    def plan(self, steps, current, target):
+        """
+        Return cheapest list of steps going from "current" version (None if
+        nothing was applied yet) to "target" version, or None if not possible.
+        Full releases with an unknown size are only chosen when there's no other way.
+        """
+        # cost: (number of full releases with unknown size, bytes, number of steps)
+        heap = [((0,0,0),0,current,[])]
+        done = set()
+        counter = 1
+        while heap:
+            cost, _, version, path = heapq.heappop(heap)
+            if version == target:
+                return path
+            if version in done:
+                continue
+            done.add(version)
+            for step in steps:
+                if step["type"] == "incremental":
+                    if version is None or step["meta"]["require_version"] != version:
+                        continue
+                    new_cost = (cost[0],cost[1] + step["size"],cost[2] + 1)
+                else:
+                    unknown = step["size"] is None
+                    new_cost = (cost[0] + unknown,cost[1] + (step["size"] or 0),cost[2] + 1)
+                reached = final_version(step["version"])
+                if reached in done:
+                    continue
+                heapq.heappush(heap,(new_cost,counter,reached,path + [step]))
+                counter += 1
+        return None
+
+    def get_plan(self, versions, current, target):
+        """Load steps for available "versions" and plan from "current" to "target" version"""
+        # only releases going further than current version are useful
+        versions = [v for v in versions if (current is None or final_version(v) > current) \
+                and final_version(v) <= target]
+        steps = self.load_steps(versions)
+        self.logger.debug("%d release(s) found between '%s' and '%s'" % (len(steps),current,target))
+        return self.plan(steps,current,target)
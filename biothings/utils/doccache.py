@@ -0,0 +1,85 @@
+"""
+Compact binary cache of parsed documents.
+
+Documents are stored as BSON (each one starting with its length, as per BSON
+spec) in a block-compressed file (see bgzf), so they can be streamed back at
+disk speed instead of parsing raw files again:
+
+    for doc in write_through(load_data(...),"docs.bson.gz"):
+        ...   # cache is complete once all documents are consumed
+    for doc in read_docs("docs.bson.gz"):
+        ...
+
+Markers found between documents (objects with a "state" attribute, like
+uploader's Checkpoint) are kept in the cache too, and can be restored by
+passing their class to read_docs().
+"""
+import os, struct
+import logging
+
+from bson import BSON
+from bson.errors import InvalidDocument
+
+from biothings.utils.bgzf import BGZFWriter, open_bgzf
+
+MARKER_KEY = "__marker_state__"
+
+
+def write_through(docs, path, logger=logging):
+    """
+    Iterate over "docs", writing them in cache file "path". File is only
+    created if all documents were consumed and could be encoded.
+    """
+    tmp = "%s.%d.tmp" % (path,os.getpid())
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    fout = BGZFWriter(tmp,index=False)
+    complete = False
+    try:
+        for doc in docs:
+            if fout is not None:
+                try:
+                    if isinstance(doc,dict):
+                        fout.write(BSON.encode(doc))
+                    else:
+                        fout.write(BSON.encode({MARKER_KEY : doc.state}))
+                except (InvalidDocument, AttributeError, OverflowError) as e:
+                    logger.warning("Can't cache document, cache '%s' won't be written: %s" % (path,e))
+                    fout.close()
+                    os.unlink(tmp)
+                    fout = None
+            yield doc
+        complete = True
+    finally:
+        if fout is not None:
+            fout.close()
+            if complete:
+                os.rename(tmp,path)
+            else:
+                os.unlink(tmp)
+
+
+def read_docs(path, marker_class=None, from_marker=None):
+    """
+    Iterate over documents stored in cache file "path". Markers are returned
+    as marker_class(state) objects if marker_class is set, skipped otherwise.
+    If "from_marker" is set, documents before marker with this state are skipped.
+    """
+    skip = from_marker is not None
+    with open_bgzf(path,"rb") as fin:
+        while True:
+            head = fin.read(4)
+            if not head:
+                break
+            size, = struct.unpack("<i",head)
+            data = head + fin.read(size - 4)
+            if len(data) != size:
+                raise IOError("Truncated document in cache '%s'" % path)
+            doc = BSON(data).decode()
+            if MARKER_KEY in doc and len(doc) == 1:
+                if skip and doc[MARKER_KEY] == from_marker:
+                    skip = False
+                elif marker_class and not skip:
+                    yield marker_class(doc[MARKER_KEY])
+                continue
+            if not skip:
+                yield doc
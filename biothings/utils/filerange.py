@@ -0,0 +1,143 @@
+"""
+Line-aligned byte ranges of a single large file.
+
+A big input file (plain text or block-compressed, see bgzf) is split into
+ranges starting at the beginning of a line, each range owning the lines
+starting within it. Ranges are small picklable objects which can be sent to
+worker processes and opened there as regular text files (anyfile() and
+open_anyfile() accept them), so a parser written for the whole file can
+parse a range without any change:
+
+    ranges = split_file("data.tsv",parts=8,header=1,propagate_header=True)
+    # in workers:
+    for doc in tabfile_feeder(ranges[i],header=1):
+        ...
+"""
+import os, io
+
+from biothings.utils import bgzf
+
+# default range size, when number of parts isn't specified
+RANGE_SIZE = 256 * 1024 * 1024
+
+
+def open_raw(filename):
+    """Open "filename" in binary mode, seekable by uncompressed offset"""
+    if bgzf.is_bgzf(filename):
+        return bgzf.open_bgzf(filename,"rb")
+    elif os.path.splitext(filename)[1].lower() in (".gz",".zip",".bz2",".xz"):
+        raise ValueError("Can't split '%s', only plain or block-compressed (BGZF) files can be" % filename)
+    return open(filename,"rb")
+
+
+def get_size(filename):
+    """Return uncompressed size of "filename" """
+    if bgzf.is_bgzf(filename):
+        raw = bgzf.BGZFRawReader(filename,threads=1)
+        try:
+            return raw.get_size()
+        finally:
+            raw.close()
+    return os.path.getsize(filename)
+
+
+class RangeReader(io.RawIOBase):
+    """Read-only raw stream over [start,end) of a binary file, "header" bytes first"""
+
+    def __init__(self, fobj, start, end, header=b""):
+        super(RangeReader,self).__init__()
+        self.fobj = fobj
+        self.header = header
+        self.hpos = 0
+        self.fobj.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.hpos < len(self.header):
+            size = min(len(b),len(self.header) - self.hpos)
+            b[:size] = self.header[self.hpos:self.hpos + size]
+            self.hpos += size
+            return size
+        if self.remaining <= 0:
+            return 0
+        data = self.fobj.read(min(len(b),self.remaining))
+        self.remaining -= len(data)
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.fobj.close()
+        super(RangeReader,self).close()
+
+
+class FileRange(object):
+    """
+    Lines of "filename" starting within [start,end) uncompressed bytes.
+    "header" (bytes, usually file's header lines) is returned before range's
+    own content when propagated by split_file().
+    """
+
+    def __init__(self, filename, start, end, num=0, header=b""):
+        self.filename = filename
+        self.start = start
+        self.end = end
+        self.num = num
+        self.header = header
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return "<FileRange #%s %s [%s,%s)>" % (self.num,self.filename,self.start,self.end)
+
+    def open(self, mode="r", **kwargs):
+        """Return a file object, binary ("rb") or text ("r", extra kwargs passed to io.TextIOWrapper)"""
+        raw = RangeReader(open_raw(self.filename),self.start,self.end,self.header)
+        fobj = io.BufferedReader(raw)
+        if not "b" in mode:
+            fobj = io.TextIOWrapper(fobj,**kwargs)
+        return fobj
+
+
+def split_file(filename, parts=None, range_size=RANGE_SIZE, header=0, propagate_header=False):
+    """
+    Split "filename" into line-aligned FileRange objects, in file order,
+    either "parts" ranges or ranges of about "range_size" bytes. The first
+    "header" lines are only part of the first range, unless "propagate_header"
+    is True, then each range starts with them (so a parser skipping a header
+    works on any range).
+    """
+    size = get_size(filename)
+    with open_raw(filename) as fin:
+        hdata = b"".join([fin.readline() for _ in range(header)])
+        first = fin.tell()
+        parts = parts or max(1,(size - first + range_size - 1) // range_size)
+        step = max(1,(size - first) // parts)
+        bounds = [first]
+        for i in range(1,parts):
+            offset = first + i * step
+            if offset <= bounds[-1]:
+                continue
+            # move cut to the start of next line
+            fin.seek(offset - 1)
+            fin.readline()
+            offset = fin.tell()
+            if offset >= size:
+                break
+            if offset > bounds[-1]:
+                bounds.append(offset)
+        bounds.append(size)
+    ranges = []
+    for i,(start,end) in enumerate(zip(bounds[:-1],bounds[1:])):
+        if i == 0:
+            # header is part of the first range in any case
+            start = 0
+            rheader = b""
+        else:
+            rheader = propagate_header and hdata or b""
+        ranges.append(FileRange(filename,start,end,num=i,header=rheader))
+    return ranges
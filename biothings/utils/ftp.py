@@ -0,0 +1,305 @@
+"""
+FTP helpers: a reusable session reconnecting when the connection is dropped
+(and sending NOOP to keep it alive while idle), and a directory listing cache
+so file size and modification time can be checked with one MLSD (or LIST)
+command per directory instead of MDTM/SIZE commands per file.
+"""
+import os, time, threading
+import logging
+from datetime import datetime
+from ftplib import FTP, error_temp, error_perm
+
+# errors meaning the connection is lost or the server can't serve us right now
+RECONNECT_ERRORS = (EOFError, OSError, error_temp)
+
+MONTHS = {m : i + 1 for i,m in enumerate(["jan","feb","mar","apr","may","jun",
+                                           "jul","aug","sep","oct","nov","dec"])}
+
+
+def parse_timestamp(value):
+    """Convert FTP timestamp (YYYYMMDDHHMMSS[.sss], as in MDTM or MLSD) to epoch"""
+    return int(time.mktime(datetime.strptime(value[:14], '%Y%m%d%H%M%S').timetuple()))
+
+
+def parse_list_line(line, now=None):
+    """
+    Parse a Unix-style LIST line, such as:
+        -rw-r--r--   1 ftp      ftp        1234 Nov 28 15:00 file.gz
+        -rw-r--r--   1 ftp      ftp        1234 Nov 28  2012 file.gz
+    Return (name,facts) where facts contains "type", "size", "modify" (epoch)
+    and "precision" (modify's resolution in seconds). Return None if
+    line can't be parsed.
+    """
+    parts = line.split(None,8)
+    if len(parts) < 9 or len(parts[0]) < 10:
+        return None
+    perms, size, month, day, year_or_time, name = parts[0], parts[4], parts[5], parts[6], parts[7], parts[8]
+    ftype = {"d" : "dir", "l" : "link"}.get(perms[0],"file")
+    if ftype == "link":
+        name = name.split(" -> ")[0]
+    try:
+        month = MONTHS[month.lower()[:3]]
+        day = int(day)
+        if ":" in year_or_time:
+            # recent file: no year, time with a minute resolution
+            hour, minute = map(int,year_or_time.split(":"))
+            now = now or datetime.now()
+            dt = datetime(now.year,month,day,hour,minute)
+            if dt > now:
+                dt = dt.replace(year=now.year - 1)
+            precision = 60
+        else:
+            dt = datetime(int(year_or_time),month,day)
+            precision = 86400
+        size = int(size)
+    except (KeyError, ValueError):
+        return None
+    return (name,{"type" : ftype, "size" : size, "modify" : int(time.mktime(dt.timetuple())),
+                  "precision" : precision})
+
+
+class FTPSession(object):
+    """
+    ftplib.FTP connection logged in (and moved to "cwd" folder), reconnecting
+    (up to "max_retries" times) when the connection is dropped by the server.
+    ftplib.FTP methods can be called on the session directly.
+    When idle for more than "keepalive" seconds, a NOOP command is sent to
+    prevent the server from closing the connection (None to disable), until
+    the session isn't used for "max_idle" seconds: connection is then closed
+    (and opened again if the session is used later).
+    """
+
+    def __init__(self, host, user="", passwd="", cwd=None, port=21, timeout=60, keepalive=60,
+                 max_retries=3, listing_ttl=300, max_idle=300, logger=logging):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.workdir = cwd
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.max_retries = max_retries
+        self.logger = logger
+        self.ftp = None
+        self.closed = False
+        self.last_used = time.time()
+        # last command sent by user (not keepalive)
+        self.last_active = time.time()
+        self.lock = threading.RLock()
+        self.listing = DirCache(self,ttl=listing_ttl)
+        self.keepalive_thread = None
+
+    def connect(self):
+        with self.lock:
+            self.disconnect()
+            self.ftp = FTP(timeout=self.timeout)
+            self.ftp.connect(self.host,self.port)
+            self.ftp.login(self.user,self.passwd)
+            if self.workdir:
+                self.ftp.cwd(self.workdir)
+            self.closed = False
+            self.last_used = self.last_active = time.time()
+            if self.keepalive and not self.keepalive_thread:
+                self.keepalive_thread = threading.Thread(target=self.keep_alive,daemon=True)
+                self.keepalive_thread.start()
+
+    def disconnect(self):
+        with self.lock:
+            if self.ftp:
+                try:
+                    self.ftp.close()
+                except Exception:
+                    pass
+                self.ftp = None
+
+    def close(self):
+        self.closed = True
+        self.disconnect()
+
+    def keep_alive(self):
+        while not self.closed:
+            time.sleep(max(self.keepalive / 4,0.1))
+            with self.lock:
+                if self.max_idle and time.time() - self.last_active > self.max_idle:
+                    # not used anymore, don't keep server's connection (reconnecting on next call)
+                    self.logger.debug("FTP session on '%s' idle, disconnecting" % self.host)
+                    self.disconnect()
+                    # cleared while locked, so connect() starts a new thread
+                    self.keepalive_thread = None
+                    return
+                if self.ftp and time.time() - self.last_used > self.keepalive:
+                    try:
+                        self.ftp.voidcmd("NOOP")
+                    except RECONNECT_ERRORS:
+                        # will reconnect on next call
+                        self.disconnect()
+                    self.last_used = time.time()
+        with self.lock:
+            self.keepalive_thread = None
+
+    def run(self, func, can_retry=None):
+        """
+        Call func(ftp) with ftplib.FTP connection, reconnecting and calling it
+        again if the connection was lost (and can_retry() returns True, if set)
+        """
+        retries = 0
+        while True:
+            with self.lock:
+                try:
+                    if not self.ftp:
+                        self.connect()
+                    res = func(self.ftp)
+                    self.last_used = self.last_active = time.time()
+                    return res
+                except RECONNECT_ERRORS as e:
+                    self.disconnect()
+                    retries += 1
+                    if retries > self.max_retries or (can_retry and not can_retry()):
+                        raise
+                    self.logger.debug("FTP command on '%s' failed (%s), reconnecting (%d/%d)" % \
+                            (self.host,e,retries,self.max_retries))
+            time.sleep(min(2 ** retries * 0.1,10))
+
+    def sendcmd(self, cmd):
+        return self.run(lambda ftp: ftp.sendcmd(cmd))
+
+    def voidcmd(self, cmd):
+        return self.run(lambda ftp: ftp.voidcmd(cmd))
+
+    def cwd(self, dirname):
+        res = self.run(lambda ftp: ftp.cwd(dirname))
+        # so we get back there after reconnecting
+        self.workdir = self.run(lambda ftp: ftp.pwd())
+        self.listing.clear()
+        return res
+
+    def mlsd(self, path="", facts=[]):
+        # ftplib's mlsd() is a generator, consume it so errors are raised here
+        return self.run(lambda ftp: list(ftp.mlsd(path,facts)))
+
+    def retrlines(self, cmd, callback=None):
+        lines = []
+        res = self.run(lambda ftp: lines.clear() or ftp.retrlines(cmd,lines.append))
+        for line in lines:
+            if callback:
+                callback(line)
+            else:
+                print(line)
+        return res
+
+    def retrbinary(self, cmd, callback, blocksize=8192):
+        """
+        Same as ftplib.FTP.retrbinary(), retried after reconnecting only if no data
+        was received (otherwise callback would get the same data twice)
+        """
+        received = [False]
+        def cb(data):
+            received[0] = True
+            callback(data)
+        return self.run(lambda ftp: ftp.retrbinary(cmd,cb,blocksize=blocksize),
+                        can_retry=lambda: not received[0])
+
+    def __getattr__(self, name):
+        # other ftplib.FTP methods, called with reconnection
+        if name.startswith("_") or not hasattr(FTP,name):
+            raise AttributeError(name)
+        if not callable(getattr(FTP,name)):
+            return getattr(self.ftp,name,None)
+        def method(*args,**kwargs):
+            return self.run(lambda ftp: getattr(ftp,name)(*args,**kwargs))
+        return method
+
+    def get_mtime(self, remotefile):
+        """Return remote file's modification time (epoch), from directory listing if possible"""
+        facts = self.listing.get(remotefile)
+        if facts and facts.get("modify") and facts.get("precision",1) == 1:
+            return facts["modify"]
+        response = self.sendcmd('MDTM ' + remotefile)
+        code, lastmodified = response.split()
+        return parse_timestamp(lastmodified)
+
+    def is_newer(self, remotefile, mtime):
+        """
+        Return True if remotefile was modified after "mtime" (epoch). If only
+        LIST is supported, times are compared at listing's resolution (minute or day)
+        """
+        facts = self.listing.get(remotefile)
+        if facts and facts.get("modify") and facts.get("precision",1) > 1:
+            fmt = facts["precision"] == 60 and "%Y%m%d%H%M" or "%Y%m%d"
+            return time.strftime(fmt,time.localtime(facts["modify"])) > time.strftime(fmt,time.localtime(mtime))
+        return self.get_mtime(remotefile) > mtime
+
+    def get_size(self, remotefile):
+        """Return remote file's size, from directory listing if possible"""
+        facts = self.listing.get(remotefile)
+        if facts and facts.get("size") is not None:
+            return facts["size"]
+        self.sendcmd("TYPE I")
+        response = self.sendcmd('SIZE ' + remotefile)
+        code, size = map(int,response.split())
+        return size
+
+
+class DirCache(object):
+    """
+    Directory listings, fetched with one MLSD command per directory (or LIST if
+    server doesn't support MLSD), kept "ttl" seconds. Entries are dict of facts
+    with (when known) "type", "size", "modify" (epoch) and "precision" (modify's
+    resolution in seconds, 1 for MLSD, 60 or 86400 for LIST).
+    """
+
+    def __init__(self, session, ttl=300):
+        self.session = session
+        self.ttl = ttl
+        self.dirs = {}
+        self.use_mlsd = True
+
+    def clear(self):
+        self.dirs = {}
+
+    def listdir(self, path=""):
+        path = path.rstrip("/")
+        if path in self.dirs and (self.ttl is None or time.time() - self.dirs[path][0] < self.ttl):
+            return self.dirs[path][1]
+        entries = None
+        if self.use_mlsd:
+            try:
+                entries = {}
+                for name,facts in self.session.mlsd(path,["type","size","modify"]):
+                    if name in (".","..") or facts.get("type") in ("cdir","pdir"):
+                        continue
+                    entry = {"type" : facts.get("type")}
+                    if "size" in facts:
+                        entry["size"] = int(facts["size"])
+                    if "modify" in facts:
+                        entry["modify"] = parse_timestamp(facts["modify"])
+                        entry["precision"] = 1
+                    entries[name] = entry
+            except error_perm as e:
+                # 500/502: command not supported, others (eg. 550, no such
+                # directory) are about this path only
+                if not str(e).startswith(("500","502")):
+                    raise
+                self.session.logger.debug("MLSD not supported on '%s' (%s), using LIST" % (self.session.host,e))
+                self.use_mlsd = False
+                entries = None
+        if entries is None:
+            lines = []
+            self.session.retrlines(path and "LIST %s" % path or "LIST",lines.append)
+            entries = {}
+            for line in lines:
+                parsed = parse_list_line(line)
+                if parsed:
+                    entries[parsed[0]] = parsed[1]
+        self.dirs[path] = (time.time(),entries)
+        return entries
+
+    def get(self, remotefile):
+        """Return facts about remotefile (path relative to session's cwd), or None if unknown"""
+        dirname, name = os.path.split(remotefile)
+        try:
+            return self.listdir(dirname).get(name)
+        except error_perm:
+            # can't list this directory
+            return None
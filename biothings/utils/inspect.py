@@ -172,10 +172,11 @@ def inspect(struct,key=None,mapt=None,mode="type",level=0,logger=logging):
             mapt[typ] = {}
         elif mode == "mapping":
             # splittable string ?
+            # (precedence: splitable > non-splitable, whatever the order)
             if is_str(struct) and len(re.split(" +",struct.strip())) > 1:
                 mapt[typ] = {"split":{}}
             else:
-                mapt[typ] = {}
+                mapt.setdefault(typ,{})
         else:
             mapt.setdefault(typ,copy.deepcopy(stats_tpl))
             if is_str(struct):
@@ -290,6 +291,30 @@ def inspect_docs(docs,mode="type",clean=True,merge=False,logger=logging):
     return mapt
 
 
+def merge_inspect(target, tomerge):
+    """
+    Merge inspect results "tomerge" into "target", so documents can be
+    inspected in several parts (eg. batches, processes) and results merged
+    at the end. Only for modes "type" and "mapping" (splitable strings win):
+    merging is a union, merging the same results again doesn't change target.
+    """
+    for k in tomerge:
+        if k in target:
+            merge_inspect(target[k],tomerge[k])
+        else:
+            target[k] = copy.deepcopy(tomerge[k])
+    return target
+
+
+def stringify_inspect_doc(mapt):
+    """Return inspect results with types as strings (eg. to be stored in mongo)"""
+    res = {}
+    for k in mapt:
+        key = k.__name__ if type(k) == type else k
+        res[key] = stringify_inspect_doc(mapt[k]) if type(mapt[k]) == dict else mapt[k]
+    return res
+
+
 if __name__ == "__main__":
     d1 = {"id" : "124",'lofd': [{"val":34.3},{"ul":"bla"}],"d":{"start":134,"end":5543}}
     d2 = {"id" : "5",'lofd': {"oula":"mak","val":34},"d":{"start":134,"end":5543}}
@@ -0,0 +1,171 @@
+"""
+Event loop lag monitoring.
+
+A heartbeat coroutine wakes up every "interval" seconds and measures how late
+it was woken up (the loop lag). Meanwhile, a watchdog thread checks the heartbeat
+is still beating: if not, the loop is blocked by some callback, and the stack
+of the loop's thread is captured so the offending function can be reported.
+"""
+import sys, os, time, threading, traceback, logging
+import asyncio
+from collections import deque, OrderedDict
+
+
+STDLIB_DIR = os.path.dirname(os.__file__)
+
+
+def is_stdlib(filename):
+    return filename.startswith(STDLIB_DIR) and \
+            not "site-packages" in filename and not "dist-packages" in filename
+
+
+class LoopMonitor(object):
+
+    def __init__(self, loop=None, interval=0.1, threshold=0.5, history=1000, logger=logging):
+        """
+        "interval" is the heartbeat period, "threshold" is the lag (in seconds) from
+        which a callback is considered blocking (its stack is then captured and reported).
+        "history" is the number of lag measures kept to compute statistics.
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.threshold = threshold
+        self.logger = logger
+        self.lags = deque(maxlen=history)
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.beats = 0
+        self.stalls = 0
+        # offender key => stats
+        self.offenders = {}
+        self._lock = threading.Lock()
+        self._loop_thread_id = None
+        self._last_beat = None
+        self._capture = None
+        self._heartbeat_task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start monitoring. Must be called from loop's thread"""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._heartbeat_task = asyncio.ensure_future(self.heartbeat(),loop=self.loop)
+        self._watchdog = threading.Thread(target=self.watch,name="loop-watchdog",daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    @asyncio.coroutine
+    def heartbeat(self):
+        while not self._stop.is_set():
+            t0 = self.loop.time()
+            yield from asyncio.sleep(self.interval)
+            lag = max(self.loop.time() - t0 - self.interval,0.0)
+            self.register_lag(lag)
+
+    def register_lag(self, lag):
+        with self._lock:
+            self._last_beat = time.monotonic()
+            self.beats += 1
+            self.lags.append(lag)
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag,lag)
+            capture = self._capture
+            self._capture = None
+            if capture:
+                self.stalls += 1
+                key, stack = capture
+                info = self.offenders.setdefault(key,{"count" : 0, "total" : 0.0, "max" : 0.0, "stack" : None})
+                info["count"] += 1
+                info["total"] += lag
+                info["max"] = max(info["max"],lag)
+                info["stack"] = stack
+        if capture:
+            self.logger.warning("Event loop blocked for %.3fs by %s:\n%s" % (lag,key,"".join(stack)))
+
+    def watch(self):
+        # check more often than threshold so we catch the callback while it's still running
+        period = min(self.interval,self.threshold) / 2
+        while not self._stop.wait(period):
+            with self._lock:
+                if self._capture or self._last_beat is None:
+                    continue
+                blocked = time.monotonic() - self._last_beat - self.interval
+            if blocked < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            with self._lock:
+                self._capture = (self.get_offender(stack),traceback.format_list(stack))
+
+    def get_offender(self, stack):
+        """
+        Return the function responsible for blocking the loop: the innermost
+        frame outside python's standard library (eg. a helper called by the
+        coroutine run by the loop, and which is sleeping or reading a file)
+        """
+        frame = stack[-1]
+        for f in reversed(stack):
+            if not is_stdlib(f.filename):
+                frame = f
+                break
+        # no line number, so all blocking calls from the same function are aggregated
+        return "%s (%s)" % (frame.name,frame.filename)
+
+    def get_metrics(self):
+        with self._lock:
+            lags = sorted(self.lags)
+            last = self.lags and self.lags[-1] or 0.0
+            mean = self.beats and self.total_lag / self.beats or 0.0
+            stalls = self.stalls
+            max_lag = self.max_lag
+        def percentile(p):
+            if not lags:
+                return 0.0
+            return lags[min(int(len(lags) * p),len(lags) - 1)]
+        return OrderedDict([("loop_lag_last",last),
+                            ("loop_lag_mean",mean),
+                            ("loop_lag_p50",percentile(0.5)),
+                            ("loop_lag_p99",percentile(0.99)),
+                            ("loop_lag_max",max_lag),
+                            ("loop_stalls",stalls)])
+
+    def get_offenders(self):
+        """Return offenders sorted by total blocking time"""
+        with self._lock:
+            offenders = [(k,dict(v)) for k,v in self.offenders.items()]
+        return OrderedDict(sorted(offenders,key=lambda e: e[1]["total"],reverse=True))
+
+    def reset(self):
+        with self._lock:
+            self.lags.clear()
+            self.max_lag = self.total_lag = 0.0
+            self.beats = self.stalls = 0
+            self.offenders = {}
+
+    def report(self, stack=None):
+        """
+        Print loop lag statistics and functions which blocked the loop.
+        Pass an offender's rank (starting from 1) as "stack" to display
+        the last captured stack for it.
+        """
+        metrics = self.get_metrics()
+        print("Loop lag: last %.3fs, mean %.3fs, p50 %.3fs, p99 %.3fs, max %.3fs" % \
+                (metrics["loop_lag_last"],metrics["loop_lag_mean"],metrics["loop_lag_p50"],
+                 metrics["loop_lag_p99"],metrics["loop_lag_max"]))
+        print("%d stall(s) over %.1fs threshold" % (metrics["loop_stalls"],self.threshold))
+        offenders = self.get_offenders()
+        for i,(key,info) in enumerate(offenders.items()):
+            print("%3d. %-70s %5d time(s), total %.3fs, max %.3fs" % \
+                    (i + 1,key,info["count"],info["total"],info["max"]))
+            if stack == i + 1:
+                print("".join(info["stack"]))
@@ -4,8 +4,9 @@ import os, pickle, inspect, types, glob, psutil
 from functools import wraps, partial
 import time, datetime
 from pprint import pprint
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 
 from biothings import config
 logger = config.logger
@@ -13,6 +14,7 @@ logger = config.logger
 from biothings.utils.hub_db import get_hub_db_conn
 from biothings.utils.common import timesofar, get_random_string, sizeof_fmt
 from biothings.utils.hub import find_process
+from biothings.utils import metrics
 
 
 def track(func):
@@ -94,6 +96,9 @@ def track(func):
                 except Exception:
                     worker["err"] = str(exc)
                     pickle.dump(worker,open(pidfile,"wb"))
+            if ptype == "process":
+                # make sure hub gets latest metrics from this worker
+                metrics.flush_registry()
         # now raise original exception
         if exc:
             raise exc
@@ -111,6 +116,198 @@ def do_work(ptype, pinfo=None, func=None, *args, **kwargs):
     # issues ("can't pickle ... object is not the same as ...")
     return func(*args,**kwargs)
 
+class WorkItem(object):
+    """
+    Keeps track of a job submitted to a RecyclingProcessPoolExecutor,
+    mimicking what ProcessPoolExecutor keeps in its _pending_work_items
+    (JobManager uses this to report pending jobs)
+    """
+    def __init__(self, future, fn, args, kwargs):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+
+class WorkerSlot(object):
+    """
+    One worker process in a RecyclingProcessPoolExecutor
+    (a single-process ProcessPoolExecutor plus some counters),
+    running one job at a time
+    """
+    def __init__(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        self.tasks = 0      # number of jobs done by this worker
+        self.busy = False   # running a job
+        self.started_at = time.time()
+        self.release_thread = None  # set once retired
+
+    @property
+    def pid(self):
+        # worker process is only started on first submission
+        pids = list(self.executor._processes or {})
+        return pids and pids[0] or None
+
+    @property
+    def memory(self):
+        pid = self.pid
+        if not pid:
+            return 0
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.NoSuchProcess:
+            return 0
+
+
+class RecyclingProcessPoolExecutor(concurrent.futures.Executor):
+    """
+    Process pool where each worker can be retired and replaced on its own,
+    instead of shutting down the whole pool. Jobs wait in a single queue and
+    are given to the first idle worker, one at a time. A worker is recycled,
+    between two jobs, once it has run "max_tasks_per_worker" jobs, or when its
+    memory usage (RSS) is above "max_worker_memory" bytes. Jobs running in
+    other workers are not disturbed.
+    """
+
+    def __init__(self, max_workers=None, max_tasks_per_worker=None, max_worker_memory=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_worker_memory = max_worker_memory
+        self.recycled = 0
+        self._lock = threading.RLock()
+        self._shutdown = False
+        self._work_cnt = 0
+        # queued and running jobs
+        self._pending_work_items = {}
+        # work ids waiting for an idle worker
+        self._queue = deque()
+        self._retired = []
+        self._slots = [WorkerSlot() for i in range(self.max_workers)]
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            f = concurrent.futures.Future()
+            work_id = self._work_cnt
+            self._work_cnt += 1
+            self._pending_work_items[work_id] = WorkItem(f,fn,args,kwargs)
+            self._queue.append(work_id)
+            self._dispatch()
+        return f
+
+    def _dispatch(self):
+        # called with lock acquired: give queued jobs to idle workers
+        for slot in list(self._slots):
+            if slot.busy or not slot in self._slots:
+                continue
+            while self._queue:
+                work_id = self._queue.popleft()
+                item = self._pending_work_items[work_id]
+                # already running if given back after a failed submission
+                if not item.future.running() and not item.future.set_running_or_notify_cancel():
+                    # cancelled while queued
+                    del self._pending_work_items[work_id]
+                    continue
+                try:
+                    f = slot.executor.submit(item.fn,*item.args,**item.kwargs)
+                except Exception as e:
+                    # worker process died while idle, job didn't run: give it to the next worker
+                    self._queue.appendleft(work_id)
+                    logger.info("Recycling worker process %s: %s" % (slot.pid,e))
+                    self._retire(slot)
+                    return self._dispatch()
+                slot.busy = True
+                f.add_done_callback(partial(self._work_done,slot,work_id))
+                break
+
+    def _work_done(self, slot, work_id, f):
+        with self._lock:
+            item = self._pending_work_items.pop(work_id)
+            slot.busy = False
+            slot.tasks += 1
+            reason = None
+            if self._shutdown or not slot in self._slots:
+                pass # already retired
+            elif isinstance(f.exception(),BrokenProcessPool):
+                # process died (killed, OOM, ...), only this worker is affected, replace it
+                reason = "worker process died"
+            elif self.max_tasks_per_worker and slot.tasks >= self.max_tasks_per_worker:
+                reason = "%d jobs done" % slot.tasks
+            elif self.max_worker_memory:
+                mem = slot.memory
+                if mem > self.max_worker_memory:
+                    reason = "using %s (max: %s)" % (sizeof_fmt(mem),sizeof_fmt(self.max_worker_memory))
+            if reason:
+                logger.info("Recycling worker process %s: %s" % (slot.pid,reason))
+                self._retire(slot)
+        if f.exception() is not None:
+            item.future.set_exception(f.exception())
+        else:
+            item.future.set_result(f.result())
+        with self._lock:
+            self._dispatch()
+
+    def _retire(self, slot):
+        # called with lock acquired. Return the thread shutting down slot's
+        # executor: shutdown waits for a running job, it mustn't block the
+        # caller (usually the executor's management thread, running done callbacks)
+        self._slots[self._slots.index(slot)] = WorkerSlot()
+        self._retired.append(slot)
+        self.recycled += 1
+        def release():
+            slot.executor.shutdown(wait=True)
+            with self._lock:
+                self._retired.remove(slot)
+        slot.release_thread = threading.Thread(target=release,daemon=True)
+        slot.release_thread.start()
+        return slot.release_thread
+
+    def recycle(self, wait=False):
+        """
+        Retire all current workers, replacing them with new ones. Workers
+        running a job will exit once it's done. If "wait", block until
+        retired workers have terminated.
+        """
+        with self._lock:
+            threads = [self._retire(slot) for slot in list(self._slots)]
+            self._dispatch()
+        if wait:
+            # executors are shut down (once) by these threads
+            for thread in threads:
+                thread.join()
+
+    def shutdown(self, wait=True):
+        """
+        If "wait", block until queued and running jobs are done. Otherwise
+        queued jobs are cancelled
+        """
+        with self._lock:
+            self._shutdown = True
+            if not wait:
+                while self._queue:
+                    item = self._pending_work_items.pop(self._queue.popleft())
+                    item.future.cancel()
+            futures = [item.future for item in self._pending_work_items.values()]
+        if wait:
+            concurrent.futures.wait(futures)
+        with self._lock:
+            slots = list(self._slots)
+            retired = list(self._retired)
+        for slot in slots:
+            slot.executor.shutdown(wait=wait)
+        if wait:
+            # already shutting down
+            for slot in retired:
+                slot.release_thread.join()
+
+    def get_workers(self):
+        """Return information about current worker processes"""
+        with self._lock:
+            return [{"pid" : slot.pid, "tasks" : slot.tasks, "busy" : slot.busy,
+                     "mem" : slot.memory, "started_at" : slot.started_at} for slot in self._slots]
+
+
 class UnknownResource(Exception):
     pass
 class ResourceError(Exception):
@@ -259,12 +456,24 @@ class JobManager(object):
     DATALINE = HEADERLINE.replace("^","<")
 
     def __init__(self, loop, process_queue=None, thread_queue=None, max_memory_usage=None,
-            num_workers=None,default_executor="thread",auto_recycle=True):
+            num_workers=None,default_executor="thread",auto_recycle=True,
+            max_tasks_per_worker=None, max_worker_memory=None, remote_queue=None):
+        """
+        If "max_tasks_per_worker" or "max_worker_memory" is set (and no process_queue
+        is passed), worker processes are recycled individually (see RecyclingProcessPoolExecutor)
+        "remote_queue" is an optional RemoteWorkerExecutor (see biothings.utils.parallel):
+        jobs flagged with pinfo["__remote__"] can then run on remote workers.
+        """
         self.loop = loop
         self.num_workers = num_workers
+        if not process_queue and (max_tasks_per_worker or max_worker_memory):
+            process_queue = RecyclingProcessPoolExecutor(max_workers=self.num_workers,
+                                                         max_tasks_per_worker=max_tasks_per_worker,
+                                                         max_worker_memory=max_worker_memory)
         self.process_queue = process_queue or concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers)
         # TODO: limit the number of threads (as argument) ?
         self.thread_queue = thread_queue or concurrent.futures.ThreadPoolExecutor()
+        self.remote_queue = remote_queue
         if default_executor == "thread":
             self.loop.set_default_executor(self.thread_queue)
         else:
@@ -318,25 +527,34 @@ class JobManager(object):
         perform a clean shutdown on current queue, waiting for running
         processes to terminate, then discard current queue and replace
         it a new one.
+        If process queue is a RecyclingProcessPoolExecutor, each worker is replaced
+        on its own, without waiting for other workers' running jobs.
         """
+        recycling = isinstance(self.process_queue,RecyclingProcessPoolExecutor)
         @asyncio.coroutine
         def do():
             try:
                 # shutting down the process queue can take a while
                 # if some processes are still running (it'll wait until they're done)
                 # we'll wait in a thread to prevent the hub from being blocked
-                logger.info("Shutting down current process queue...")
                 pinfo = {"__skip_check__" : True, # skip sanity check, mem check to make sure
                                                   # this worker will be run
                          "category" : "admin",
                          "source" : "maintenance",
                          "step" : "",
                          "description" : "Recycling process queue"}
-                j = yield from self.defer_to_thread(pinfo,self.process_queue.shutdown)
-                yield from j
-                # now replace
-                logger.info("Replacing process queue with new one")
-                self.process_queue = concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers)
+                if recycling:
+                    # workers are replaced right away, only wait for retired ones to exit
+                    logger.info("Recycling worker processes...")
+                    j = yield from self.defer_to_thread(pinfo,partial(self.process_queue.recycle,wait=True))
+                    yield from j
+                else:
+                    logger.info("Shutting down current process queue...")
+                    j = yield from self.defer_to_thread(pinfo,self.process_queue.shutdown)
+                    yield from j
+                    # now replace
+                    logger.info("Replacing process queue with new one")
+                    self.process_queue = concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers)
                 # and ready to go
             except Exception as e:
                 logger.error("Error while recycling the process queue: %s" % e)
@@ -415,11 +633,35 @@ class JobManager(object):
             if self.auto_recycle_setting:
                 self.auto_recycle = self.auto_recycle_setting
 
+    @property
+    def process_capacity(self):
+        return getattr(self.process_queue,"max_workers",None) or self.process_queue._max_workers
+
+    def use_remote(self, pinfo):
+        """
+        Return True if job should run on remote workers: job allows it, and
+        remote workers are less busy than local ones (relatively to their capacity)
+        """
+        if not self.remote_queue or not (pinfo and pinfo.get("__remote__")):
+            return False
+        capacity = self.remote_queue.capacity
+        if not capacity:
+            return False
+        local_load = len(self.process_queue._pending_work_items) / self.process_capacity
+        return self.remote_queue.load / capacity <= local_load
+
     @asyncio.coroutine
     def defer_to_process(self, pinfo=None, func=None, *args):
 
         @asyncio.coroutine
         def run(future):
+            if self.use_remote(pinfo):
+                # local memory and queue limits don't apply there
+                self.ok_to_run.release()
+                res = yield from asyncio.wrap_future(self.remote_queue.submit_job(pinfo,func,*args),
+                                                     loop=self.loop)
+                future.set_result(res)
+                return
             yield from self.checkmem(pinfo)
             self.ok_to_run.release()
             res = yield from self.loop.run_in_executor(self.process_queue,
@@ -578,6 +820,22 @@ class JobManager(object):
                     print(e)
                     pprint(info)
 
+    def print_remote_workers(self,jobs):
+        if jobs:
+            print(self.__class__.HEADERLINE.format(**self.__class__.HEADER))
+            for name,pinfo,started_at in jobs:
+                worker = {"info" : dict(pinfo or {},id=name), "started_at" : started_at or time.time()}
+                info = self.extract_worker_info(worker)
+                tt = datetime.datetime.fromtimestamp(info["started_at"]).timetuple()
+                info["started_at"] = time.strftime("%Y/%m/%d %H:%M:%S",tt)
+                info["mem"] = ""
+                info["cpu"] = ""
+                try:
+                    print(self.__class__.DATALINE.format(**info))
+                except (TypeError, KeyError) as e:
+                    print(e)
+                    pprint(info)
+
     def print_pending_info(self,num,info):
         assert type(info) == dict
         info["cpu"] = ""
@@ -600,12 +858,37 @@ class JobManager(object):
         tworkers = self.get_thread_files()
         self.print_workers(pworkers)
         self.print_workers(tworkers)
-        print("%d running job(s)" % (len(pworkers) + len(tworkers)))
+        rworkers = self.remote_queue and self.remote_queue.get_running() or []
+        self.print_remote_workers(rworkers)
+        print("%d running job(s)" % (len(pworkers) + len(tworkers) + len(rworkers)))
+        if self.remote_queue:
+            print("%d remote worker(s), %d job(s) queued or running for a capacity of %d" % \
+                    (len(self.remote_queue.get_workers()),self.remote_queue.load,self.remote_queue.capacity))
+        if isinstance(self.process_queue,RecyclingProcessPoolExecutor):
+            print("%d worker process(es) recycled so far" % self.process_queue.recycled)
         print("%s, type 'top(pending)' for more" % self.get_pending_summary())
         done_jobs = glob.glob(os.path.join(config.RUN_DIR,"done","*.pickle"))
         if done_jobs:
             print("%s finished job(s), type 'top(done)' for more" % len(done_jobs))
 
+    def get_metrics(self):
+        """
+        Return queue depths and worker utilization, as a dict
+        """
+        running = len(self.get_pid_files())
+        pmax = self.process_capacity
+        tmax = self.thread_queue._max_workers
+        trunning = len(self.get_thread_files())
+        return OrderedDict([("process_queue_pending",max(len(self.process_queue._pending_work_items) - running,0)),
+                            ("process_queue_running",running),
+                            ("process_workers_utilization",pmax and running / pmax or 0.0),
+                            ("thread_queue_pending",self.thread_queue._work_queue.qsize()),
+                            ("thread_queue_running",trunning),
+                            ("thread_workers_utilization",tmax and trunning / tmax or 0.0),
+                            ("hub_memory",self.hub_memory)] + \
+                           (self.remote_queue and [("remote_workers_capacity",self.remote_queue.capacity),
+                                                   ("remote_queue_load",self.remote_queue.load)] or []))
+
     def get_pending_summary(self,getstr=False):
         running = len(self.get_pid_files())
         return "%d pending job(s)" % (len(self.process_queue._pending_work_items) - running)
@@ -0,0 +1,306 @@
+"""
+Hub metrics: documents and bytes processed per pipeline step and source.
+
+Workers call record() as they process data. Counters are kept in a
+process-local registry, regularly flushed to a file named after the process'
+pid in RUN_DIR/metrics. The hub's MetricsCollector periodically aggregates
+these files (and its own registry), computes throughputs (docs/s, bytes/s)
+over a sliding window and adds gauges such as queue depths and worker utilization.
+Time spent in each phase of a step (eg. "parse" vs. "write" while uploading)
+can also be accounted, to find out which one is the bottleneck.
+"""
+import os, time, glob, pickle, threading
+import logging
+import asyncio
+from collections import OrderedDict, deque
+
+try:
+    from biothings import config
+    logger = config.logger
+except ImportError:
+    # not running from a configured application (eg. storages used in tests),
+    # config is only needed once metrics are written
+    logger = logging
+from biothings.utils.common import sizeof_fmt
+
+
+STEPS = ["dump","upload","merge","diff","sync","index"]
+# don't write metrics file more often than this (seconds)
+FLUSH_INTERVAL = 2.0
+PROMETHEUS_PREFIX = "biothings_hub"
+
+_registry = {}
+_lock = threading.Lock()
+_last_flush = 0.0
+# process owning the registry: a forked process inherits its parent's
+# counters, which must not be written again under the child's pid
+_registry_pid = os.getpid()
+
+
+def _check_pid():
+    # called with lock acquired
+    global _registry_pid, _last_flush
+    if os.getpid() != _registry_pid:
+        _registry.clear()
+        _registry_pid = os.getpid()
+        _last_flush = 0.0
+
+
+def get_metrics_dir():
+    from biothings import config
+    return os.path.join(config.RUN_DIR,"metrics")
+
+
+def escape_label(value):
+    """Escape label value for Prometheus text format"""
+    return str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+
+def new_counters():
+    return {"docs" : 0, "bytes" : 0, "timings" : {}}
+
+
+def record(step, source, docs=0, size=0, timings=None, flush=False):
+    """
+    Account "docs" documents and/or "size" bytes processed for "source"
+    during pipeline "step" (one of STEPS). "timings" is a dict of
+    phase name => seconds spent in this phase
+    """
+    global _last_flush
+    with _lock:
+        _check_pid()
+        counters = _registry.setdefault((step,source),new_counters())
+        counters["docs"] += docs
+        counters["bytes"] += size
+        for phase,secs in (timings or {}).items():
+            counters["timings"][phase] = counters["timings"].get(phase,0.0) + secs
+    if flush or time.time() - _last_flush > FLUSH_INTERVAL:
+        _last_flush = time.time()
+        flush_registry()
+
+
+def get_registry():
+    with _lock:
+        _check_pid()
+        return dict([(k,dict(v,timings=dict(v["timings"]))) for k,v in _registry.items()])
+
+
+def flush_registry():
+    """
+    Write process' counters to its metrics file, so the hub can collect them.
+    Counters are cumulative, file is replaced each time.
+    """
+    registry = get_registry()
+    if not registry:
+        return
+    mdir = get_metrics_dir()
+    if not os.path.exists(mdir):
+        os.makedirs(mdir,exist_ok=True)
+    fn = os.path.join(mdir,"%s.pickle" % os.getpid())
+    tmpfn = fn + ".tmp"
+    try:
+        pickle.dump(registry,open(tmpfn,"wb"))
+        # atomic, hub never reads a partially written file
+        os.rename(tmpfn,fn)
+    except Exception as e:
+        logger.warning("Can't write metrics file '%s': %s" % (fn,e))
+
+
+def merge_registries(registries):
+    totals = {}
+    for registry in registries:
+        for key,counters in registry.items():
+            tot = totals.setdefault(key,new_counters())
+            tot["docs"] += counters["docs"]
+            tot["bytes"] += counters["bytes"]
+            # files written by previous versions have no timings
+            for phase,secs in counters.get("timings",{}).items():
+                tot["timings"][phase] = tot["timings"].get(phase,0.0) + secs
+    return totals
+
+
+class MetricsCollector(object):
+
+    def __init__(self, loop=None, job_manager=None, interval=5, window=60):
+        """
+        Collect metrics every "interval" seconds. Throughputs are
+        computed over the last "window" seconds.
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.job_manager = job_manager
+        self.interval = interval
+        self.window = window
+        self.samples = deque()
+        self.gauges = OrderedDict()
+        self.gauge_providers = []
+        self._task = None
+        if job_manager:
+            self.register_gauges(job_manager.get_metrics)
+
+    def register_gauges(self, func):
+        """
+        Register a function returning a dict of gauges (name => value),
+        called each time metrics are collected
+        """
+        self.gauge_providers.append(func)
+
+    def start(self):
+        # start from scratch, pids from previous hub instances could be re-used
+        for fn in glob.glob(os.path.join(get_metrics_dir(),"*.pickle")):
+            os.unlink(fn)
+        self._task = asyncio.ensure_future(self.run(),loop=self.loop)
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            try:
+                # reading files is done in a thread to not block the loop
+                totals = yield from self.loop.run_in_executor(None,self.read_totals)
+                self.add_sample(time.time(),totals)
+                self.gauges = self.collect_gauges()
+            except Exception as e:
+                logger.warning("Error while collecting metrics: %s" % e)
+            yield from asyncio.sleep(self.interval)
+
+    def read_totals(self):
+        registries = [get_registry()]
+        mypid = "%s.pickle" % os.getpid()
+        for fn in glob.glob(os.path.join(get_metrics_dir(),"*.pickle")):
+            if os.path.basename(fn) == mypid:
+                continue # already have it, up-to-date
+            try:
+                registries.append(pickle.load(open(fn,"rb")))
+            except (EOFError, pickle.UnpicklingError, FileNotFoundError):
+                pass
+        return merge_registries(registries)
+
+    def add_sample(self, ts, totals):
+        self.samples.append((ts,totals))
+        # keep one sample older than window, as the reference point
+        while len(self.samples) > 2 and self.samples[1][0] <= ts - self.window:
+            self.samples.popleft()
+
+    def collect_gauges(self):
+        gauges = OrderedDict()
+        for func in self.gauge_providers:
+            try:
+                gauges.update(func())
+            except Exception as e:
+                logger.warning("Can't collect gauges from %s: %s" % (func,e))
+        return gauges
+
+    def get_throughputs(self):
+        """
+        Return counters and throughputs, per (step,source)
+        """
+        if not self.samples:
+            return OrderedDict()
+        t0,first = self.samples[0]
+        t1,last = self.samples[-1]
+        dt = t1 - t0
+        res = OrderedDict()
+        for key in sorted(last,key=lambda k: (STEPS.index(k[0]) if k[0] in STEPS else len(STEPS),k[0],str(k[1]))):
+            cur = last[key]
+            prev = first.get(key,new_counters())
+            res[key] = {"docs" : cur["docs"],
+                        "bytes" : cur["bytes"],
+                        "docs_per_sec" : dt and (cur["docs"] - prev["docs"]) / dt or 0.0,
+                        "bytes_per_sec" : dt and (cur["bytes"] - prev["bytes"]) / dt or 0.0,
+                        "timings" : dict(cur["timings"])}
+        return res
+
+    def get_step_throughputs(self):
+        """Same as get_throughputs() but aggregated per step"""
+        res = OrderedDict()
+        for (step,_),vals in self.get_throughputs().items():
+            agg = res.setdefault(step,dict(dict.fromkeys(["docs","bytes","docs_per_sec","bytes_per_sec"],0),timings={}))
+            for k in vals:
+                if k == "timings":
+                    for phase,secs in vals[k].items():
+                        agg[k][phase] = agg[k].get(phase,0.0) + secs
+                else:
+                    agg[k] += vals[k]
+        return res
+
+    def get_metrics(self):
+        return {"steps" : self.get_step_throughputs(),
+                "sources" : OrderedDict([("%s:%s" % k,v) for k,v in self.get_throughputs().items()]),
+                "gauges" : self.gauges}
+
+    def report(self, step=None):
+        """
+        Print throughputs per step and source (only for "step" if passed),
+        followed by gauges (queues, workers, ...)
+        """
+        line = "{:<8}|{:<35}|{:>12}|{:>10}|{:>12}|{:>12}"
+        print(line.format("STEP","SOURCE","DOCS","DOCS/S","BYTES","BYTES/S"))
+        for (st,src),vals in self.get_throughputs().items():
+            if step and st != step:
+                continue
+            print(line.format(st,str(src)[:35],vals["docs"],"%.1f" % vals["docs_per_sec"],
+                              sizeof_fmt(vals["bytes"]),"%s/s" % sizeof_fmt(vals["bytes_per_sec"])))
+            if vals["timings"]:
+                print("{:<8} {}".format("",", ".join(["%s: %.1fs" % (phase,secs) \
+                        for phase,secs in sorted(vals["timings"].items())])))
+        for name,val in self.gauges.items():
+            print("%s: %s" % (name,val))
+
+    def render_prometheus(self):
+        """Render metrics using Prometheus text exposition format"""
+        lines = []
+        def add(name, mtype, helpmsg, values):
+            fullname = "%s_%s" % (PROMETHEUS_PREFIX,name)
+            lines.append("# HELP %s %s" % (fullname,helpmsg))
+            lines.append("# TYPE %s %s" % (fullname,mtype))
+            for labels,val in values:
+                lbl = ",".join(['%s="%s"' % (k,escape_label(v)) for k,v in labels])
+                lines.append("%s%s %s" % (fullname,lbl and "{%s}" % lbl or "",val))
+        thr = self.get_throughputs()
+        for field,mtype,helpmsg in [("docs","counter","Documents processed"),
+                                    ("bytes","counter","Bytes processed"),
+                                    ("docs_per_sec","gauge","Documents processed per second"),
+                                    ("bytes_per_sec","gauge","Bytes processed per second")]:
+            name = mtype == "counter" and "%s_total" % field or field
+            add(name,mtype,helpmsg,[((("step",k[0]),("source",k[1])),v[field]) for k,v in thr.items()])
+        add("seconds_total","counter","Time spent per phase",
+            [((("step",k[0]),("source",k[1]),("phase",phase)),secs) \
+                    for k,v in thr.items() for phase,secs in sorted(v["timings"].items())])
+        for name,val in self.gauges.items():
+            if isinstance(val,(int,float)):
+                add(name,"gauge",name.replace("_"," "),[((),val)])
+        return "\n".join(lines) + "\n"
+
+    @asyncio.coroutine
+    def handle_http(self, reader, writer):
+        try:
+            request = yield from reader.readline()
+            # consume headers
+            while True:
+                header = yield from reader.readline()
+                if not header or header in (b"\r\n",b"\n"):
+                    break
+            parts = request.decode(errors="replace").split()
+            path = len(parts) > 1 and parts[1] or ""
+            if path.split("?")[0] == "/metrics":
+                status = "200 OK"
+                body = self.render_prometheus().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not found, try /metrics\n"
+            writer.write(("HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\n" % status + \
+                          "Content-Length: %d\r\n\r\n" % len(body)).encode() + body)
+            yield from writer.drain()
+        finally:
+            writer.close()
+
+    def start_http_server(self, host="127.0.0.1", port=9100):
+        """
+        Serve Prometheus metrics on http://host:port/metrics (no authentication,
+        listening on localhost by default)
+        """
+        return asyncio.start_server(self.handle_http,host=host,port=port)
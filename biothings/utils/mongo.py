@@ -282,7 +282,8 @@ def id_feeder(col, batch_size=1000, build_cache=True, logger=logging,
         cache_file = get_cache_filename(col.name)
         try:
             # size of empty file differs depending on compression
-            empty_size = {None:0,"xz":32,"gzip":25,"bz2":14}
+            # (gzip is block-compressed, empty file is BGZF's EOF block)
+            empty_size = {None:0,"xz":32,"gzip":28,"bz2":14}
             if force_build:
                 logger.warning("Force building cache file")
                 use_cache = False
@@ -1,53 +1,394 @@
 '''
-Utils for running parallel jobs on IPython cluster.
+Utils for running parallel jobs on remote workers.
+
+RemoteWorkerExecutor is a concurrent.futures.Executor listening on a TCP port.
+Worker daemons (see run_worker()) connect to it, announce how many jobs they can
+run at the same time (their capacity) and pull jobs whenever they have a free slot.
+Jobs are pickled callables, so functions must be importable on the worker side
+(workers typically run from the hub's application folder, with same config).
+Workers stream back job-tracking events (job started, job done) and results.
+
+Messages are pickled objects, prefixed with their length (8 bytes, big endian)
+and their HMAC-SHA256 signature. Hub and workers share a secret key
+(HUB_REMOTE_WORKERS_AUTHKEY in config) and messages are only unpickled if
+their signature is valid, since unpickling runs code. By default, the hub only
+listens on localhost (see HUB_REMOTE_WORKERS_HOST).
 '''
-import os, sys
-import time
-import copy
-from ipyparallel import Client
+import os, sys, time, copy
+import socket, struct, pickle, threading, hmac, hashlib
+import logging
+import concurrent.futures
+from collections import deque
+from functools import partial
+
+
+HEADER = struct.Struct("!Q")
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+class RemoteWorkerError(Exception):
+    pass
+
+class AuthenticationError(RemoteWorkerError):
+    pass
+
+
+def check_authkey(authkey):
+    """Return authkey as bytes, raise ValueError if not set"""
+    if not authkey:
+        raise ValueError("No authentication key set for remote workers " + \
+                         "(see HUB_REMOTE_WORKERS_AUTHKEY)")
+    return isinstance(authkey,bytes) and authkey or authkey.encode()
+
+
+def sign(authkey, data):
+    return hmac.new(authkey,data,hashlib.sha256).digest()
+
+
+def send_msg(sock, msg, authkey, lock=None):
+    data = pickle.dumps(msg,protocol=pickle.HIGHEST_PROTOCOL)
+    frame = HEADER.pack(len(data)) + sign(authkey,data) + data
+    if lock:
+        with lock:
+            sock.sendall(frame)
+    else:
+        sock.sendall(frame)
+
+
+def recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf),1024*1024))
+        if not chunk:
+            raise EOFError("Connection closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_msg(sock, authkey):
+    size = HEADER.unpack(recv_exactly(sock,HEADER.size))[0]
+    digest = recv_exactly(sock,DIGEST_SIZE)
+    data = recv_exactly(sock,size)
+    if not hmac.compare_digest(digest,sign(authkey,data)):
+        raise AuthenticationError("Invalid message signature")
+    return pickle.loads(data)
+
+
+class RemoteJob(object):
+
+    def __init__(self, job_id, future, payload, pinfo):
+        self.job_id = job_id
+        self.future = future
+        self.payload = payload
+        self.pinfo = pinfo
+        self.worker = None
+        self.started_at = None
+        self.retries = 0
+
+
+class WorkerConnection(object):
+    """Hub side of a connected worker"""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.lock = threading.Lock()
+        self.name = "%s:%s" % addr[:2]
+        self.capacity = 0
+        self.credits = 0  # number of jobs the worker asked for
+        self.jobs = {}    # job_id => RemoteJob, running on that worker
+        self.done = 0
+        self.connected_at = time.time()
+
 
-# ipcluster expecting to be in the folder where the app config is
-# because ipcluster will just import this file/module, kind of as if
-# it was building a main script from this lib
-import config, biothings
-biothings.config_for_app(config)
-from biothings.utils.common import timesofar, ask
+class RemoteWorkerExecutor(concurrent.futures.Executor):
+    """
+    Executor dispatching jobs to remote workers. Jobs running on a worker which
+    disconnects are re-submitted (up to "max_retries" times), so jobs should
+    be idempotent (like merge or index batches). "authkey" is the secret
+    shared with workers, required.
+    """
 
+    def __init__(self, host="127.0.0.1", port=0, max_retries=1, logger=logging, authkey=None):
+        self.authkey = check_authkey(authkey)
+        self.host = host
+        self.port = port
+        self.max_retries = max_retries
+        self.logger = logger
+        self.workers = []
+        self._pending = deque()
+        self._lock = threading.RLock()
+        self._job_cnt = 0
+        self._shutdown = False
+        self._server = None
 
-def run_jobs_on_ipythoncluster(worker, task_list, shutdown_ipengines_after_done=False):
+    def start(self):
+        """Start listening for workers, return (host,port) actually used"""
+        self._server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self._server.bind((self.host,self.port))
+        self._server.listen(64)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept,name="remote-workers-server",daemon=True).start()
+        self.logger.info("Waiting for remote workers on port %s" % self.port)
+        return (self.host,self.port)
 
+    @property
+    def capacity(self):
+        """Total number of jobs connected workers can run in parallel"""
+        with self._lock:
+            return sum([w.capacity for w in self.workers])
+
+    @property
+    def load(self):
+        """Number of jobs queued or running"""
+        with self._lock:
+            return len(self._pending) + sum([len(w.jobs) for w in self.workers])
+
+    def submit(self, fn, *args, **kwargs):
+        if kwargs:
+            fn = partial(fn,**kwargs)
+        return self.submit_job(None,fn,*args)
+
+    def submit_job(self, pinfo, fn, *args):
+        """
+        Submit fn(*args) to a remote worker, "pinfo" is used
+        for reporting (see JobManager)
+        """
+        f = concurrent.futures.Future()
+        try:
+            payload = pickle.dumps(partial(fn,*args),protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            f.set_exception(RemoteWorkerError("Can't pickle job %s: %s" % (fn,e)))
+            return f
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._job_cnt += 1
+            self._pending.append(RemoteJob(self._job_cnt,f,payload,pinfo))
+            self._dispatch()
+        return f
+
+    def _dispatch(self):
+        # called with lock acquired
+        while self._pending:
+            worker = max(self.workers,key=lambda w: w.credits,default=None)
+            if not worker or worker.credits <= 0:
+                return
+            job = self._pending.popleft()
+            # re-submitted jobs (from a lost worker) are already running
+            if not job.future.running() and not job.future.set_running_or_notify_cancel():
+                continue # cancelled while pending
+            try:
+                send_msg(worker.sock,("job",job.job_id,job.payload),self.authkey,worker.lock)
+            except OSError as e:
+                self.logger.warning("Can't send job to worker %s: %s" % (worker.name,e))
+                self._pending.appendleft(job)
+                self._drop(worker)
+                continue
+            worker.credits -= 1
+            job.worker = worker.name
+            job.started_at = time.time()
+            worker.jobs[job.job_id] = job
+
+    def _accept(self):
+        while not self._shutdown:
+            try:
+                sock, addr = self._server.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            worker = WorkerConnection(sock,addr)
+            threading.Thread(target=self._serve,args=(worker,),daemon=True,
+                             name="remote-worker-%s" % worker.name).start()
+
+    def _serve(self, worker):
+        try:
+            msg = recv_msg(worker.sock,self.authkey)
+            assert msg[0] == "hello", "Expecting 'hello' from worker, got %s" % repr(msg[0])
+            info = msg[1]
+            worker.capacity = info["capacity"]
+            worker.name = "%s:%s" % (info.get("host",worker.addr[0]),info.get("pid"))
+            with self._lock:
+                self.workers.append(worker)
+            self.logger.info("Remote worker %s connected (capacity: %s)" % (worker.name,worker.capacity))
+            while True:
+                msg = recv_msg(worker.sock,self.authkey)
+                if msg[0] == "pull":
+                    with self._lock:
+                        worker.credits += msg[1]
+                        self._dispatch()
+                elif msg[0] == "started":
+                    with self._lock:
+                        job = worker.jobs.get(msg[1])
+                        if job:
+                            job.started_at = msg[2].get("started_at",job.started_at)
+                elif msg[0] == "result":
+                    _, job_id, ok, payload, _info = msg
+                    with self._lock:
+                        job = worker.jobs.pop(job_id,None)
+                        worker.done += 1
+                    if not job:
+                        continue
+                    try:
+                        if ok:
+                            job.future.set_result(pickle.loads(payload))
+                        else:
+                            job.future.set_exception(payload)
+                    except Exception as e:
+                        job.future.set_exception(RemoteWorkerError("Can't load result: %s" % e))
+                elif msg[0] == "bye":
+                    break
+        except (EOFError, OSError) as e:
+            if not self._shutdown:
+                self.logger.warning("Lost connection with remote worker %s: %s" % (worker.name,e))
+        except Exception as e:
+            self.logger.error("Error with remote worker %s: %s" % (worker.name,e))
+        finally:
+            with self._lock:
+                self._drop(worker)
+
+    def _drop(self, worker):
+        # called with lock acquired
+        if worker in self.workers:
+            self.workers.remove(worker)
+        try:
+            worker.sock.close()
+        except OSError:
+            pass
+        # jobs running there are lost
+        for job in list(worker.jobs.values()):
+            if job.retries < self.max_retries and not self._shutdown:
+                self.logger.warning("Re-submitting job #%s, previously running on worker %s" % (job.job_id,worker.name))
+                job.retries += 1
+                job.worker = None
+                self._pending.appendleft(job)
+            else:
+                job.future.set_exception(RemoteWorkerError("Worker %s running job #%s disconnected" % (worker.name,job.job_id)))
+        worker.jobs = {}
+        worker.credits = 0
+        self._dispatch()
+
+    def get_workers(self):
+        with self._lock:
+            return [{"name" : w.name, "capacity" : w.capacity, "running" : len(w.jobs),
+                     "done" : w.done, "connected_at" : w.connected_at} for w in self.workers]
+
+    def get_running(self):
+        """Return running jobs, as (worker name, pinfo, started_at) tuples"""
+        with self._lock:
+            return [(w.name,j.pinfo,j.started_at) for w in self.workers for j in w.jobs.values()]
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            for job in self._pending:
+                job.future.cancel()
+            self._pending.clear()
+            workers = list(self.workers)
+        for worker in workers:
+            try:
+                send_msg(worker.sock,("stop",),self.authkey,worker.lock)
+            except OSError:
+                pass
+        if self._server:
+            self._server.close()
+        if wait:
+            for worker in workers:
+                for job in list(worker.jobs.values()):
+                    try:
+                        job.future.exception()
+                    except concurrent.futures.CancelledError:
+                        pass
+
+
+def run_payload(payload):
+    """Run pickled job (in a worker's process), returning pickled result"""
+    try:
+        res = pickle.loads(payload)()
+        return pickle.dumps(res,protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        # if job recorded hub metrics, make sure they're written
+        metrics = sys.modules.get("biothings.utils.metrics")
+        if metrics:
+            metrics.flush_registry()
+
+
+def run_worker(host, port, capacity=None, logger=logging, authkey=None):
+    """
+    Connect to a RemoteWorkerExecutor listening on host:port and run jobs
+    (up to "capacity" jobs at the same time, using sub-processes) until
+    the hub asks to stop or closes the connection. "authkey" is the secret
+    shared with the hub, required.
+    """
+    authkey = check_authkey(authkey)
+    capacity = capacity or os.cpu_count() or 1
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=capacity)
+    # start sub-processes before connecting, otherwise they would inherit the socket
+    # and the connection wouldn't be closed if this process dies
+    list(pool.map(time.sleep,[0.1] * capacity))
+    sock = socket.create_connection((host,port))
+    sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    lock = threading.Lock()
+    send_msg(sock,("hello",{"host" : socket.gethostname(), "pid" : os.getpid(), "capacity" : capacity}),authkey,lock)
+    send_msg(sock,("pull",capacity),authkey,lock)
+    logger.info("Connected to %s:%s, capacity: %s" % (host,port,capacity))
+
+    def done(job_id, f):
+        try:
+            res = f.result()
+            msg = ("result",job_id,True,res,{"ended_at" : time.time()})
+        except Exception as e:
+            logger.error("Job #%s failed: %s" % (job_id,e))
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RemoteWorkerError("%s: %s" % (type(e).__name__,e))
+            msg = ("result",job_id,False,e,{"ended_at" : time.time()})
+        try:
+            send_msg(sock,msg,authkey,lock)
+            # slot is free, ask for more
+            send_msg(sock,("pull",1),authkey,lock)
+        except OSError as e:
+            logger.warning("Can't send result for job #%s: %s" % (job_id,e))
+
+    try:
+        while True:
+            msg = recv_msg(sock,authkey)
+            if msg[0] == "job":
+                _, job_id, payload = msg
+                f = pool.submit(run_payload,payload)
+                send_msg(sock,("started",job_id,{"started_at" : time.time(), "pid" : os.getpid()}),authkey,lock)
+                f.add_done_callback(partial(done,job_id))
+            elif msg[0] == "stop":
+                break
+    except (EOFError, OSError) as e:
+        logger.info("Connection closed: %s" % e)
+    finally:
+        pool.shutdown(wait=True)
+        try:
+            send_msg(sock,("bye",),authkey,lock)
+        except OSError:
+            pass
+        sock.close()
+
+
+def run_jobs(worker, task_list, executor=None):
+    """
+    Run worker(task) for each task in task_list, using given executor
+    (eg. a RemoteWorkerExecutor) or local processes if None.
+    Results are returned in same order as task_list.
+    """
     t0 = time.time()
-    rc = Client(config.CLUSTER_CLIENT_JSON)
-    lview = rc.load_balanced_view()
-    cnt_nodes = len(lview.targets or rc.ids)
-    print("\t# nodes in use: {}".format(cnt_nodes))
-    lview.block = False
-    # move to app path
-    lview.map(os.chdir, [config.APP_PATH] * cnt_nodes)
-    print("\t# of tasks: {}".format(len(task_list)))
-    print("\tsubmitting...", end='')
-    job = lview.map_async(worker,task_list)
-    print("done.")
+    own_executor = executor is None
+    executor = executor or concurrent.futures.ProcessPoolExecutor()
     try:
-        job.wait_interactive()
-    except KeyboardInterrupt:
-        #handle "Ctrl-C"
-        if ask("\nAbort all submitted jobs?") == 'Y':
-            lview.abort()
-            print("Aborted, all submitted jobs are cancelled.")
-        else:
-            print("Aborted, but your jobs are still running on the cluster.")
-        return
-
-    if len(job.result()) != len(task_list):
-        print("WARNING:\t# of results returned ({}) != # of tasks ({}).".format(len(job.result()), len(task_list)))
-    print("\ttotal time: {}".format(timesofar(t0)))
-
-    if shutdown_ipengines_after_done:
-        print("\tshuting down all ipengine nodes...", end='')
-        lview.shutdown()
-        print('Done.')
-    return job.result()
+        futures = [executor.submit(worker,task) for task in task_list]
+        return [f.result() for f in futures]
+    finally:
+        if own_executor:
+            executor.shutdown()
+        logging.info("%d tasks done in %.1fs" % (len(task_list),time.time() - t0))
 
 
 def collection_partition(src_collection_list, step=100000):
@@ -68,3 +409,25 @@ def collection_partition(src_collection_list, step=100000):
             __kwargs = copy.copy(_kwargs)
             __kwargs['skip'] = s
             yield __kwargs
+
+
+def main():
+    import argparse, importlib
+    parser = argparse.ArgumentParser(description="Run a hub remote worker")
+    parser.add_argument("--host",default="localhost",help="hub host")
+    parser.add_argument("--port",type=int,required=True,help="hub remote workers port (HUB_REMOTE_WORKERS_PORT)")
+    parser.add_argument("--capacity",type=int,default=None,help="number of jobs to run in parallel (default: nb of cpus)")
+    parser.add_argument("--config",default="config",help="application config module")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # jobs usually need the application config, like in the hub
+    sys.path.insert(0,os.getcwd())
+    import biothings
+    biothings.config_for_app(importlib.import_module(args.config))
+    # same secret as the hub, from config (not command line, visible to other users)
+    run_worker(args.host,args.port,args.capacity,
+               authkey=getattr(biothings.config,"HUB_REMOTE_WORKERS_AUTHKEY",None))
+
+
+if __name__ == "__main__":
+    main()
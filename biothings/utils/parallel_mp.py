@@ -1,6 +1,7 @@
 from biothings.utils.backend import DocESBackend, DocMongoBackend, DocMemoryBackend, DocBackendOptions
 from biothings.utils.es import ESIndexer
 from biothings.utils.common import iter_n
+from biothings.utils.resultchannel import wrap_result, unwrap_result, DEFAULT_THRESHOLD
 from multiprocessing import Pool
 from glob import glob
 from os.path import abspath, isdir, join, exists
@@ -26,7 +27,8 @@ class ParallelResult(object):
         self.agg_function = agg_function
 
     def aggregate(self, curr):
-        self.res = self.agg_function(self.res, curr)
+        # chunk results can come as handles (see biothings.utils.resultchannel)
+        self.res = self.agg_function(self.res, unwrap_result(curr))
 
 # Handles errors in async apply
 class ErrorHandler(object):
@@ -46,7 +48,8 @@ class ErrorHandler(object):
 
 def run_parallel_on_iterable(fun, iterable, backend_options=None, agg_function=agg_by_append, agg_function_init=[],
                             chunk_size=1000000, num_workers=DEFAULT_THREADS, outpath=None,
-                            mget_chunk_size=10000, ignore_None=True, error_path=None, **query_kwargs):
+                            mget_chunk_size=10000, ignore_None=True, error_path=None,
+                            result_threshold=DEFAULT_THRESHOLD, **query_kwargs):
     
     ''' This function will run a user function on all documents in a backend database in parallel using
         multiprocessing.Pool.  The overview of the process looks like this:  
@@ -98,6 +101,10 @@ def run_parallel_on_iterable(fun, iterable, backend_options=None, agg_function=a
         :param ignore_None:
                 If set, then falsy values will not be aggregated (0, [], None, etc) in the aggregation step.
                 Default True.
+        :param result_threshold:
+                Chunk results bigger than this size (in bytes, once pickled) are passed back through
+                shared memory or a spill file instead of the pool's pipe (see biothings.utils.resultchannel).
+                None to always pass results through the pipe.
 
         All other parameters are fed to the backend query.
       '''
@@ -123,7 +130,7 @@ def run_parallel_on_iterable(fun, iterable, backend_options=None, agg_function=a
             # apply function to chunk
             p.apply_async(_run_one_chunk, 
                     args=(chunk_num, chunk, fun, backend_options, agg_function, agg_function_init, 
-                    outpath, mget_chunk_size, ignore_None), callback=ret.aggregate, 
+                    outpath, mget_chunk_size, ignore_None, result_threshold), callback=ret.aggregate, 
                     error_callback=ErrorHandler(error_path, chunk_num).handle)
         # close pool and wait for completion of all workers
         p.close()
@@ -211,7 +218,7 @@ def run_parallel_on_ids_dir(fun, ids_dir, backend_options=None, agg_function=agg
 
 
 def _run_one_chunk(chunk_num, chunk, fun, backend_options, agg_function, 
-                   agg_function_init, outpath, mget_chunk_size, ignore_None):
+                   agg_function_init, outpath, mget_chunk_size, ignore_None, result_threshold=None):
     # iterator if chunk is a file path
     def _file_path_iterator(fp):
         with open(fp, 'r') as fh:
@@ -258,4 +265,6 @@ def _run_one_chunk(chunk_num, chunk, fun, backend_options, agg_function,
     if outpath and _file:
         _file.close()
 
-    return ret.res
+    if result_threshold is None:
+        return ret.res
+    return wrap_result(ret.res,threshold=result_threshold)
@@ -0,0 +1,110 @@
+"""
+Result channel for large worker return values.
+
+Values returned by a worker process go through the executor's pipe: they're
+pickled in the worker, sent to the parent and unpickled there (usually in
+the thread running the event loop). For large values, workers can instead
+call wrap_result(): if the pickled value is bigger than a threshold, it's
+written to shared memory (or to a spill file if shared memory isn't available)
+and only a lightweight ResultHandle is returned. Smaller values are returned
+already pickled, within the handle, so they're not pickled twice. The parent
+then calls unwrap_result() (or handle.load()), ideally from a thread, to get
+the value back.
+"""
+import os, pickle, tempfile
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+
+# pickled size (bytes) from which a result goes through the channel
+DEFAULT_THRESHOLD = 1024 * 1024
+
+
+class ResultHandle(object):
+    """
+    Reference to a pickled value stored in shared memory ("shm"), in a
+    spill file ("file") or held by the handle itself ("inline", "data" being
+    the pickled value). A handle can be loaded only once, resources are
+    released after loading.
+    """
+
+    def __init__(self, mode, name, size, data=None):
+        self.mode = mode
+        self.name = name
+        self.size = size
+        self.data = data
+
+    def __repr__(self):
+        return "<%s %s:%s (%d bytes)>" % (self.__class__.__name__,self.mode,self.name,self.size)
+
+    def load(self):
+        if self.mode == "inline":
+            data, self.data = self.data, None
+            return pickle.loads(data)
+        elif self.mode == "shm":
+            shm = shared_memory.SharedMemory(name=self.name)
+            try:
+                with shm.buf[:self.size] as buf:
+                    # unpickled directly from shared memory, no intermediate copy
+                    return pickle.loads(buf)
+            finally:
+                shm.close()
+                shm.unlink()
+        else:
+            try:
+                with open(self.name,"rb") as fin:
+                    return pickle.load(fin)
+            finally:
+                os.unlink(self.name)
+
+    def discard(self):
+        """Release resources without loading the value"""
+        try:
+            if self.mode == "inline":
+                self.data = None
+            elif self.mode == "shm":
+                shm = shared_memory.SharedMemory(name=self.name)
+                shm.close()
+                shm.unlink()
+            else:
+                os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+
+def wrap_result(obj, threshold=DEFAULT_THRESHOLD, mode=None, spill_dir=None):
+    """
+    Return a ResultHandle for obj, holding its pickled value if its size is
+    below "threshold" bytes (None means always store it), otherwise storing
+    it. "mode" is "shm" (default when available) or "file", in which case
+    spill files are created in "spill_dir" (default: system's temp dir).
+    """
+    data = pickle.dumps(obj,protocol=pickle.HIGHEST_PROTOCOL)
+    if threshold is not None and len(data) < threshold:
+        # pickled again as bytes only, no need to go through obj again
+        return ResultHandle("inline",None,len(data),data)
+    mode = mode or (shared_memory and "shm" or "file")
+    if mode == "shm":
+        shm = shared_memory.SharedMemory(create=True,size=len(data))
+        shm.buf[:len(data)] = data
+        # parent process owns the segment now, it must survive this worker
+        resource_tracker.unregister(shm._name,"shared_memory")
+        handle = ResultHandle("shm",shm.name,len(data))
+        shm.close()
+    else:
+        fd, path = tempfile.mkstemp(prefix="result_",suffix=".pickle",dir=spill_dir)
+        with os.fdopen(fd,"wb") as fout:
+            fout.write(data)
+        handle = ResultHandle("file",path,len(data))
+    return handle
+
+
+def unwrap_result(res):
+    """Load value if "res" is a ResultHandle, return it unchanged otherwise"""
+    if isinstance(res,ResultHandle):
+        return res.load()
+    return res
@@ -4,8 +4,6 @@ import json
 
 from biothings import config
 from biothings.utils.hub_db import IDatabase
-from biothings.utils.dotfield import parse_dot_fields
-from biothings.utils.dataload import update_dict_recur
 from biothings.utils.common import json_serial
 
 def get_hub_db_conn():
@@ -45,6 +43,14 @@ def get_source_fullname(col_name):
         else:
             return name
 
+def get_parent(doc, dotkey):
+    """Return (dict containing "dotkey" in "doc", last key), creating missing levels"""
+    keys = dotkey.split(".")
+    for key in keys[:-1]:
+        doc = doc.setdefault(key,{})
+    return doc, keys[-1]
+
+
 class Database(IDatabase):
 
     def __init__(self):
@@ -150,16 +156,17 @@ class Collection(object):
             conn.commit()
 
     def update_one(self,query,what):
-        assert len(what) == 1 and ("$set" in what or \
-                "$unset" in what or "$push" in what), "$set/$unset/$push operators not found"
+        assert len(what) == 1 and ("$set" in what or "$unset" in what or \
+                "$push" in what or "$inc" in what), "$set/$unset/$push/$inc operators not found"
         doc = self.find_one(query)
         if doc:
             if "$set" in what:
-                # parse_dot_fields uses json.dumps internally, we can to make
-                # sure everything is serializable first
+                # make sure everything is serializable first
                 what = json.loads(json.dumps(what,default=json_serial))
-                what = parse_dot_fields(what["$set"])
-                doc = update_dict_recur(doc,what)
+                for setkey,val in what["$set"].items():
+                    # as mongo does, value is replaced (not merged)
+                    sub, key = get_parent(doc,setkey)
+                    sub[key] = val
             elif "$unset" in what:
                 for keytounset in what["$unset"].keys():
                     doc.pop(keytounset,None)
@@ -167,6 +174,10 @@ class Collection(object):
                 for listkey,elem in what["$push"].items():
                     assert not "." in listkey, "$push not supported for nested keys: %s" % listkey
                     doc.setdefault(listkey,[]).append(elem)
+            elif "$inc" in what:
+                for inckey,val in what["$inc"].items():
+                    sub, key = get_parent(doc,inckey)
+                    sub[key] = sub.get(key,0) + val
 
             self.save(doc)
 
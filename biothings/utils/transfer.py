@@ -0,0 +1,519 @@
+"""
+Resumable, segmented HTTP downloads.
+
+If the server supports range requests (and the file is big enough), the file
+is split in segments downloaded concurrently, each one written at its own offset
+in a preallocated local file. Progress is kept in a segment map saved next to the
+local file ("<localfile>.segments"), so an interrupted download resumes where it
+stopped. Dropped connections are retried from the last received byte. If ranges
+aren't supported, the file is downloaded with a single GET request.
+
+A ContentTap can be given to process content (checksums, decompression)
+while it's downloaded, so the file doesn't have to be read again afterwards,
+and to limit download rate with a Throttle.
+"""
+import os, json, time, threading
+import logging, hashlib, zlib, bz2
+import concurrent.futures
+
+import requests
+
+
+CHUNK_SIZE = 512 * 1024
+# files smaller than 2 x MIN_SEGMENT_SIZE are downloaded with one request
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+# don't save segment map more often than this (seconds)
+SAVE_INTERVAL = 1.0
+
+
+class TransferError(Exception):
+    pass
+
+
+class RangeNotSupported(TransferError):
+    """Server answered a range request with the whole content"""
+    pass
+
+class Interrupted(Exception):
+    """Connection dropped before all expected bytes were received"""
+    pass
+
+
+class Checksums(object):
+    """Compute checksums ("md5", "sha256", ... any hashlib algorithm) of content"""
+
+    def __init__(self, algos=("md5",)):
+        self.algos = algos
+        self.reset()
+
+    def reset(self):
+        self.hashes = {algo : hashlib.new(algo) for algo in self.algos}
+
+    def update(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def result(self):
+        return {algo : h.hexdigest() for algo,h in self.hashes.items()}
+
+
+class Decompressor(object):
+    """
+    Decompress gzip (".gz") or bzip2 (".bz2") content to "path"
+    (default: compressed file's name without extension)
+    """
+
+    CODECS = {".gz" : lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+              ".bz2" : bz2.BZ2Decompressor}
+
+    @classmethod
+    def supports(klass, localfile):
+        return os.path.splitext(localfile)[1].lower() in klass.CODECS
+
+    def __init__(self, localfile, path=None):
+        self.ext = os.path.splitext(localfile)[1].lower()
+        self.path = path or os.path.splitext(localfile)[0]
+        self.fout = None
+        self.reset()
+
+    def reset(self):
+        if self.fout:
+            self.fout.close()
+        self.decomp = self.CODECS[self.ext]()
+        self.fout = open(self.path + ".tmp","wb")
+
+    def update(self, data):
+        while data:
+            if self.decomp.eof:
+                # concatenated gzip members/bzip2 streams
+                self.decomp = self.CODECS[self.ext]()
+            self.fout.write(self.decomp.decompress(data))
+            data = self.decomp.eof and self.decomp.unused_data or b""
+
+    def close(self):
+        if self.fout:
+            if self.ext == ".gz":
+                self.fout.write(self.decomp.flush())
+            self.fout.close()
+            self.fout = None
+            os.rename(self.path + ".tmp",self.path)
+
+    def abort(self):
+        if self.fout:
+            self.fout.close()
+            self.fout = None
+            os.unlink(self.path + ".tmp")
+
+    def result(self):
+        return {"decompressed" : self.path}
+
+
+class Throttle(object):
+    """
+    Token bucket limiting download rate to "rate" bytes/s (None: no limit),
+    shared by all segments. If "path" is set, rate is read from that JSON file
+    ({"rate" : ...}, as written by hub's DownloadScheduler) every "refresh"
+    seconds, so it can change while downloading. "burst" is the number of
+    seconds worth of bytes which can be received at once.
+    """
+
+    def __init__(self, rate=None, path=None, refresh=1.0, burst=1.0):
+        self.rate = rate
+        self.path = path
+        self.refresh = refresh
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last = time.time()
+        self.last_read = 0.0
+        # total time spent waiting
+        self.waited = 0.0
+
+    def reload(self, now):
+        if not self.path or now - self.last_read < self.refresh:
+            return
+        self.last_read = now
+        try:
+            with open(self.path) as fin:
+                self.rate = json.load(fin).get("rate")
+        except (OSError, ValueError):
+            # no allocation (anymore), keep previous rate
+            pass
+
+    def consume(self, nbytes):
+        """Account "nbytes" received, sleep if going faster than allowed"""
+        with self.lock:
+            now = time.time()
+            self.reload(now)
+            if not self.rate:
+                self.tokens = 0.0
+                self.last = now
+                return
+            self.tokens = min(self.tokens + (now - self.last) * self.rate,self.rate * self.burst)
+            self.last = now
+            # borrow tokens, paid back while sleeping (so concurrent callers queue up)
+            self.tokens -= nbytes
+            wait = self.tokens < 0 and -self.tokens / self.rate or 0
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+
+
+class ContentTap(object):
+    """
+    Feed downloaded content, in order, to consumers (Checksums, Decompressor,
+    ...) while it's downloaded. Segments are downloaded concurrently so chunks
+    ahead of current position are buffered (up to "max_buffer" bytes), or skipped
+    and read back from local file when calling finish().
+    If "throttle" is set, downloads are slowed down to throttle's rate.
+    """
+
+    def __init__(self, consumers, max_buffer=64 * 1024 * 1024, throttle=None):
+        self.consumers = consumers
+        self.max_buffer = max_buffer
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.pos = 0
+        self.pending = {}
+        self.pending_size = 0
+        # bytes read back from local file
+        self.reread = 0
+
+    def reset(self):
+        """Content will be sent again from the beginning"""
+        with self.lock:
+            self.pos = 0
+            self.pending = {}
+            self.pending_size = 0
+            for consumer in self.consumers:
+                consumer.reset()
+
+    def _consume(self, data):
+        for consumer in self.consumers:
+            consumer.update(data)
+        self.pos += len(data)
+
+    def feed(self, offset, data):
+        size = len(data)
+        with self.lock:
+            if offset == self.pos:
+                self._consume(data)
+                while self.pos in self.pending:
+                    data = self.pending.pop(self.pos)
+                    self.pending_size -= len(data)
+                    self._consume(data)
+            elif offset > self.pos and self.pending_size + len(data) <= self.max_buffer:
+                self.pending[offset] = data
+                self.pending_size += len(data)
+        if self.throttle:
+            self.throttle.consume(size)
+
+    def finish(self, localfile, chunk_size=CHUNK_SIZE):
+        """Process content not fed yet (read from localfile), return consumers' results"""
+        with self.lock:
+            size = os.path.getsize(localfile)
+            with open(localfile,"rb") as fin:
+                while self.pos < size:
+                    if self.pos in self.pending:
+                        data = self.pending.pop(self.pos)
+                    else:
+                        nexts = [o for o in self.pending if o > self.pos]
+                        upto = min(nexts + [size,self.pos + chunk_size])
+                        fin.seek(self.pos)
+                        data = fin.read(upto - self.pos)
+                        self.reread += len(data)
+                    self._consume(data)
+            self.pending = {}
+            self.pending_size = 0
+            results = {}
+            for consumer in self.consumers:
+                consumer.close()
+                results.update(consumer.result())
+            return results
+
+    def abort(self):
+        """Download failed, release consumers' resources"""
+        with self.lock:
+            for consumer in self.consumers:
+                consumer.abort()
+
+
+def get_segment_map_path(localfile):
+    return localfile + ".segments"
+
+
+class SegmentMap(object):
+    """
+    Download progress: list of [start,end,pos] segments (end is inclusive, pos is
+    the next byte to download), plus remote file's size and validators so we don't
+    resume a download with a different remote file.
+    """
+
+    def __init__(self, path, url, size, validators, segments=None):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.validators = validators
+        self.segments = segments or []
+        self.lock = threading.Lock()
+        self.last_save = 0
+
+    @classmethod
+    def load(klass, path):
+        try:
+            dat = json.load(open(path))
+            return klass(path,dat["url"],dat["size"],dat["validators"],dat["segments"])
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    @classmethod
+    def create(klass, path, url, size, validators, num):
+        seg_size = size // num
+        segments = []
+        for i in range(num):
+            start = i * seg_size
+            end = size - 1 if i == num - 1 else start + seg_size - 1
+            segments.append([start,end,start])
+        return klass(path,url,size,validators,segments)
+
+    def matches(self, url, size, validators):
+        return self.url == url and self.size == size and self.validators == validators
+
+    def progress(self, idx, pos):
+        with self.lock:
+            self.segments[idx][2] = pos
+            if time.time() - self.last_save > SAVE_INTERVAL:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        json.dump({"url" : self.url, "size" : self.size, "validators" : self.validators,
+                   "segments" : self.segments},open(tmp,"w"))
+        os.rename(tmp,self.path)
+        self.last_save = time.time()
+
+    def remaining(self):
+        return sum([end - pos + 1 for start,end,pos in self.segments])
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def probe(session, url, headers=None):
+    """
+    Return (response,size,accept_ranges,validators) for remote url,
+    using a HEAD request (size is None if unknown)
+    """
+    res = session.head(url,headers=headers,allow_redirects=True)
+    if res.status_code != 200:
+        return (res,None,False,{})
+    size = res.headers.get("Content-Length")
+    size = size is not None and int(size) or None
+    # Content-Length for compressed content isn't the actual size
+    if res.headers.get("Content-Encoding") not in (None,"identity"):
+        size = None
+    accept_ranges = res.headers.get("Accept-Ranges","").lower() == "bytes"
+    validators = {k : res.headers[k] for k in ("ETag","Last-Modified") if k in res.headers}
+    return (res,size,accept_ranges,validators)
+
+
+def fetch_range(session, url, localfile, start, end, headers=None, on_progress=None,
+                chunk_size=CHUNK_SIZE, timeout=None, tap=None):
+    """
+    Download bytes [start,end] (inclusive) of url, writing them at same offset in
+    localfile (which must exist). on_progress(pos) is called after each written chunk.
+    Raises Interrupted if connection was dropped before "end".
+    """
+    hdrs = dict(headers or {})
+    hdrs["Range"] = "bytes=%d-%d" % (start,end)
+    pos = start
+    try:
+        res = session.get(url,headers=hdrs,stream=True,timeout=timeout)
+        if res.status_code != 206:
+            res.close()
+            if res.status_code == 200:
+                raise RangeNotSupported("Range request on '%s' ignored by server" % url)
+            raise TransferError("Range request on '%s' failed (status: %s, reason: %s)" % \
+                    (url,res.status_code,res.reason))
+        with open(localfile,"r+b") as fout:
+            fout.seek(start)
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                if not chunk:
+                    continue
+                chunk = chunk[:end - pos + 1]
+                fout.write(chunk)
+                if tap:
+                    tap.feed(pos,chunk)
+                pos += len(chunk)
+                if on_progress:
+                    on_progress(pos)
+                if pos > end:
+                    break
+        res.close()
+    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout) as e:
+        raise Interrupted(pos,str(e))
+    if pos <= end:
+        raise Interrupted(pos,"connection closed")
+    return pos
+
+
+def clone_session(session):
+    """Return a new requests.Session with same settings as "session" (auth, TLS, proxies, ...)"""
+    sess = requests.Session()
+    sess.headers.update(session.headers)
+    sess.cookies.update(session.cookies)
+    for attr in ("auth","verify","cert","proxies","params","trust_env","max_redirects"):
+        setattr(sess,attr,getattr(session,attr))
+    return sess
+
+
+def download_segmented(session, url, localfile, segmap, headers=None, max_retries=5,
+                       chunk_size=CHUNK_SIZE, timeout=None, tap=None, logger=logging):
+    """
+    Download segments from "segmap" with concurrent range requests, raise
+    RangeNotSupported if server ignores them.
+    """
+    todo = [i for i,(start,end,pos) in enumerate(segmap.segments) if pos <= end]
+
+    def get_segment(idx):
+        # one session per thread, requests.Session isn't thread-safe
+        sess = clone_session(session)
+        retries = 0
+        try:
+            while True:
+                start,end,pos = segmap.segments[idx]
+                if pos > end:
+                    return
+                try:
+                    fetch_range(sess,url,localfile,pos,end,headers=headers,chunk_size=chunk_size,timeout=timeout,
+                                tap=tap,on_progress=lambda p: segmap.progress(idx,p))
+                except Interrupted as e:
+                    retries += 1
+                    if retries > max_retries:
+                        raise TransferError("Segment #%d of '%s' failed after %d retries: %s" % \
+                                (idx,url,max_retries,e.args[1]))
+                    logger.warning("Segment #%d of '%s' interrupted at byte %s (%s), retrying (%d/%d)" % \
+                            (idx,url,e.args[0],e.args[1],retries,max_retries))
+                    time.sleep(min(2 ** retries * 0.1,10))
+        finally:
+            sess.close()
+            segmap.save()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(todo) or 1) as pool:
+        futures = [pool.submit(get_segment,idx) for idx in todo]
+        errors = []
+        for f in futures:
+            try:
+                f.result()
+            except Exception as e:
+                errors.append(e)
+    for e in errors:
+        if isinstance(e,RangeNotSupported):
+            raise e
+    if errors:
+        raise TransferError("Download of '%s' failed, can be resumed: %s" % (url,errors))
+
+
+def download_single(session, url, localfile, headers=None, size=None, accept_ranges=False,
+                    max_retries=5, chunk_size=CHUNK_SIZE, timeout=None, tap=None, logger=logging):
+    """
+    Download url with one GET request. If interrupted and server supports ranges,
+    it resumes from last received byte, otherwise it starts again.
+    """
+    retries = 0
+    pos = 0
+    while True:
+        hdrs = dict(headers or {})
+        if pos:
+            hdrs["Range"] = "bytes=%d-" % pos
+        try:
+            res = session.get(url,headers=hdrs,stream=True,timeout=timeout)
+            if res.status_code not in (pos and 206 or 200,):
+                raise TransferError("Error while downloading '%s' (status: %s, reason: %s)" % \
+                        (url,res.status_code,res.reason))
+            if tap and not pos:
+                tap.reset()
+            with open(localfile,pos and "r+b" or "wb") as fout:
+                fout.seek(pos)
+                for chunk in res.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        fout.write(chunk)
+                        if tap:
+                            tap.feed(pos,chunk)
+                        pos += len(chunk)
+                fout.truncate()
+            res.close()
+            if size is not None and pos < size:
+                raise Interrupted(pos,"connection closed")
+            return res
+        except (Interrupted, requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            retries += 1
+            if retries > max_retries:
+                raise TransferError("Download of '%s' failed after %d retries: %s" % (url,max_retries,e))
+            if not (accept_ranges and size):
+                pos = 0 # can't resume, start again
+            logger.warning("Download of '%s' interrupted at byte %s (%s), retrying (%d/%d)" % \
+                    (url,pos,e,retries,max_retries))
+            time.sleep(min(2 ** retries * 0.1,10))
+
+
+def download(session, url, localfile, headers=None, segments=4, min_segment_size=MIN_SEGMENT_SIZE,
+             max_retries=5, chunk_size=CHUNK_SIZE, timeout=None, tap=None, logger=logging):
+    """
+    Download url to localfile using requests' session, with up to "segments" concurrent
+    range requests (when supported, and each segment is at least "min_segment_size" bytes).
+    An interrupted segmented download is resumed if the remote file hasn't changed.
+    Content is sent to "tap" (ContentTap) while downloaded, call tap.finish() afterwards.
+    Returns a requests' response object, HEAD's response for a segmented download,
+    GET's response (already consumed) otherwise.
+    """
+    res, size, accept_ranges, validators = probe(session,url,headers)
+    mappath = get_segment_map_path(localfile)
+    num = size and min(segments,size // min_segment_size) or 0
+    if not (accept_ranges and size and num > 1):
+        logger.debug("Downloading '%s' using a single request" % url)
+        res = download_single(session,url,localfile,headers=headers,size=size,accept_ranges=accept_ranges,
+                              max_retries=max_retries,chunk_size=chunk_size,timeout=timeout,tap=tap,
+                              logger=logger)
+        if os.path.exists(mappath):
+            os.unlink(mappath)
+        return res
+
+    segmap = SegmentMap.load(mappath)
+    if segmap and segmap.matches(url,size,validators) and os.path.exists(localfile) \
+            and os.path.getsize(localfile) == size:
+        logger.info("Resuming download of '%s' (%d bytes remaining)" % (url,segmap.remaining()))
+    else:
+        segmap = SegmentMap.create(mappath,url,size,validators,num)
+        with open(localfile,"wb") as fout:
+            if hasattr(os,"posix_fallocate"):
+                os.posix_fallocate(fout.fileno(),0,size)
+            else:
+                fout.truncate(size)
+        segmap.save()
+        logger.debug("Downloading '%s' using %d segments" % (url,num))
+    try:
+        download_segmented(session,url,localfile,segmap,headers=headers,max_retries=max_retries,
+                           chunk_size=chunk_size,timeout=timeout,tap=tap,logger=logger)
+    except RangeNotSupported as e:
+        # Accept-Ranges advertised but not honored
+        logger.warning("%s, downloading using a single request" % e)
+        segmap.remove()
+        return download_single(session,url,localfile,headers=headers,size=size,accept_ranges=False,
+                               max_retries=max_retries,chunk_size=chunk_size,timeout=timeout,tap=tap,
+                               logger=logger)
+    segmap.remove()
+    return res